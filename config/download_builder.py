@@ -17,6 +17,10 @@ from pathlib import Path
 # weight for age
 # https://cdn.who.int/media/docs/default-source/child-growth/child-growth-standards/indicators/weight-for-age/tab_wfa_girls_p_0_5.xlsx
 
+# weight for length (45-110 cm, under 2 years) and weight for height (65-120 cm, 2-5 years)
+# https://cdn.who.int/media/docs/default-source/child-growth/child-growth-standards/indicators/weight-for-length-height/tab_wfl_girls_p_0_2.xlsx
+# https://cdn.who.int/media/docs/default-source/child-growth/child-growth-standards/indicators/weight-for-length-height/tab_wfh_girls_p_2_5.xlsx
+
 
 tables = {
     "bmi": [
@@ -34,6 +38,12 @@ tables = {
     "height": [
         "https://cdn.who.int/media/docs/default-source/child-growth/child-growth-standards/indicators/length-height-for-age/tab_lhfa_girls_p_0_2.xlsx",
         "https://cdn.who.int/media/docs/default-source/child-growth/child-growth-standards/indicators/length-height-for-age/tab_lhfa_girls_p_2_5.xlsx"
+    ],
+    "weight_length": [
+        "https://cdn.who.int/media/docs/default-source/child-growth/child-growth-standards/indicators/weight-for-length-height/tab_wfl_girls_p_0_2.xlsx"
+    ],
+    "weight_height": [
+        "https://cdn.who.int/media/docs/default-source/child-growth/child-growth-standards/indicators/weight-for-length-height/tab_wfh_girls_p_2_5.xlsx"
     ]
 }   
 
@@ -62,7 +72,9 @@ def description_metric(url: str, metric) -> dict:
         "bmi": f"WHO Growth Tables percentile for body mass index for age {age_range} years",
         "hc": f"WHO Growth Tables for head circumference for age {age_range} years",
         "weight": f"WHO Growth Tables for weight for age {age_range} years",
-        "height": f"WHO Growth Tables for length/height for age {age_range} years"
+        "height": f"WHO Growth Tables for length/height for age {age_range} years",
+        "weight_length": f"WHO Growth Tables for weight for length (45-110 cm) for age {age_range} years",
+        "weight_height": f"WHO Growth Tables for weight for height (65-120 cm) for age {age_range} years"
     }
     return description[metric]
 
@@ -1,10 +1,25 @@
 import pandas as pd
-import plotly.express as px
 import dash
 from dash import dcc, html
 from dash.dependencies import Input, Output, State
 import base64
-import io
+
+from src.reference_store import shared_growth_database
+from src.jobs import JobQueue
+from src.plot import PERCENTILES, METRIC_LABELS, PERCENTILE_COLUMNS, reference_curves
+
+# Reference tables are loaded once per process; the curves are sent to the browser once
+# and every interaction after an upload (metric, percentile lines, age window) is drawn
+# by a clientside callback without a round-trip to the server.
+growth_tables = shared_growth_database()
+# Uploads are scored by background jobs; the callbacks only enqueue them and poll their progress.
+# The job directory holds copies of the uploads, old jobs are removed on startup and while polling.
+job_queue = JobQueue()
+job_queue.cleanup()
+JOB_POLL_MS = 500
+
+DEFAULT_PERCENTILES = ['P5', 'P50', 'P95']
+
 
 # Create a Dash app
 app = dash.Dash(__name__)
@@ -40,75 +55,158 @@ app.layout = html.Div([
         value='auto',
         style={'width': '50%', 'margin': '10px'}
     ),
+    html.Div([
+        dcc.DatePickerSingle(id='dob', placeholder='Date of birth', display_format='YYYY-MM-DD'),
+        dcc.RadioItems(
+            id='gender',
+            options=[{'label': 'Girl', 'value': 'F'}, {'label': 'Boy', 'value': 'M'}],
+            value='F',
+            inline=True,
+            style={'margin': '10px'}
+        ),
+    ], style={'display': 'flex', 'alignItems': 'center', 'margin': '10px'}),
     html.Div(id='output-data-upload'),
-    html.Div(id='scatterplots')
+    html.Div(id='job-progress'),
+    dcc.Interval(id='job-poll', interval=JOB_POLL_MS, disabled=True),
+    html.Div([
+        dcc.Dropdown(
+            id='metric',
+            options=[{'label': label, 'value': col} for col, label in METRIC_LABELS.items()],
+            value='weight_kg',
+            clearable=False,
+            style={'width': '40%', 'margin': '10px'}
+        ),
+        dcc.Checklist(
+            id='percentiles',
+            options=[{'label': f'{p}th', 'value': p} for p in PERCENTILES],
+            value=DEFAULT_PERCENTILES,
+            inline=True,
+            style={'margin': '10px'}
+        ),
+        dcc.RangeSlider(
+            id='age-window', min=0, max=60, step=1, value=[0, 60],
+            marks={m: f'{m}m' for m in range(0, 61, 6)},
+        ),
+    ]),
+    dcc.Graph(id='growth-chart'),
+    ## the reference curves never change: sent once with the layout
+    dcc.Store(id='reference-store', data=reference_curves(growth_tables)),
+    ## scored measurements, only written by the server when the jobs of an upload are finished
+    dcc.Store(id='scored-store'),
+    ## ids of the jobs of the current upload
+    dcc.Store(id='job-store'),
 ])
 
 
-def clean_data(contents, filename, file_format):
-    decoded = base64.b64decode(contents[0])
-    print(decoded[:100])
-    try:
-        if file_format == 'auto':
-            if 'csv' in filename:
-                df = pd.read_csv(io.StringIO(decoded.decode('utf-8')))
-            elif 'xls' in filename or 'xlsx' in filename:
-                df = pd.read_excel(io.BytesIO(decoded))
-            else:
-                # Assume CSV by default if format cannot be determined
-                df = pd.read_csv(io.StringIO(decoded.decode('utf-8')))
-        elif file_format == 'excel':
-            df = pd.read_excel(io.BytesIO(decoded))
-        elif file_format == 'csv':
-            df = pd.read_csv(io.StringIO(decoded.decode('utf-8')))
-    except Exception as e:
-        print(e)
-        return html.Div([
-            'There was an error processing this file.'
-        ])
-
-    # Clean up the data (replace NaNs, remove duplicates, etc.)
-    # Your cleaning process here
-    cleaned_df = df.dropna()  # Example: Drop NaN values
-
-    return cleaned_df
-
-
-@app.callback(Output('output-data-upload', 'children'),
-              [Input('upload-data', 'contents')],
-              [State('upload-data', 'filename'),
-               State('format-dropdown', 'value')])
-def update_output(contents, filename, file_format):
-    if contents is not None:
-        cleaned_df = clean_data(contents, filename, file_format)
-        return html.Div([
-            html.H5(filename),
-            html.H6('Cleaned Data Preview:'),
-            html.Div(cleaned_df.head())
-        ])
-
-
-@app.callback(Output('scatterplots', 'children'),
-              [Input('upload-data', 'contents')],
+def scored_records(frames) -> list:
+    """The scored rows of finished jobs as json records for the scored-store"""
+    scored = pd.concat(frames, ignore_index=True).sort_values('months')
+    columns = ['date', 'months'] + list(METRIC_LABELS) + list(PERCENTILE_COLUMNS.values())
+    scored = scored[[c for c in columns if c in scored.columns]]
+    scored['date'] = scored['date'].astype(str)
+    scored = scored.round(2).astype(object)
+    scored = scored.where(scored.notna(), None)  ## null in json
+    return scored.to_dict('records')
+
+
+@app.callback(Output('job-store', 'data'),
+              Output('job-poll', 'disabled'),
+              Output('output-data-upload', 'children'),
+              [Input('upload-data', 'contents'),
+               Input('dob', 'date'),
+               Input('gender', 'value')],
               [State('upload-data', 'filename'),
                State('format-dropdown', 'value')])
-def update_scatterplots(contents, filename, file_format):
-    if contents is not None:
-        cleaned_df = clean_data(contents, filename, file_format)
+def enqueue_upload(contents, dob, gender, filenames, file_format):
+    """Enqueue one scoring job per uploaded file and start polling"""
+    if contents is None:
+        return None, True, None
+    if dob is None:
+        return None, True, html.Div('Select the date of birth to score the upload.')
+    job_ids = [
+        job_queue.submit(base64.b64decode(content.split(',', 1)[-1]), filename, dob[:10], gender, file_format)
+        for content, filename in zip(contents, filenames)
+    ]
+    return job_ids, False, html.H6(f'Scoring {", ".join(filenames)}')
+
+
+@app.callback(Output('job-progress', 'children'),
+              Output('scored-store', 'data'),
+              Output('job-poll', 'disabled', allow_duplicate=True),
+              Input('job-poll', 'n_intervals'),
+              State('job-store', 'data'),
+              prevent_initial_call=True)
+def poll_jobs(n_intervals, job_ids):
+    """Report the progress of the upload's jobs and publish the scores once all are finished"""
+    if not job_ids:
+        return None, None, True
+    job_queue.maybe_cleanup()
+    jobs = job_queue.jobs(job_ids)
+    progress = [
+        html.Div([
+            html.Span(f'{job.filename}: ', style={'marginRight': '5px'}),
+            html.Progress(value=str(job.progress), max='1', style={'width': '30%'}),
+            html.Span(f' {job.done_rows}/{job.total_rows} rows' if job.status != 'failed'
+                      else f' could not be scored: {job.message}'),
+        ]) for job in jobs
+    ]
+    if not all(job.finished for job in jobs):
+        return progress, dash.no_update, False
+    frames = [job_queue.result(job.id) for job in jobs if job.status == 'done']
+    if not frames:
+        return progress, None, True
+    return progress, scored_records(frames), True
 
-        # Create scatter plots
-        fig_bmi = px.scatter(cleaned_df, x='Age', y='BMI', title='BMI Scatter Plot')
-        fig_weight = px.scatter(cleaned_df, x='Age', y='Weight', title='Weight Scatter Plot')
-        fig_length = px.scatter(cleaned_df, x='Age', y='Length', title='Length Scatter Plot')
-        fig_hc = px.scatter(cleaned_df, x='Age', y='Head Circumference', title='Head Circumference Scatter Plot')
 
-        return html.Div([
-            dcc.Graph(figure=fig_bmi),
-            dcc.Graph(figure=fig_weight),
-            dcc.Graph(figure=fig_length),
-            dcc.Graph(figure=fig_hc)
-        ])
+## drawn in the browser: switching metric, percentile lines or age window never reaches the server
+app.clientside_callback(
+    """
+    function(scored, reference, metric, percentiles, ageWindow, gender) {
+        const lo = ageWindow[0], hi = ageWindow[1];
+        const sex = gender === 'M' ? 'boys' : 'girls';
+        const traces = [];
+        const ref = reference.curves[sex] && reference.curves[sex][metric];
+        if (ref) {
+            const keep = ref.months.map(m => m >= lo && m <= hi);
+            const months = ref.months.filter((m, i) => keep[i]);
+            (percentiles || []).forEach(function(p) {
+                traces.push({
+                    x: months, y: ref[p].filter((v, i) => keep[i]),
+                    mode: 'lines', name: p + 'th', hoverinfo: 'name+y',
+                    line: {width: 1, color: reference.colors[p]}
+                });
+            });
+        }
+        if (scored && scored.length) {
+            const pcol = reference.percentile_columns[metric];
+            const rows = scored.filter(r => r[metric] !== null && r[metric] !== undefined && r.months >= lo && r.months <= hi);
+            traces.push({
+                x: rows.map(r => r.months), y: rows.map(r => r[metric]),
+                text: rows.map(r => r.date + ' (' + r[pcol] + '%)'),
+                mode: 'markers', name: 'Subject', marker: {size: 6, color: 'red'}
+            });
+        }
+        return {
+            data: traces,
+            layout: {
+                title: {text: reference.labels[metric] + ' growth percentiles'},
+                xaxis: {title: {text: 'Age (months)'}, range: [lo, hi]},
+                yaxis: {title: {text: reference.labels[metric]}},
+                uirevision: metric,
+                height: 600
+            }
+        };
+    }
+    """,
+    Output('growth-chart', 'figure'),
+    Input('scored-store', 'data'),
+    Input('reference-store', 'data'),
+    Input('metric', 'value'),
+    Input('percentiles', 'value'),
+    Input('age-window', 'value'),
+    Input('gender', 'value'),
+)
 
 
 if __name__ == '__main__':
-    app.run_server(debug=True)
+    app.run(debug=True)
@@ -7,11 +7,35 @@ from loguru import logger
 
 from src.downloader import DataSet, Downloader
 from src.database import Child, get_growth_table, build_growth_database
+from src.reference_store import shared_growth_database, store_version
+from src.result_cache import ResultCache, result_key
 from src.plot import plot_subplot_growth_percentiles
-from src.ingest_csv import huckleberry_reader, standardize_reader
+from src.ingest_csv import resolve_format, FORMATS
+from src.ingest_polars import benchmark_backends, BACKENDS
+from src.merge import score_exports, MERGE_STRATEGIES, DEFAULT_WINDOW
+from src.validation import log_flag_summary
+from src.conformance import run_conformance
+from src.console_output import print_growth, DISPLAY_MODES, DEFAULT_ROWS
+from src.population import summarize_files, without_column, CHUNKSIZE, PREVALENCE
+from src.pipeline import DirectoryPipeline, DEFAULT_READERS, DEFAULT_SCORERS, DEFAULT_WRITERS, DEFAULT_QUEUE_SIZE
+from src.watcher import FolderWatcher, load_children, DEFAULT_INTERVAL
 from rich.table import Table
 from rich.console import Console
 
+## output csv name of a single input, by format
+OUTPUT_NAMES = {'standard': 'standardized'}
+HUCKLEBERRY_HELP = 'Deprecated, same as --format huckleberry'
+
+
+def legacy_format(is_huckleberry: bool, input_format: str) -> str:
+    """The input format, with the deprecated --huckleberry flag mapped to --format huckleberry"""
+    if not is_huckleberry:
+        return input_format
+    if input_format not in ('auto', 'huckleberry'):
+        raise click.BadParameter(f"conflicts with --format {input_format}", param_hint="'--huckleberry'")
+    logger.warning("--huckleberry/-hb is deprecated, use --format huckleberry")
+    return 'huckleberry'
+
 @click.group(
         context_settings=dict(
             help_option_names=['-h', '--help'],
@@ -46,53 +70,180 @@ def download(output: str = 'data', table_json: str = 'config/WHO_growth_tables.j
             logger.warning(f"Failed to download {dataset.filename}: {result.error}")
 
 @cli.command('growth')
-@click.option('--csv','-i',      required=True,  type=click.Path(exists=True), help='The input huckleburry csv file')
+@click.option('--csv','-i',      required=True,  type=click.Path(exists=True), multiple=True, help='The input csv export (huckleberry, standard, ...). Repeat to merge several sources, preferred source first')
 @click.option('--dob', '-d',     required=True, type=click.DateTime(['%Y-%m-%d']), help='The date of birth of the child ' )
 @click.option('--gender', '-g',  required=True, type=click.Choice(['M','F']), help='Select gender of the child ["M", "F"]')
 @click.option('--name', '-n',     default='child', help='Name of child for the output file')
 @click.option('--savepath', '-s', default=Path.cwd(), help='Save path for the output file')
 @click.option('--prefix', '-p',   default=None, help='The prefix of the output file')
-@click.option('--huckleberry', '-hb', 'is_huckleberry',  is_flag=True, help='The input file is a huckleberry csv file')
+@click.option('--format', '-f', 'input_format', default='auto', type=click.Choice(['auto'] + list(FORMATS)), help='Export format of the input files, detected from their header by default')
+@click.option('--huckleberry', '-hb', 'is_huckleberry', is_flag=True, help=HUCKLEBERRY_HELP)
 @click.option('--verbose', '-v',  is_flag=True, help='Prints the dataframe to the console')
-def growth(csv, dob, gender, name, savepath, prefix, verbose, is_huckleberry):
+@click.option('--display',        default='auto', type=click.Choice(DISPLAY_MODES), help='How to print the results: auto (full table for short histories, otherwise the tail), full, tail, summary or page')
+@click.option('--rows', '-r',     default=DEFAULT_ROWS, type=int, help='Number of rows shown in the tail display')
+@click.option('--quiet', '-q',    is_flag=True, help='Do not print the results or open the chart, for scripted runs')
+@click.option('--backend',        default='pandas', type=click.Choice(BACKENDS), help='Dataframe library used to read and parse the csv file (polars is optional)')
+@click.option('--merge-window',   default=DEFAULT_WINDOW, help='With several inputs, measurements this close in time (e.g. 1h, 1d) are merged into one')
+@click.option('--merge-strategy', default='priority', type=click.Choice(MERGE_STRATEGIES), help='Merged value: from the first input that has one (priority) or the median')
+@click.option('--no-cache',       is_flag=True, help='Score the input again even if the same input was scored before')
+def growth(csv, dob, gender, name, savepath, prefix, verbose, input_format, is_huckleberry, display, rows, quiet, backend, merge_window, merge_strategy, no_cache):
+    input_format = legacy_format(is_huckleberry, input_format)
     child = Child(name,gender,  dob)
-    growth_tables = build_growth_database()
+    growth_tables = shared_growth_database()
     # growth_tables = get_growth_table()
     if prefix is None:
         prefix = child.name
     savepath = Path(savepath)
     if not savepath.exists():
         savepath.mkdir()
-    if is_huckleberry:
-        df = huckleberry_reader(csv, child, growth_tables).round(2)
-        df.to_csv(savepath / f"{prefix}_huckleberry.csv", index=False)
+
+    ## the scored rows only depend on the inputs, the child, these options and the code and reference versions.
+    ## They are computed in src/ (`score_exports`), so the code version covers every module they depend on
+    cache = ResultCache()
+    params = dict(dob=child.dob, gender=gender, format=input_format, backend=backend)
+    if len(csv) > 1:
+        params.update(sources=csv, merge_window=merge_window, merge_strategy=merge_strategy)
+    key = result_key(csv, store_version(), **params)
+    df = None if no_cache else cache.get(key)
+    if df is not None:
+        logger.info("Unchanged input, using the cached scores")
     else:
-        df = standardize_reader(csv, child, growth_tables).round(2)
-        df.to_csv(savepath / f"{prefix}_standardized.csv", index=False)
+        df = score_exports(csv, child, growth_tables, input_format, backend, merge_window, merge_strategy)
+        cache.put(key, df)
+
+    output = 'merged' if len(csv) > 1 else resolve_format(input_format, csv[0]).name
+    output = OUTPUT_NAMES.get(output, output)
+    df.to_csv(savepath / f"{prefix}_{output}.csv", index=False)
+    log_flag_summary(df)
 
     if verbose:
         logger.remove()
         logger.add(sys.stderr, level="DEBUG")
+    if not quiet:
+        print_growth(df, Console(), mode=display, rows=rows)
+
+    plot_subplot_growth_percentiles(df, child, growth_tables, savepath/f'{prefix}.html', show=not quiet)
+
+
+@cli.command('watch')
+@click.option('--folder', '-i',   required=True, type=click.Path(exists=True, file_okay=False), help='The folder the csv exports are dropped into')
+@click.option('--children', '-c', required=True, type=click.Path(exists=True), help='Json list of {"pattern", "name", "dob", "gender", "format"} mapping file names to children, format is optional')
+@click.option('--savepath', '-s', default=Path.cwd(), help='Save path for the per-child csv files and charts')
+@click.option('--interval', default=DEFAULT_INTERVAL, type=float, help='Seconds between scans of the folder')
+@click.option('--once', is_flag=True, help='Scan the folder once and exit')
+@click.option('--no-charts', is_flag=True, help='Do not re-render the charts')
+def watch(folder, children, savepath, interval, once, no_charts):
+    """Score new rows of exports dropped into a folder and update the affected children"""
+    watcher = FolderWatcher(folder, load_children(children), Path(savepath),
+                            growth_tables=shared_growth_database(), render=not no_charts)
+    if once:
+        watcher.scan()
+    else:
+        watcher.run(interval)
+
+
+@cli.command('batch')
+@click.option('--folder', '-i',   required=True, type=click.Path(exists=True, file_okay=False), help='The folder of csv exports')
+@click.option('--children', '-c', required=True, type=click.Path(exists=True), help='Json list of {"pattern", "name", "dob", "gender", "format"} mapping file names to children, format is optional')
+@click.option('--savepath', '-s', default=Path.cwd(), help='Save path for the per-file csv files and charts')
+@click.option('--readers',        default=DEFAULT_READERS, type=click.IntRange(min=1), help='Threads reading and parsing files')
+@click.option('--scorers',        default=DEFAULT_SCORERS, type=click.IntRange(min=1), help='Threads scoring parsed files')
+@click.option('--writers',        default=DEFAULT_WRITERS, type=click.IntRange(min=1), help='Threads writing the csv files and charts')
+@click.option('--queue-size',     default=DEFAULT_QUEUE_SIZE, type=click.IntRange(min=1), help='Files buffered between two stages')
+@click.option('--processes', '-j', default=0, type=click.IntRange(min=0), help='Score and render in this many processes (0: in the stage threads)')
+@click.option('--no-charts', is_flag=True, help='Do not render the charts')
+@click.option('--site', default=None, type=click.Path(file_okay=False), help='Write one static report site of all the children here instead of a chart per file')
+def batch(folder, children, savepath, readers, scorers, writers, queue_size, processes, no_charts, site):
+    """Score every export of a folder with overlapping read, score and write stages"""
+    pipeline = DirectoryPipeline(load_children(children), Path(savepath), shared_growth_database(),
+                                 readers=readers, scorers=scorers, writers=writers, queue_size=queue_size,
+                                 render=not no_charts, processes=processes, site=site)
+    report = pipeline.run(folder)
+    table = Table(title=f"{report.files} files in {report.wall_seconds:.2f}s")
+    for col in ["Stage", "Workers", "Items", "Failed", "Items/s", "Busy", "Input queue depth (mean / max)"]:
+        table.add_column(col)
+    for stage, q in zip(report.stages, report.queues):
+        table.add_row(stage.name, str(stage.workers), str(stage.items), str(stage.failed),
+                      f"{stage.items / report.wall_seconds if report.wall_seconds else 0:.1f}",
+                      f"{100 * stage.utilization(report.wall_seconds):.0f}%",
+                      f"{q.mean_depth:.1f} / {q.max_depth} of {q.maxsize}")
+    Console().print(table)
+
+
+@cli.command('population')
+@click.option('--csv', '-i',      required=True, type=click.Path(exists=True), multiple=True, help='Scored csv files (the output of growth, watch or batch), repeat for several files')
+@click.option('--sex-col',        default='gender', help='Column with the sex of each row (M/F)')
+@click.option('--gender', '-g',   default=None, type=click.Choice(['M','F']), help='Sex of every row, for files without a sex column')
+@click.option('--chunksize',      default=CHUNKSIZE, type=int, help='Rows read at a time')
+@click.option('--workers', '-w',  default=1, type=int, help='Files summarized in parallel')
+@click.option('--output', '-o',   default=None, help='Prefix of the prevalence and z-score summary csv files')
+def population(csv, sex_col, gender, chunksize, workers, output):
+    """Prevalence of stunting, underweight, wasting and overweight and z-score summaries by sex and age group"""
+    if gender is None:
+        missing = without_column(csv, sex_col)
+        if missing:
+            raise click.BadParameter(f"no column '{sex_col}' in {', '.join(map(str, missing))}. "
+                                     "Name the sex column with --sex-col, or give the sex of a single child's files with --gender",
+                                     param_hint="'--sex-col'")
+    summary = summarize_files(csv, sex_col=sex_col, sex=gender, chunksize=chunksize, workers=workers)
+    prevalence = summary.prevalence()
+    table = Table(title=f"Prevalence (%) in {summary.rows} measurements")
+    table.add_column("Sex")
+    table.add_column("Age")
+    for indicator in PREVALENCE:
+        table.add_column(indicator.capitalize())
+    for (sex, age_group), row in prevalence.iterrows():
+        table.add_row(sex, age_group, *[
+            '-' if row[f'{i}_n'] == 0 else f"{row[f'{i}_%']:.1f} (n={int(row[f'{i}_n'])})" for i in PREVALENCE])
+    Console().print(table)
+    if output is not None:
+        prevalence.round(2).to_csv(f'{output}_prevalence.csv')
+        summary.stats().round(3).to_csv(f'{output}_zscores.csv')
+
+
+@cli.command('benchmark')
+@click.option('--csv','-i',      required=True,  type=click.Path(exists=True), help='The input csv file')
+@click.option('--dob', '-d',     required=True, type=click.DateTime(['%Y-%m-%d']), help='The date of birth of the child ' )
+@click.option('--gender', '-g',  required=True, type=click.Choice(['M','F']), help='Select gender of the child ["M", "F"]')
+@click.option('--format', '-f', 'input_format', default='auto', type=click.Choice(['auto'] + list(FORMATS)), help='Export format of the input file, detected from its header by default')
+@click.option('--huckleberry', '-hb', 'is_huckleberry', is_flag=True, help=HUCKLEBERRY_HELP)
+@click.option('--repeat', default=3, type=int, help='Runs per backend, the best time is reported')
+def benchmark(csv, dob, gender, input_format, is_huckleberry, repeat):
+    """Time reading and scoring a file with each ingest backend"""
+    input_format = legacy_format(is_huckleberry, input_format)
+    child = Child('child', gender, dob)
+    timings = benchmark_backends(csv, child, shared_growth_database(), fmt=resolve_format(input_format, csv), repeat=repeat)
+    table = Table(title=f"Best of {repeat} runs")
+    table.add_column("Backend")
+    table.add_column("Seconds")
+    for backend, seconds in timings.items():
+        table.add_row(backend, f"{seconds:.4f}")
+    Console().print(table)
+
+
+@cli.command('conformance')
+@click.option('--cases', '-n', default=1_000_000, type=int, help='Number of randomized cases for the vectorized formula check')
+@click.option('--scalar-cases', '-s', default=10_000, type=int, help='Number of cases run through the full scalar reference path')
+@click.option('--seed', default=0, type=int, help='Random seed')
+def conformance(cases, scalar_cases, seed):
+    """Check the optimized scoring paths against the scalar WHO reference"""
+    report = run_conformance(shared_growth_database(), n_cases=cases, n_scalar=scalar_cases, seed=seed)
     console = Console()
-    table = Table()
-    table.add_column("Date")
-    table.add_column("Month")
-    table.add_column("Weight (Kg)")
-    table.add_column("Height (cm)")
-    table.add_column("Head Circumference (cm)")
-    table.add_column("BMI")
-    for idx, row in df.iterrows():
-        table.add_row(
-            str(row['date'].date()), 
-            f"{row['months']:.2f}",
-            f"{row['weight_kg']:.2f} ({row['weight_percentile']:.1f}%)", 
-            f"{row['height_cm']: .2f} ({row['height_percentile']:.1f}%)", 
-            f"{row['hc_cm']: .2f} ({row['hc_percentile']:.1f}%)", 
-            f"{row['bmi']: .2f} ({row['bmi_percentile']:.1f}%)"
-            )
+    table = Table(title=f"{report.cases} cases, {report.scalar_cases} through the scalar reference")
+    table.add_column("Path")
+    table.add_column("Cases")
+    table.add_column("Max |dz|")
+    table.add_column("Max |d percentile|")
+    table.add_column("NaN mismatches")
+    for name, res in report.paths.items():
+        table.add_row(name, str(res.cases), f"{res.max_z_deviation:.3g}", f"{res.max_percentile_deviation:.3g}", str(res.mismatched_nan))
     console.print(table)
-
-    plot_subplot_growth_percentiles(df, child, growth_tables, savepath/f'{prefix}.html')
+    failures = report.failures()
+    for failure in failures:
+        logger.error(failure)
+    if failures:
+        sys.exit(1)
+    logger.success("All scoring paths conform to the reference")
 
 
 if __name__ == "__main__":
@@ -1,4 +1,5 @@
 import math 
+import numpy as np
 from scipy.stats import norm
 from abc import ABC, abstractmethod
 from src import logger
@@ -124,7 +125,7 @@ def interpolate_lms(age, data):
     age_upper = data.index[data.index >= age].min()
     
     age_diff = age_upper - age_lower
-    age_frac = (age - age_lower) / age_diff
+    age_frac = (age - age_lower) / age_diff if age_diff else 0.0  ## age is on a table row
     
     L = data.loc[age_lower, 'L'] + age_frac * (data.loc[age_upper, 'L'] - data.loc[age_lower, 'L'])
     M = data.loc[age_lower, 'M'] + age_frac * (data.loc[age_upper, 'M'] - data.loc[age_lower, 'M'])
@@ -132,6 +133,64 @@ def interpolate_lms(age, data):
     logger.debug(f"Interpolated LMS: {age=} {L=}, {M=}, {S=}")
     return L, M, S
 
+def interpolate_lms_index(values, data):
+    """
+    Vectorized linear interpolation of L, M, and S at the given index values.
+    The table index (months, or length/height in cm) must be sorted; np.interp
+    locates each value with a binary search. Values outside the index return NaN.
+
+    Args:
+        values (array-like): The ages in months or lengths in cm.
+        data (pandas.DataFrame): The data frame containing L, M, and S values.
+
+    Returns:
+        tuple: A tuple of numpy arrays with the interpolated L, M, and S values.
+    """
+    values = np.asarray(values, dtype='float64')
+    index = data.index.to_numpy(dtype='float64')
+    outside = (values < index[0]) | (values > index[-1]) | np.isnan(values)
+    lms = []
+    for col in ['L', 'M', 'S']:
+        interpolated = np.interp(values, index, data[col].to_numpy(dtype='float64'))
+        interpolated[outside] = np.nan
+        lms.append(interpolated)
+    return tuple(lms)
+
+
+def interpolate_lms_array(ages, data):
+    """
+    Vectorized `interpolate_lms` for an array of ages.
+    Ages of 1 month or less are rounded to the nearest month, as in `interpolate_lms`.
+    Ages outside the table index return NaN.
+
+    Args:
+        ages (array-like): The ages in months.
+        data (pandas.DataFrame): The data frame containing L, M, and S values.
+
+    Returns:
+        tuple: A tuple of numpy arrays with the interpolated L, M, and S values.
+    """
+    ages = np.asarray(ages, dtype='float64')
+    ages = np.where(ages <= 1, np.round(ages, 0), ages)
+    return interpolate_lms_index(ages, data)
+
+
+def zscore_lms(L, M, S, y, restricted=True):
+    """Vectorized z-score from LMS parameters.
+    With `restricted=True` the tails beyond +-3 SD are adjusted as in `ZscoreWeight.zscore`,
+    otherwise the plain LMS z-score of `ZscoreHeight.zscore` is returned."""
+    L, M, S, y = (np.asarray(v, dtype='float64') for v in (L, M, S, y))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z = ((y / M) ** L - 1) / (S * L)
+        if not restricted:
+            return z
+        sdx = lambda x: M * (1 + L * S * x) ** (1 / L)
+        sd3pos, sd3neg = sdx(3), sdx(-3)
+        z = np.where(z > 3, 3 + (y - sd3pos) / (sd3pos - sdx(2)), z)
+        z = np.where(z < -3, -3 + (y - sd3neg) / (sdx(-2) - sd3neg), z)
+    return z
+
+
 def calc_bmi(weight, height):
     """Calculate BMI from weight and height"""
     return weight / ((height / 100) ** 2)
\ No newline at end of file
@@ -0,0 +1,269 @@
+# WHO conformance and differential-accuracy harness.
+#
+# The scalar classes (`interpolate_lms` + `ZscoreWeight` / `ZscoreHeight`) are the reference
+# implementation. Every faster path (the vectorized `zscore_lms` / `lms_for_months` used by
+# the ingest pipeline, the `LMSCache`) is run on the same randomized cases and must agree
+# within a tolerance. Golden cases from the WHO computation document pin the LMS formula, and
+# published values of the WHO 0-5 year tables pin the table selection and the interpolation.
+## https://cdn.who.int/media/docs/default-source/child-growth/growth-reference-5-19-years/computation.pdf?sfvrsn=c2ff6a95_4
+from dataclasses import dataclass, field
+from typing import Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+from scipy.stats import norm
+
+from src.calculations import ZscoreWeight, ZscoreHeight, interpolate_lms, zscore_lms
+from src.database import lms_for_months
+from src.lms_cache import LMSCache
+
+
+## WHO table: restricted +-3 SD tails (ZscoreWeight) or not (ZscoreHeight), as used by the ingest pipeline
+SCORED_METRICS = {
+    'wfa': True,
+    'bmi': True,
+    'lhfa': False,
+    'hcfa': False,
+}
+
+## (L, M, S, y, restricted, expected z) worked examples from the WHO computation document
+GOLDEN_CASES: List[Tuple[float, float, float, float, bool, float]] = [
+    (-1.7862, 16.9392, 0.11070, 30, True, 3.35),
+    (-1.3529, 20.4951, 0.12579, 14, True, -3.80),
+    (-1.6318, 16.0490, 0.10038, 19, True, 1.47),
+]
+## the document rounds its intermediate SD values, so its z-scores can be 0.01 off the exact ones
+GOLDEN_TOLERANCE = 0.01
+
+## published WHO 0-5 year table rows: (metric, sex, [(age in months, P3, M, P97), ...])
+## P3 and P97 are published to 0.1, M to 4 decimals. At 24 months the 0-2 year (length)
+## tables are used, the first range containing the age.
+GOLDEN_TABLE_CASES: List[Tuple[str, str, List[Tuple[float, float, float, float]]]] = [
+    ('wfa', 'boys', [(0, 2.5, 3.3464, 4.3), (12, 7.8, 9.6479, 11.8), (24, 9.8, 12.1515, 15.1), (36, 11.4, 14.3429, 18.0), (60, 14.3, 18.3366, 23.8)]),
+    ('wfa', 'girls', [(0, 2.4, 3.2322, 4.2), (12, 7.1, 8.9481, 11.3), (24, 9.2, 11.4775, 14.6), (36, 11.0, 13.8503, 17.8), (60, 14.0, 18.2193, 24.4)]),
+    ('lhfa', 'boys', [(0, 46.3, 49.8842, 53.4), (12, 71.3, 75.7488, 80.2), (24, 82.1, 87.8161, 93.6), (36, 89.1, 96.0835, 103.1), (60, 101.2, 109.9638, 118.7)]),
+    ('lhfa', 'girls', [(0, 45.6, 49.1477, 52.7), (12, 69.2, 74.015, 78.9), (24, 80.3, 86.4153, 92.5), (36, 87.9, 95.0515, 102.2), (60, 100.5, 109.4233, 118.4)]),
+    ('bmi', 'boys', [(0, 11.3, 13.4069, 16.1), (12, 14.5, 16.7981, 19.6), (24, 13.7, 15.7356, 18.3), (36, 13.5, 15.5988, 18.2), (60, 13.0, 15.1916, 18.1)]),
+    ('bmi', 'girls', [(0, 11.2, 13.3363, 15.9), (12, 13.9, 16.3568, 19.4), (24, 13.2, 15.4052, 18.2), (36, 13.2, 15.3968, 18.2), (60, 12.8, 15.2747, 18.6)]),
+    ('hcfa', 'boys', [(0, 32.1, 34.4618, 36.9), (12, 43.6, 46.0661, 48.5), (24, 45.7, 48.2515, 50.8), (36, 46.8, 49.4612, 52.1), (60, 47.9, 50.7375, 53.5)]),
+    ('hcfa', 'girls', [(0, 31.7, 33.8787, 36.1), (12, 42.3, 44.8965, 47.5), (24, 44.6, 47.1822, 49.8), (36, 45.9, 48.5099, 51.2), (60, 47.2, 49.9229, 52.6)]),
+]
+## between two table rows: (metric, sex, age in months, mean of the published M of months 6 and 7)
+GOLDEN_INTERPOLATED: List[Tuple[str, str, float, float]] = [
+    ('wfa', 'boys', 6.5, 8.1155),
+    ('wfa', 'girls', 6.5, 7.4696),
+    ('lhfa', 'boys', 6.5, 68.39405),
+    ('lhfa', 'girls', 6.5, 66.5092),
+    ('bmi', 'boys', 6.5, 17.3355),
+    ('bmi', 'girls', 6.5, 16.90515),
+    ('hcfa', 'boys', 6.5, 43.65545),
+    ('hcfa', 'girls', 6.5, 42.51425),
+]
+## the rounding interval of a published percentile value must contain the exact z of the percentile
+GOLDEN_PERCENTILE_ROUNDING = 0.05
+GOLDEN_P3_Z = float(norm.ppf(0.03))  ## -1.8808
+## z-score of a published median
+GOLDEN_MEDIAN_TOLERANCE = 1e-4
+
+## the deviations allowed between the reference and an optimized path
+Z_TOLERANCE = 1e-9
+PERCENTILE_TOLERANCE = 1e-7
+
+
+@dataclass
+class PathResult:
+    """Deviation of one scoring path from the scalar reference"""
+    cases: int
+    max_z_deviation: float
+    max_percentile_deviation: float
+    mismatched_nan: int          ## cases where only one side could score the value
+    worst_case: dict = field(default_factory=dict)
+
+
+@dataclass
+class ConformanceReport:
+    cases: int
+    scalar_cases: int
+    paths: Dict[str, PathResult]
+    golden_failures: List[str]
+
+    def failures(self, z_tol: float = Z_TOLERANCE, p_tol: float = PERCENTILE_TOLERANCE) -> List[str]:
+        failures = list(self.golden_failures)
+        for name, res in self.paths.items():
+            if res.max_z_deviation > z_tol or res.max_percentile_deviation > p_tol or res.mismatched_nan:
+                failures.append(
+                    f"{name}: max |dz|={res.max_z_deviation:.3g} max |dp|={res.max_percentile_deviation:.3g} "
+                    f"NaN mismatches={res.mismatched_nan} worst={res.worst_case}")
+        return failures
+
+
+def check_golden() -> List[str]:
+    """Return the golden WHO cases the scalar classes get wrong"""
+    failures = []
+    for L, M, S, y, restricted, expected in GOLDEN_CASES:
+        zscore_cls = ZscoreWeight if restricted else ZscoreHeight
+        z = zscore_cls(L, M, S, y).zscore()
+        if abs(z - expected) > GOLDEN_TOLERANCE:
+            failures.append(f"golden {zscore_cls.__name__}(L={L}, M={M}, S={S}, y={y}) = {z:.4f}, expected {expected}")
+    return failures
+
+
+def _golden_table_cases() -> pd.DataFrame:
+    rows = []
+    for metric, gender, points in GOLDEN_TABLE_CASES:
+        for months, p3, median, p97 in points:
+            rows += [(metric, gender, months, 'P3', p3), (metric, gender, months, 'M', median),
+                     (metric, gender, months, 'P97', p97)]
+    rows += [(metric, gender, months, 'M', median) for metric, gender, months, median in GOLDEN_INTERPOLATED]
+    return pd.DataFrame(rows, columns=['metric', 'gender', 'months', 'point', 'value'])
+
+
+def _scalar_zscores(tables: dict, cases: pd.DataFrame) -> np.ndarray:
+    return np.array([scalar_zscore(tables, r.metric, r.gender, r.months, r.value) for r in cases.itertuples()])
+
+
+def check_golden_tables(tables: dict) -> List[str]:
+    """Return the published table values that the scalar reference or the vectorized path score
+    wrongly: a median must give z = 0, and the 0.1 rounding interval of P3 / P97 must contain
+    z = -/+1.881"""
+    cases = _golden_table_cases()
+    cases = cases[[metric in tables.get(gender, {}) for metric, gender in zip(cases['metric'], cases['gender'])]]
+    target = cases['point'].map({'P3': GOLDEN_P3_Z, 'M': 0.0, 'P97': -GOLDEN_P3_Z}).to_numpy()
+    median = (cases['point'] == 'M').to_numpy()
+    failures = []
+    for path, score in (('scalar', _scalar_zscores), ('vectorized', vectorized_zscores)):
+        z = score(tables, cases)
+        low = score(tables, cases.assign(value=cases['value'] - GOLDEN_PERCENTILE_ROUNDING))
+        high = score(tables, cases.assign(value=cases['value'] + GOLDEN_PERCENTILE_ROUNDING))
+        ok = np.where(median, np.abs(z - target) <= GOLDEN_MEDIAN_TOLERANCE, (low <= target) & (target <= high))
+        for r, zi, ti in zip(cases[~ok].itertuples(), z[~ok], target[~ok]):
+            failures.append(f"golden table {path}: {r.metric} {r.gender} {r.months} months {r.point}={r.value:g} "
+                            f"gives z={zi:.4f}, expected {ti:.4f}")
+    return failures
+
+
+def random_cases(tables: dict, n: int, seed: int = 0) -> pd.DataFrame:
+    """Draw `n` (metric, gender, months, value) cases over every loaded table.
+    Ages are rounded to 2 decimals like the ingest pipeline, and the values are drawn
+    from z-scores in [-5, 5] so the +-3 SD tails are exercised."""
+    rng = np.random.default_rng(seed)
+    keys = [(metric, gender) for gender in sorted(tables) for metric in SCORED_METRICS if metric in tables[gender]]
+    pick = rng.integers(0, len(keys), n)
+    metric = np.array([keys[i][0] for i in range(len(keys))])[pick]
+    gender = np.array([keys[i][1] for i in range(len(keys))])[pick]
+    months = np.round(rng.uniform(0, 60, n), 2)
+    ## integer ages hit table rows exactly, make sure they are covered
+    on_row = rng.random(n) < 0.05
+    months[on_row] = rng.integers(0, 61, int(on_row.sum()))
+    z = rng.uniform(-5, 5, n)
+    cases = pd.DataFrame({'metric': metric, 'gender': gender, 'months': months, 'z_drawn': z})
+    cases['value'] = np.nan
+    for (m, g), idx in cases.groupby(['metric', 'gender']).groups.items():
+        L, M, S = lms_for_months(tables, m, g, cases.loc[idx, 'months'])
+        ## y = M (1 + L S z)^(1/L); clip so the base stays positive for extreme z
+        base = np.clip(1 + L * S * cases.loc[idx, 'z_drawn'].to_numpy(), 0.05, None)
+        cases.loc[idx, 'value'] = M * base ** (1 / L)
+    return cases.drop(columns='z_drawn')
+
+
+def _scalar_table(tables: dict, metric: str, gender: str, months: float) -> pd.DataFrame:
+    ## same rule as lms_for_months: first age range (sorted) containing the age at measurement
+    for age_range, table in sorted(tables[gender][metric].items()):
+        if age_range[0] * 12 <= months <= age_range[1] * 12:
+            return table
+    raise ValueError(f"Age {months} months not found in tables")
+
+
+def scalar_zscore(tables: dict, metric: str, gender: str, months: float, value: float) -> float:
+    """Reference z-score: table lookup, interpolate_lms and the scalar classes. NaN if it cannot be scored"""
+    zscore_cls = ZscoreWeight if SCORED_METRICS[metric] else ZscoreHeight
+    try:
+        L, M, S = interpolate_lms(months, _scalar_table(tables, metric, gender, months))
+        return float(zscore_cls(L, M, S, value).zscore())
+    except (ValueError, KeyError, ZeroDivisionError):
+        return np.nan
+
+
+def vectorized_zscores(tables: dict, cases: pd.DataFrame) -> np.ndarray:
+    """z-scores from the vectorized path used by `src.ingest_csv.zscores`"""
+    z = np.full(len(cases), np.nan)
+    cache = LMSCache()
+    for (metric, gender), idx in cases.groupby(['metric', 'gender']).groups.items():
+        pos = cases.index.get_indexer(idx)
+        L, M, S = cache.lms_array(tables, metric, gender, cases.loc[idx, 'months'])
+        z[pos] = zscore_lms(L, M, S, cases.loc[idx, 'value'], restricted=SCORED_METRICS[metric])
+    return z
+
+
+def _compare(reference: np.ndarray, candidate: np.ndarray, cases: pd.DataFrame) -> PathResult:
+    both = ~np.isnan(reference) & ~np.isnan(candidate)
+    mismatched = int((np.isnan(reference) != np.isnan(candidate)).sum())
+    dz = np.abs(reference - candidate)
+    dp = np.abs(norm.cdf(reference) - norm.cdf(candidate)) * 100
+    dz[~both], dp[~both] = 0.0, 0.0
+    worst = {}
+    if len(dz) and dz.max() > 0:
+        i = int(np.argmax(dz))
+        worst = cases.iloc[i].to_dict() | {'reference': reference[i], 'candidate': candidate[i]}
+    elif mismatched:
+        i = int(np.argmax(np.isnan(reference) != np.isnan(candidate)))
+        worst = cases.iloc[i].to_dict() | {'reference': reference[i], 'candidate': candidate[i]}
+    return PathResult(
+        cases=len(reference),
+        max_z_deviation=float(dz.max()) if len(dz) else 0.0,
+        max_percentile_deviation=float(dp.max()) if len(dp) else 0.0,
+        mismatched_nan=mismatched,
+        worst_case=worst,
+    )
+
+
+def run_conformance(tables: dict, n_cases: int = 1_000_000, n_scalar: int = 10_000, seed: int = 0) -> ConformanceReport:
+    """Compare the optimized scoring paths with the scalar reference.
+
+    `n_cases` random cases check the vectorized z-score formula against the scalar classes
+    (the LMS interpolation is shared for speed). A subsample of `n_scalar` cases runs the full
+    scalar path, including `interpolate_lms`, against the vectorized path and the LMSCache.
+    """
+    cases = random_cases(tables, n_cases, seed)
+    vectorized = vectorized_zscores(tables, cases)
+
+    ## formula check on every case: scalar classes on the vectorized LMS
+    classes = np.full(len(cases), np.nan)
+    for (metric, gender), idx in cases.groupby(['metric', 'gender']).groups.items():
+        pos = cases.index.get_indexer(idx)
+        zscore_cls = ZscoreWeight if SCORED_METRICS[metric] else ZscoreHeight
+        L, M, S = lms_for_months(tables, metric, gender, cases.loc[idx, 'months'])
+        for j, (l, m, s, y) in enumerate(zip(L, M, S, cases.loc[idx, 'value'])):
+            try:
+                classes[pos[j]] = zscore_cls(l, m, s, y).zscore()
+            except ValueError:
+                pass
+
+    sub = cases.sample(min(n_scalar, len(cases)), random_state=seed) if len(cases) else cases
+    sub_pos = cases.index.get_indexer(sub.index)
+    reference = np.array([scalar_zscore(tables, r.metric, r.gender, r.months, r.value) for r in sub.itertuples()])
+    cache = LMSCache(maxsize=max(1, len(sub)))
+    cached = np.full(len(sub), np.nan)
+    for j, r in enumerate(sub.itertuples()):
+        try:
+            cached[j] = cache.zscore(tables, r.metric, r.gender, r.months, r.value)
+        except ValueError:
+            pass
+
+    return ConformanceReport(
+        cases=len(cases),
+        scalar_cases=len(sub),
+        paths={
+            'vectorized formula': _compare(classes, vectorized, cases),
+            'vectorized pipeline': _compare(reference, vectorized[sub_pos], sub),
+            'lms cache': _compare(reference, cached, sub),
+        },
+        golden_failures=check_golden() + check_golden_tables(tables),
+    )
+
+
+def assert_conformance(report: ConformanceReport, z_tol: float = Z_TOLERANCE, p_tol: float = PERCENTILE_TOLERANCE):
+    """Raise AssertionError listing every path that diverged from the reference"""
+    failures = report.failures(z_tol, p_tol)
+    if failures:
+        raise AssertionError("Scoring paths diverge from the WHO reference:\n" + "\n".join(failures))
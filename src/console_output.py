@@ -0,0 +1,105 @@
+# Console rendering of scored measurements for the `growth` command.
+#
+# Strings are formatted column-wise with numpy and only for the rows that are shown, so the
+# cost of printing does not grow with the length of the history.
+from typing import Literal
+
+import numpy as np
+import pandas as pd
+from rich.table import Table
+from rich.console import Console
+
+
+DISPLAY_MODES = ['auto', 'full', 'tail', 'summary', 'page']
+## 'auto' prints the full table up to this many rows and the tail above it
+AUTO_FULL_ROWS = 50
+DEFAULT_ROWS = 20
+
+## header: (value column, percentile column)
+COLUMNS = {
+    "Weight (Kg)": ('weight_kg', 'weight_percentile'),
+    "Height (cm)": ('height_cm', 'height_percentile'),
+    "Head Circumference (cm)": ('hc_cm', 'hc_percentile'),
+    "BMI": ('bmi', 'bmi_percentile'),
+}
+
+
+def _numbers(df: pd.DataFrame, col: str, fmt: str) -> np.ndarray:
+    """Format a numeric column with a printf-style format, '-' for missing values"""
+    if col not in df.columns:
+        return np.full(len(df), '-', dtype=object)
+    values = pd.to_numeric(df[col], errors='coerce').to_numpy(dtype='float64', na_value=np.nan)
+    out = np.char.mod(fmt, values).astype(object)
+    out[np.isnan(values)] = '-'
+    return out
+
+
+def format_rows(df: pd.DataFrame) -> pd.DataFrame:
+    """Return the display strings for each row, one column per table column"""
+    dates = pd.to_datetime(df['date']).dt.strftime('%Y-%m-%d').fillna('-') if 'date' in df.columns else '-'
+    out = pd.DataFrame({'Date': dates, 'Month': _numbers(df, 'months', '%.2f')}, index=df.index)
+    for header, (col, pcol) in COLUMNS.items():
+        value = _numbers(df, col, '%.2f')
+        pct = _numbers(df, pcol, '%.1f%%')
+        cell = value + ' (' + pct + ')'
+        cell[value == '-'] = '-'
+        out[header] = cell
+    return out
+
+
+def growth_table(df: pd.DataFrame, title: str = None) -> Table:
+    """The per-measurement table of the given rows"""
+    table = Table(title=title)
+    rows = format_rows(df)
+    for col in rows.columns:
+        table.add_column(col)
+    for row in rows.itertuples(index=False):
+        table.add_row(*row)
+    return table
+
+
+def summary_table(df: pd.DataFrame) -> Table:
+    """One line per metric: number of measurements, the latest value and percentile and the percentile range"""
+    table = Table(title=f"{len(df)} measurements")
+    for col in ["Metric", "Measurements", "Latest", "Latest percentile", "Percentile range"]:
+        table.add_column(col)
+    ordered = df.sort_values('months') if 'months' in df.columns else df
+    for header, (col, pcol) in COLUMNS.items():
+        if col not in ordered.columns:
+            continue
+        valid = ordered[pd.to_numeric(ordered[col], errors='coerce').notna()]
+        if valid.empty:
+            table.add_row(header, "0", "-", "-", "-")
+            continue
+        last = valid.iloc[[-1]]
+        pct = pd.to_numeric(valid.get(pcol), errors='coerce') if pcol in valid.columns else pd.Series(dtype=float)
+        pct_range = f"{pct.min():.1f}% - {pct.max():.1f}%" if pct.notna().any() else "-"
+        table.add_row(header, str(len(valid)), _numbers(last, col, '%.2f')[0], _numbers(last, pcol, '%.1f%%')[0], pct_range)
+    return table
+
+
+def print_growth(df: pd.DataFrame, console: Console = None,
+            mode: Literal['auto', 'full', 'tail', 'summary', 'page'] = 'auto', rows: int = DEFAULT_ROWS):
+    """Print the scored measurements.
+        auto:    full table for short histories, otherwise the tail
+        full:    every row
+        tail:    the latest `rows` rows
+        summary: one line per metric
+        page:    every row, through the console pager
+    """
+    console = console or Console()
+    if mode == 'auto':
+        mode = 'full' if len(df) <= AUTO_FULL_ROWS else 'tail'
+    if mode == 'summary':
+        console.print(summary_table(df))
+    elif mode == 'tail':
+        ordered = df.sort_values('date') if 'date' in df.columns else df
+        shown = ordered.tail(rows).iloc[::-1]  ## newest first, like the exports
+        console.print(growth_table(shown, title=f"Latest {len(shown)} of {len(df)} measurements"))
+    elif mode == 'page':
+        with console.pager():
+            console.print(growth_table(df))
+    elif mode == 'full':
+        console.print(growth_table(df))
+    else:
+        raise ValueError(f"Unknown display mode {mode}, choose from {DISPLAY_MODES}")
@@ -2,21 +2,26 @@ from pathlib import Path
 from typing import Dict, Tuple, Literal, Optional
 from dataclasses import dataclass
 from datetime import datetime
+import numpy as np
 import pandas as pd 
 from collections import defaultdict
 from src import logger
+from src.calculations import interpolate_lms_array, interpolate_lms_index
 
 
 
-def build_growth_database() -> Dict[str, Dict[str, Dict[Tuple[int, int], pd.DataFrame]]]:
+def build_growth_database(datapath: Path = Path('data')) -> Dict[str, Dict[str, Dict[Tuple[int, int], pd.DataFrame]]]:
     """Return a dictionary of tables. The keys gender, metric, and age range (int,int). 
     The values are pandas DataFrames, indexed by 'Month' and columns 'L',  'M', 'S', 'P1', 'P5', 'P10', 'P25', 'P50', 'P75', 'P90', 'P95', 'P99'
+    Weight-for-length/height tables (see LENGTH_INDEXED) are indexed by 'Length' or 'Height' in cm instead.
+    See `src.reference_store.shared_growth_database` for a memory-mapped copy shared across processes.
     """
     ## memory usage is approximately < 110 KB
-    datapath = Path('data')
+    datapath = Path(datapath)
     tables = defaultdict(lambda: defaultdict(dict))  ## gender: {metric: {age_range: file}}
     for file in datapath.glob('*.xlsx'):
-        df = pd.read_excel(file).set_index('Month')
+        df = pd.read_excel(file)
+        df = df.set_index(df.columns[0])  ## 'Month', or 'Length'/'Height' for LENGTH_INDEXED tables
         metric, gender, age_range, *_ = file.stem.split('.')
         min_age, max_age = map(int, age_range.split('_'))
         age_range = (min_age, max_age )
@@ -33,7 +38,7 @@ def build_growth_database() -> Dict[str, Dict[str, Dict[Tuple[int, int], pd.Data
     return tables
 
 def get_growth_table(tables: Dict[str, Dict[str, Dict[Tuple[int, int], pd.DataFrame]]],
-            metric: Literal['wfa','lhfa', 'hcfa', 'bmi'], gender: Literal['girls','boys'], age: int) -> pd.DataFrame:
+            metric: Literal['wfa','lhfa', 'hcfa', 'bmi', 'wfl', 'wfh'], gender: Literal['girls','boys'], age: int) -> pd.DataFrame:
     """Return the growth table for the given metric, gender, and age"""
     gender = gender.lower()
     if gender not in tables:
@@ -47,6 +52,60 @@ def get_growth_table(tables: Dict[str, Dict[str, Dict[Tuple[int, int], pd.DataFr
     raise ValueError(f"Age {age} not found in tables: {metric_tables.keys()}")
 
 
+def lms_for_months(tables: Dict[str, Dict[str, Dict[Tuple[int, int], pd.DataFrame]]],
+            metric: Literal['wfa','lhfa', 'hcfa', 'bmi'], gender: Literal['girls','boys'], months) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Return interpolated L, M, S arrays for an array of ages in months.
+    Each age is looked up in the table whose age range (in years) contains the age at measurement,
+    the first matching range wins on shared boundaries. Ages outside every range are NaN."""
+    gender = gender.lower()
+    if gender not in tables or metric not in tables[gender]:
+        raise ValueError(f"Metric {metric} for {gender} not found in tables")
+    months = np.asarray(months, dtype='float64')
+    L, M, S = (np.full(months.shape, np.nan) for _ in range(3))
+    todo = ~np.isnan(months)
+    for age_range, table in sorted(tables[gender][metric].items()):
+        mask = todo & (months >= age_range[0] * 12) & (months <= age_range[1] * 12)
+        if mask.any():
+            L[mask], M[mask], S[mask] = interpolate_lms_array(months[mask], table)
+            todo &= ~mask
+    return L, M, S
+
+
+## WHO indicators indexed by length/height (cm) instead of age: metric -> index column.
+## Weight-for-length covers 45-110 cm and is used under 2 years (recumbent length),
+## weight-for-height covers 65-120 cm and is used from 2 to 5 years (standing height).
+LENGTH_INDEXED = {
+    'wfl': 'Length',
+    'wfh': 'Height',
+}
+
+
+def lms_for_lengths(tables: Dict[str, Dict[str, Dict[Tuple[int, int], pd.DataFrame]]],
+            gender: Literal['girls','boys'], months, lengths) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Return weight-for-length/height L, M, S arrays.
+    The table (wfl or wfh) is chosen by the age at measurement, as in lms_for_months, and then
+    interpolated at the length/height with a binary search on its sorted index.
+    Rows without a matching table, or with a length outside the table, are NaN."""
+    gender = gender.lower()
+    months = np.asarray(months, dtype='float64')
+    lengths = np.asarray(lengths, dtype='float64')
+    L, M, S = (np.full(months.shape, np.nan) for _ in range(3))
+    todo = ~np.isnan(months) & ~np.isnan(lengths)
+    segments = [(age_range, table) for metric in LENGTH_INDEXED
+                for age_range, table in sorted(tables.get(gender, {}).get(metric, {}).items())]
+    for age_range, table in segments:
+        mask = todo & (months >= age_range[0] * 12) & (months <= age_range[1] * 12)
+        if mask.any():
+            L[mask], M[mask], S[mask] = interpolate_lms_index(lengths[mask], table)
+            todo &= ~mask
+    return L, M, S
+
+
+def has_length_indexed(tables: Dict[str, Dict[str, Dict[Tuple[int, int], pd.DataFrame]]], gender: str) -> bool:
+    """True when weight-for-length/height tables are loaded for the gender"""
+    return any(tables.get(gender.lower(), {}).get(metric) for metric in LENGTH_INDEXED)
+
+
 @dataclass
 class Child():
     """Child class with name and date of birth attributes and a method to calculate age in months
@@ -95,6 +154,11 @@ class Child():
             'boy': 'boys'
         }
         return gen[self.gender.lower()]
+
+    @property
+    def sex(self) -> str:
+        """'M' or 'F', as the command line takes it"""
+        return 'F' if self.gender == 'girls' else 'M'
     
 
 @dataclass
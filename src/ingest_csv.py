@@ -1,13 +1,30 @@
 # This file contains the parser for the huckleberry csv file
+import numpy as np
 import pandas as pd
+from scipy.stats import norm
 from src.unit_conversions import Weight, Length
 from pathlib import Path
 import re
-from src.database import Child, get_growth_table
-from src.calculations import ZscoreWeight, ZscoreHeight, interpolate_lms, calc_bmi
-from typing import Dict
+import csv
+from dataclasses import dataclass
+from src.database import Child, lms_for_lengths, has_length_indexed
+from src.calculations import calc_bmi, zscore_lms
+from src.lms_cache import lms_cache
+from typing import Dict, List, Optional, Sequence, Tuple
+from src import logger
 
 
+## metric name: (value column, WHO table, restricted +-3 SD tails as in ZscoreWeight)
+## 'wflh' is weight-for-length under 2 years and weight-for-height from 2 years, looked up
+## by height_cm instead of age (see src.database.LENGTH_INDEXED)
+METRICS = {
+    'weight': ('weight_kg', 'wfa', True),
+    'bmi': ('bmi', 'bmi', True),
+    'height': ('height_cm', 'lhfa', False),
+    'hc': ('hc_cm', 'hcfa', False),
+    'wflh': ('weight_kg', 'wflh', True),
+}
+
 
 def cleanup_weight(weight: str) -> float:
     """Cleans up the weight string and returns the weight in kg"""
@@ -44,119 +61,238 @@ def cleanup_length(height: str) -> float:
     else:
         raise ValueError(f'Invalid height: {height}: type: {type(height)}')
 
+## fields an export can provide and the column each one is converted to
+OUTPUT_COLUMNS = {
+    'weight': 'weight_kg',
+    'height': 'height_cm',
+    'hc': 'hc_cm',
+}
+## unit of a field whose values carry their own unit, e.g. '5.2kg' or '1.8ft.in'
+TEXT = 'text'
+## bytes read from the start of a file to detect its format
+SNIFF_BYTES = 4096
+
+
+@dataclass
+class InputFormat:
+    """The layout of a baby tracker or clinic csv export.
+
+    Args:
+        name (str): Registry name, e.g. for `main.py growth --format`.
+        columns (dict): Header in the file -> 'date', 'weight', 'height' or 'hc'.
+        units (dict): Field -> unit of its numbers ('kg', 'lbs', 'g', 'oz', 'cm', 'in', 'm', 'ft'),
+            or TEXT when each value carries its unit (parsed by cleanup_weight / cleanup_length).
+        date_format (str): Format passed to `pd.to_datetime`, so the format is not inferred per row.
+        required (list): Header columns that identify the format, by default all of `columns`.
+        any_of (list): Header columns of which the format needs at least one, e.g. the measurements
+            of an export that may leave some of them out.
+        row_filter (tuple): (column, value) of the rows with measurements, e.g. ('Type', 'Growth').
+    """
+    name: str
+    columns: Dict[str, str]
+    units: Dict[str, str]
+    date_format: Optional[str] = 'ISO8601'
+    required: Optional[List[str]] = None
+    any_of: Optional[List[str]] = None
+    row_filter: Optional[Tuple[str, str]] = None
+
+    def __post_init__(self):
+        if self.required is None:
+            self.required = list(self.columns)
+
+    def matches(self, header: Sequence[str]) -> bool:
+        header = {h.strip() for h in header}
+        return set(self.required) <= header and (not self.any_of or not header.isdisjoint(self.any_of))
+
+    def renames(self) -> Dict[str, str]:
+        """Header -> column name: TEXT fields keep the field name, numbers are converted in place"""
+        return {raw: OUTPUT_COLUMNS[field] if field in OUTPUT_COLUMNS and self.units.get(field) != TEXT else field
+                for raw, field in self.columns.items()}
+
+    def frame(self, df: pd.DataFrame) -> pd.DataFrame:
+        """Keep the measurement rows and the mapped columns of a loaded export and rename them"""
+        if self.row_filter is not None:
+            column, value = self.row_filter
+            df = df[df[column] == value]
+        df = df[[c for c in df.columns if c in self.columns]]
+        return df.rename(columns=self.renames()).dropna(axis=1, how='all')
+
+    def read(self, file_path) -> pd.DataFrame:
+        """Read the measurement rows of an export file (path or buffer)"""
+        return self.frame(pd.read_csv(file_path))
+
+    def parse(self, df: pd.DataFrame, child: Child) -> pd.DataFrame:
+        """Adds the dates, the age in months, the weight in kg, lengths in cm and the BMI, without scoring"""
+        df['date'] = parse_dates(df['date'], self.date_format)
+        for field, col in OUTPUT_COLUMNS.items():
+            unit = self.units.get(field)
+            if unit not in (None, TEXT) and col in df.columns:
+                df[col] = pd.to_numeric(df[col], errors='coerce') * unit_factor(field, unit)
+        df['months'] = ((df['date'] - child.dob).dt.days / 30).round(2)
+        for field, col in OUTPUT_COLUMNS.items():
+            if self.units.get(field) == TEXT:
+                cleanup = cleanup_weight if field == 'weight' else cleanup_length
+                df[col] = pd.to_numeric(df[field].apply(cleanup), errors='coerce') if field in df.columns else np.nan
+        if 'weight_kg' in df.columns and 'height_cm' in df.columns:
+            df['bmi'] = calc_bmi(df['weight_kg'], df['height_cm'])
+        else:
+            df['bmi'] = np.nan
+        return df
+
+
+FORMATS: Dict[str, InputFormat] = {}
+
+
+def register_format(fmt: InputFormat) -> InputFormat:
+    """Add an export format to the registry used by `sniff_format`"""
+    FORMATS[fmt.name] = fmt
+    return fmt
+
+
+register_format(InputFormat(
+    name='huckleberry',
+    columns={'Start': 'date', 'Start Condition': 'weight', 'Start Location': 'height', 'End Condition': 'hc'},
+    units={'weight': TEXT, 'height': TEXT, 'hc': TEXT},
+    required=['Type', 'Start', 'Start Condition', 'Start Location', 'End Condition'],
+    row_filter=('Type', 'Growth'),
+))
+register_format(InputFormat(
+    name='standard',
+    columns={'date': 'date', 'weight_kg': 'weight', 'height_cm': 'height', 'hc_cm': 'hc'},
+    units={'weight': 'kg', 'height': 'cm', 'hc': 'cm'},
+    required=['date'],
+    any_of=['weight_kg', 'height_cm', 'hc_cm'],
+))
+
+
+def unit_factor(field: str, unit: str) -> float:
+    """Factor from `unit` to kg (weight) or cm (lengths)"""
+    factor = Weight(1.0, unit).to_kilograms() if field == 'weight' else Length(1.0, unit).to_cm()
+    if factor is None:
+        raise ValueError(f"Unknown unit {unit} for {field}")
+    return factor
+
+
+def parse_dates(dates: pd.Series, date_format: Optional[str]) -> pd.Series:
+    """pd.to_datetime with the format of the export, inferring it only if the dates do not match"""
+    try:
+        return pd.to_datetime(dates, format=date_format)
+    except (ValueError, TypeError) as e:
+        logger.debug(f"Dates do not match {date_format} ({e}), inferring the format")
+        return pd.to_datetime(dates)
+
+
+def detect_format(header: Sequence[str]) -> InputFormat:
+    """The registered format matching a header; the most specific one if several do"""
+    candidates = [fmt for fmt in FORMATS.values() if fmt.matches(header)]
+    if not candidates:
+        raise ValueError(f"Unknown export format, header: {list(header)}. Known formats: {list(FORMATS)}")
+    return max(candidates, key=lambda fmt: len(fmt.required))
+
+
+def sniff_format(source, nbytes: int = SNIFF_BYTES) -> InputFormat:
+    """Detect the format of a csv file (path) or upload (bytes) from its header line only"""
+    if isinstance(source, (bytes, bytearray)):
+        head = bytes(source[:nbytes])
+    else:
+        with open(source, 'rb') as f:
+            head = f.read(nbytes)
+    first_line = head.decode('utf-8-sig', errors='replace').splitlines()[:1]
+    header = next(csv.reader(first_line), [])
+    return detect_format(header)
+
+
+def resolve_format(fmt, file_path=None) -> InputFormat:
+    """An InputFormat from a format, a registered name, or None / 'auto' to sniff `file_path`"""
+    if isinstance(fmt, InputFormat):
+        return fmt
+    if fmt is None or fmt == 'auto':
+        return sniff_format(file_path)
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown format {fmt}, choose from {list(FORMATS)}")
+    return FORMATS[fmt]
+
+
+def parse_export(file_path: Path, child: Child, fmt=None) -> pd.DataFrame:
+    """Read and parse an export without scoring it. The format is detected when not given"""
+    fmt = resolve_format(fmt, file_path)
+    return fmt.parse(fmt.read(file_path), child)
+
+
+def export_reader(file_path: Path, child: Child, growth_tables: dict, fmt=None) -> pd.DataFrame:
+    """Read, parse and score an export. The format is detected when not given"""
+    return percentile(parse_export(file_path, child, fmt), child, growth_tables)
+
+
 def process_huckleebery_df(df: pd.DataFrame, child: Child, growth_tables: Dict[str, Dict[str, Dict[str, pd.DataFrame]]]) -> pd.DataFrame:
     """Processes the huckleberry dataframe and returns a new dataframe with the weight, height, and head circumference 
     converted to kg, cm, and cm respectively"""
-    df['date'] = pd.to_datetime(df['date'])
-    df['months'] = df['date'].apply(lambda x: (x - child.dob).days / 30).round(2)
-    df['weight_kg'] = df['weight'].apply(cleanup_weight)#.round(2)
-    df['height_cm'] = df['height'].apply(cleanup_length)#.round(2)
-    df['hc_cm'] = df['hc'].apply(cleanup_length)#.round(2)
-    # df['bmi'] = df['weight_kg'] / ((df['height_cm'] / 100) ** 2)
-    df['bmi'] = df.apply(lambda row: calc_bmi(row['weight_kg'], row['height_cm']), axis=1)
-    df =  percentile(df, child, growth_tables)
-    return df
+    return percentile(parse_huckleberry_df(df, child), child, growth_tables)
+
+def parse_huckleberry_df(df: pd.DataFrame, child: Child) -> pd.DataFrame:
+    """The unit conversion, age and BMI of process_huckleebery_df, without the scoring"""
+    return FORMATS['huckleberry'].parse(df, child)
+
+def read_huckleberry_csv(file_path: Path) -> pd.DataFrame:
+    """Reads the growth rows of a huckleberry csv file, with the columns renamed to date, weight, height and hc"""
+    return FORMATS['huckleberry'].read(file_path)
 
 def huckleberry_reader(file_path: Path, child: Child, growth_tables: Dict[str, Dict[str, Dict[str, pd.DataFrame]]]) -> pd.DataFrame:
     """Reads the huckleberry csv file and returns a dataframe with the weight, height, and head circumference 
     converted to kg, cm, and cm respectively"""
-    df = (pd.read_csv(file_path)
-        .query('Type  == "Growth"')
-        .rename(columns={
-            'Start': 'date', 
-            'Start Condition': 'weight',
-            "Start Location": 'height',
-            'End Condition': 'hc'
-            })
-        .dropna(axis=1, how='all')
-        
-        )
-    
-    return process_huckleebery_df(df, child, growth_tables)
+    return export_reader(file_path, child, growth_tables, 'huckleberry')
+
 
+def read_standard_csv(file_path: Path) -> pd.DataFrame:
+    """Reads a standard csv file with the columns date, weight_kg, height_cm and hc_cm"""
+    return FORMATS['standard'].read(file_path)
+
+def process_standard_df(df: pd.DataFrame, child: Child, growth_tables: Dict[str, Dict[str, Dict[str, pd.DataFrame]]]) -> pd.DataFrame:
+    """Adds the age in months, BMI and the percentiles to a standard dataframe"""
+    return percentile(parse_standard_df(df, child), child, growth_tables)
+
+def parse_standard_df(df: pd.DataFrame, child: Child) -> pd.DataFrame:
+    """Adds the age in months and BMI to a standard dataframe, without the scoring"""
+    return FORMATS['standard'].parse(df, child)
 
 def standardize_reader(file_path: Path, child: Child, growth_tables: Dict[str, Dict[str, Dict[str, pd.DataFrame]]]) -> pd.DataFrame:
     """Reads the strandard csv file and returns a dataframe with the weight, height, and head circumference and there percentiles respectively"""
-    df = (pd.read_csv(file_path)
-        .dropna(axis=1, how='all')
-        )
-    df['date'] = pd.to_datetime(df['date'])
-    df['months'] = df['date'].apply(lambda x: (x - child.dob).days / 30).round(2)
-    # df['bmi'] = df['weight_kg'] / ((df['height_cm'] / 100) ** 2)
-    df['bmi'] = df.apply(lambda row: calc_bmi(row['weight_kg'], row['height_cm']), axis=1)
-    df = percentile(df, child, growth_tables)
-    return df
+    return export_reader(file_path, child, growth_tables, 'standard')
 
 
-def percentile(df: pd.DataFrame, child:Child, growth_tables: dict):
-    df['weight_percentile'] = df.apply(lambda row: weight_percentile(row, child, growth_tables), axis=1).fillna(0).round(1)
-    df['bmi_percentile'] = df.apply(lambda row: bmi_percentile(row, child, growth_tables), axis=1).fillna(0).round(1)
-    df['height_percentile'] = df.apply(lambda row: height_percentile(row, child, growth_tables), axis=1).fillna(0).round(1)
-    df['hc_percentile'] = df.apply(lambda row: hc_percentile(row, child, growth_tables), axis=1).fillna(0).round(1)
+def zscores(df: pd.DataFrame, child: Child, growth_tables: dict) -> pd.DataFrame:
+    """Adds the `<metric>_zscore` columns for weight, BMI, height and head circumference.
+    The reference table is chosen by the age at measurement. Missing or zero values,
+    and ages outside the WHO tables, give NaN. The age-indexed LMS come from `lms_cache`.
+    `wflh_zscore` (weight-for-length/height) is only added when those tables are loaded."""
+    months = df['months'].to_numpy(dtype='float64', na_value=np.nan)
+    for name, (col, metric, restricted) in METRICS.items():
+        if metric == 'wflh' and not has_length_indexed(growth_tables, child.gender):
+            continue
+        if col not in df.columns:
+            df[f'{name}_zscore'] = np.nan
+            continue
+        y = pd.to_numeric(df[col], errors='coerce').to_numpy(dtype='float64', na_value=np.nan)
+        y = np.where(y == 0, np.nan, y)
+        if metric == 'wflh':
+            if 'height_cm' not in df.columns:
+                df[f'{name}_zscore'] = np.nan
+                continue
+            lengths = pd.to_numeric(df['height_cm'], errors='coerce').to_numpy(dtype='float64', na_value=np.nan)
+            L, M, S = lms_for_lengths(growth_tables, child.gender, months, lengths)
+        else:
+            L, M, S = lms_cache.lms_array(growth_tables, metric, child.gender, months)
+        df[f'{name}_zscore'] = zscore_lms(L, M, S, y, restricted=restricted)
     return df
 
-def weight_percentile(row,  child:Child, growth_tables: dict):
-    if pd.isna(row['weight_kg']) or row['weight_kg'] == 0.0 or pd.isna(row['months']):
-        return pd.NA
-    else:
-        growth_table = get_growth_table(growth_tables, 'wfa', child.gender, child.age) 
-
-        try:
-            return ZscoreWeight(*interpolate_lms(row['months'], growth_table), row['weight_kg']).z_score_to_percentile()
-        except ZeroDivisionError:
-            print("Error: Division by zero")
-            return pd.NA
-        except ValueError:
-            print("Error: Invalid value")
-            return pd.NA
-
-def bmi_percentile(row,  child:Child, growth_tables: dict):
-    # print(row['bmi'])
-    if pd.isna(row['bmi']) or row['bmi'] == 0.0 or pd.isna(row['months']):
-        return pd.NA
-    else:
-        growth_table = get_growth_table(growth_tables, 'bmi', child.gender, child.age) 
-
-        try:
-            return ZscoreWeight(*interpolate_lms(row['months'], growth_table), row['bmi']).z_score_to_percentile()
-        except ZeroDivisionError:
-            print("Error: Division by zero")
-            return pd.NA
-        except ValueError:
-            print("Error: Invalid value")
-            return pd.NA
-        
-
-def height_percentile(row, child:Child, growth_tables: dict):
-    # print(row['bmi'])
-    if pd.isna(row['height_cm']) or row['height_cm'] == 0.0 or pd.isna(row['months']):
-        return pd.NA
-    else:
-        growth_table = get_growth_table(growth_tables, 'lhfa', child.gender, child.age) 
-
-        try:
-            return ZscoreHeight(*interpolate_lms(row['months'], growth_table), row['height_cm']).z_score_to_percentile()
-        except ZeroDivisionError:
-            print("Error: Division by zero")
-            return pd.NA
-        except ValueError:
-            print("Error: Invalid value")
-            return pd.NA
-        
 
-def hc_percentile(row, child:Child, growth_tables: dict):
-    # print(row['bmi'])
-    if pd.isna(row['hc_cm']) or row['hc_cm'] == 0.0 or pd.isna(row['months']):
-        return pd.NA
-    else:
-        growth_table = get_growth_table(growth_tables, 'hcfa', child.gender, child.age) 
-
-        try:
-            return ZscoreHeight(*interpolate_lms(row['months'], growth_table), row['hc_cm']).z_score_to_percentile()
-            # return ZscoreWeight(*interpolate_lms(row['months'], growth_table), row['hc_cm']).z_score_to_percentile()
-        except ZeroDivisionError:
-            print("Error: Division by zero")
-            return pd.NA
-        except ValueError:
-            print("Error: Invalid value")
-            return pd.NA
+def percentile(df: pd.DataFrame, child:Child, growth_tables: dict):
+    """Adds the child's `gender` ('M' or 'F') and the `<metric>_zscore` and `<metric>_percentile` columns.
+    Values that cannot be scored are left as NaN, use `src.validation.flag_plausibility` to flag them."""
+    df = zscores(df, child, growth_tables)
+    df['gender'] = child.sex  ## so the scored outputs of several children can be summarized together
+    for name in METRICS:
+        if f'{name}_zscore' not in df.columns:
+            continue
+        df[f'{name}_percentile'] = pd.Series(norm.cdf(df[f'{name}_zscore']) * 100, index=df.index).round(1)
+    return df
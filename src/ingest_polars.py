@@ -0,0 +1,170 @@
+# Optional Polars backend for the csv readers.
+#
+# Builds the read/filter/parse pipeline of an `InputFormat` (src.ingest_csv)
+# as a Polars lazy query: the csv scan, the row filter, unit parsing, dates, age and BMI run
+# multithreaded in Polars, with predicate pushdown into the scan. The result is converted to
+# pandas and scored with the same vectorized `percentile` as the pandas path, so both backends
+# give identical columns and identical z-scores (see src.conformance).
+## pip install polars
+import time
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import pandas as pd
+
+from src import logger
+from src.database import Child
+from src.ingest_csv import percentile, export_reader, parse_export, resolve_format, unit_factor, InputFormat, OUTPUT_COLUMNS, TEXT
+
+try:
+    import polars as pl
+except ImportError:  ## optional dependency
+    pl = None
+
+
+BACKENDS = ['pandas', 'polars']
+
+## unit: factor to kg / cm. Huckleberry writes lbs.oz and ft.in but the numbers are lbs and ft
+WEIGHT_UNITS = {'kg': 1.0, 'lbs.oz': 0.453592, 'lbs': 0.453592}
+LENGTH_UNITS = {'ft.in': 30.48, 'ft': 30.48, 'cm': 1.0, 'in': 2.54}
+
+
+def _require_polars():
+    if pl is None:
+        raise ImportError("The polars backend needs polars: pip install polars")
+
+
+def _alternatives(units: Dict[str, float]) -> str:
+    return '|'.join(u.replace('.', r'\.') for u in units)  ## longest units first, as in the regexes
+
+
+def _unit_value(col: str, units: Dict[str, float]) -> 'pl.Expr':
+    """Vectorized cleanup_weight / cleanup_length: '<number><unit>' -> number * factor, null otherwise"""
+    alternatives = _alternatives(units)
+    text = pl.col(col).cast(pl.Utf8)
+    unit = text.str.extract(rf'\d({alternatives})', 1)
+    number = text.str.extract(rf'^(.*?)\d?(?:{alternatives})', 0).str.replace(rf'(?:{alternatives})$', '')
+    factor = unit.replace_strict(list(units), list(units.values()), default=None, return_dtype=pl.Float64)
+    return number.str.strip_chars().cast(pl.Float64, strict=False) * factor
+
+
+def _unit_error(col: str, units: Dict[str, float], unitless_ok: bool) -> 'pl.Expr':
+    """The values cleanup_weight / cleanup_length raise a ValueError on: a number that does not
+    parse before the unit and, for lengths, a value without a unit. Weights without a unit are NaN"""
+    text = pl.col(col).cast(pl.Utf8)
+    bad = text.is_not_null() & (text.str.strip_chars() != '') & _unit_value(col, units).is_null()
+    if unitless_ok:
+        bad = bad & text.str.contains(rf'\d({_alternatives(units)})')
+    return bad
+
+
+def _months(child: Child) -> 'pl.Expr':
+    """Age in months as in the pandas readers: whole days since birth / 30"""
+    return ((pl.col('date') - pl.lit(child.dob)).dt.total_days() / 30).round(2)
+
+
+def _bmi() -> 'pl.Expr':
+    return pl.col('weight_kg') / (pl.col('height_cm') / 100) ** 2
+
+
+def _to_pandas(lf: 'pl.LazyFrame', derived: List[str], checks: Dict[str, str] = None) -> pd.DataFrame:
+    """Collect the query. `checks` maps boolean columns to the field they check: the first
+    failing one raises a ValueError with the offending values, as the pandas readers do"""
+    df = lf.collect()
+    for check, field in (checks or {}).items():
+        bad = df.filter(pl.col(check))[field]
+        if len(bad):
+            raise ValueError(f"Invalid {field}: {', '.join(map(repr, bad.head(5).to_list()))} ({len(bad)} rows)")
+    df = df.drop(list(checks or {}))
+    ## same as .dropna(axis=1, how='all') on the raw columns in the pandas readers, computed columns are kept
+    keep = [c for c in df.columns if c in derived or df[c].null_count() < df.height]
+    ## column by column through numpy, so pyarrow is not needed
+    return pd.DataFrame({c: df[c].to_numpy() for c in keep})
+
+
+def _dates(fmt: InputFormat) -> 'pl.Expr':
+    ## polars reads ISO 8601 without a format; other formats are given as strftime patterns
+    date_format = None if fmt.date_format == 'ISO8601' else fmt.date_format
+    return pl.col('date').str.to_datetime(date_format, strict=False)
+
+
+def frame_polars(file_path: Path, child: Child, fmt=None) -> pd.DataFrame:
+    """The lazy equivalent of InputFormat.read + InputFormat.parse"""
+    return _to_pandas(*_lazy_frame(file_path, child, fmt))
+
+
+def _lazy_frame(file_path: Path, child: Child, fmt=None) -> Tuple['pl.LazyFrame', List[str], Dict[str, str]]:
+    """The query of frame_polars, the columns computed by it and the checks of _to_pandas"""
+    _require_polars()
+    fmt = resolve_format(fmt, file_path)
+    lf = pl.scan_csv(file_path, infer_schema_length=0)  ## every column as text, parsed below
+    if fmt.row_filter is not None:
+        column, value = fmt.row_filter
+        lf = lf.filter(pl.col(column) == value)
+    ## only the columns the format maps are read, the scan skips the others
+    lf = lf.select([c for c in lf.collect_schema().names() if c in fmt.columns])
+    lf = lf.rename(fmt.renames(), strict=False).with_columns(_dates(fmt))
+    header = lf.collect_schema().names()
+    numbers, texts, checks = [], {}, {}
+    for field, col in OUTPUT_COLUMNS.items():
+        unit = fmt.units.get(field)
+        if unit == TEXT:
+            units = WEIGHT_UNITS if field == 'weight' else LENGTH_UNITS
+            texts[col] = _unit_value(field, units) if field in header else pl.lit(None, dtype=pl.Float64)
+            if field in header:
+                checks[f'_invalid_{field}'] = field
+        elif unit is not None and col in header:
+            numbers.append(pl.col(col).cast(pl.Float64, strict=False) * unit_factor(field, unit))
+    if numbers:
+        lf = lf.with_columns(*numbers)
+    lf = lf.with_columns(months=_months(child))
+    if texts:
+        lf = lf.with_columns(**texts, **{check: _unit_error(field, WEIGHT_UNITS if field == 'weight' else LENGTH_UNITS,
+                                                            unitless_ok=field == 'weight') for check, field in checks.items()})
+    header = lf.collect_schema().names()
+    lf = lf.with_columns(bmi=_bmi() if 'weight_kg' in header and 'height_cm' in header else pl.lit(None, dtype=pl.Float64))
+    return lf, ['months', 'bmi', *texts], checks
+
+
+def reader_polars(file_path: Path, child: Child, growth_tables: dict, fmt=None) -> pd.DataFrame:
+    """export_reader on the polars backend"""
+    return percentile(frame_polars(file_path, child, fmt), child, growth_tables)
+
+
+def get_reader(backend: str, fmt=None):
+    """Return reader(file_path, child, growth_tables) for the backend ('pandas' or 'polars').
+    `fmt` is a format name or InputFormat, None to detect the format of each file"""
+    if backend == 'pandas':
+        return lambda file_path, child, growth_tables: export_reader(file_path, child, growth_tables, fmt)
+    if backend == 'polars':
+        _require_polars()
+        return lambda file_path, child, growth_tables: reader_polars(file_path, child, growth_tables, fmt)
+    raise ValueError(f"Unknown backend {backend}, choose from {BACKENDS}")
+
+
+def get_parser(backend: str, fmt=None):
+    """Like get_reader, but the returned function(file_path, child) does not score the rows"""
+    if backend == 'pandas':
+        return lambda file_path, child: parse_export(file_path, child, fmt)
+    if backend == 'polars':
+        _require_polars()
+        return lambda file_path, child: frame_polars(file_path, child, fmt)
+    raise ValueError(f"Unknown backend {backend}, choose from {BACKENDS}")
+
+
+def benchmark_backends(file_path: Path, child: Child, growth_tables: dict, fmt=None,
+            repeat: int = 3) -> Dict[str, float]:
+    """Best wall time in seconds of each available backend on the file"""
+    timings = {}
+    for backend in BACKENDS:
+        if backend == 'polars' and pl is None:
+            logger.warning("polars is not installed, skipping it in the benchmark")
+            continue
+        reader = get_reader(backend, fmt)
+        best = float('inf')
+        for _ in range(repeat):
+            start = time.perf_counter()
+            reader(file_path, child, growth_tables)
+            best = min(best, time.perf_counter() - start)
+        timings[backend] = best
+    return timings
@@ -0,0 +1,263 @@
+# Local background jobs for scoring uploads outside the web workers.
+#
+# Jobs live in a SQLite table next to their input and result files, so any web worker
+# (or a restarted one) can enqueue, poll and fetch them. They run in a process pool that
+# loads the shared reference store once per process, and are scored in chunks so the
+# progress can be reported while they run. A job is keyed by the hash of the upload, the
+# child's DOB and gender, the reference version and the code version: the same upload is
+# only scored once until the tables or the scoring code change.
+import io
+import os
+import time
+import sqlite3
+import hashlib
+from pathlib import Path
+from contextlib import contextmanager
+from dataclasses import dataclass
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional
+
+import pandas as pd
+
+from src import logger
+from src.database import Child
+from src.ingest_csv import percentile, detect_format
+from src.result_cache import code_version
+from src.reference_store import shared_growth_database, store_version
+
+
+JOB_DIR = '.jobs'
+CHUNK_ROWS = 5000
+## finished jobs whose result file is older than this are removed by `cleanup`
+MAX_AGE_SECONDS = 7 * 24 * 3600
+## `maybe_cleanup` runs `cleanup` at most this often
+CLEANUP_INTERVAL_SECONDS = 3600
+## a queued or running job without progress for this long was lost with its process, it is run again on resubmit
+STALE_SECONDS = 600
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    filename TEXT,
+    dob TEXT,
+    gender TEXT,
+    status TEXT,
+    done_rows INTEGER DEFAULT 0,
+    total_rows INTEGER DEFAULT 0,
+    message TEXT DEFAULT '',
+    created REAL,
+    updated REAL
+)
+"""
+QUEUED, RUNNING, DONE, FAILED = 'queued', 'running', 'done', 'failed'
+
+## insert a new job or take over one that is not reusable: failed, done without its result
+## file, or queued/running without progress for STALE_SECONDS. No row is written otherwise
+CLAIM = """
+INSERT INTO jobs (id, filename, dob, gender, status, done_rows, total_rows, message, created, updated)
+VALUES (?, ?, ?, ?, ?, 0, 0, '', ?, ?)
+ON CONFLICT(id) DO UPDATE SET
+    filename = excluded.filename, status = excluded.status, done_rows = 0, total_rows = 0,
+    message = '', created = excluded.created, updated = excluded.updated
+WHERE (jobs.status = ? AND ?) OR jobs.status = ? OR (jobs.status IN (?, ?) AND jobs.updated < ?)
+"""
+
+
+@dataclass
+class Job:
+    id: str
+    filename: str
+    dob: str
+    gender: str
+    status: str
+    done_rows: int
+    total_rows: int
+    message: str
+    created: float
+    updated: float
+
+    @property
+    def progress(self) -> float:
+        """Fraction of the rows scored, 1.0 when done"""
+        if self.status == DONE:
+            return 1.0
+        return self.done_rows / self.total_rows if self.total_rows else 0.0
+
+    @property
+    def finished(self) -> bool:
+        return self.status in (DONE, FAILED)
+
+
+def job_key(data: bytes, dob: str, gender: str, file_format: str = 'auto') -> str:
+    """Content hash of the upload, its format, the child parameters the scores depend on
+    and the versions of the reference tables and the scoring code"""
+    digest = hashlib.sha256(data)
+    digest.update(f'|{dob}|{gender}|{file_format}|{store_version()}|{code_version()}'.encode())
+    return digest.hexdigest()
+
+
+## leading bytes of excel files: xlsx (zip) and xls (OLE2)
+EXCEL_MAGIC = (b'PK\x03\x04', b'\xd0\xcf\x11\xe0')
+
+
+def read_upload(data: bytes, file_format: str = 'auto') -> pd.DataFrame:
+    """Read an uploaded csv or excel file. 'auto' tells them apart by their first bytes, not the file name"""
+    if file_format == 'excel' or (file_format == 'auto' and data.startswith(EXCEL_MAGIC)):
+        return pd.read_excel(io.BytesIO(data))
+    return pd.read_csv(io.StringIO(data.decode('utf-8-sig')))
+
+
+def parse_upload(df: pd.DataFrame, child: Child) -> pd.DataFrame:
+    """Parse an uploaded export of any registered format, without scoring it"""
+    fmt = detect_format([str(c) for c in df.columns])
+    return fmt.parse(fmt.frame(df), child)
+
+
+@contextmanager
+def _connect(db_path: Path):
+    con = sqlite3.connect(db_path, timeout=30)
+    try:
+        con.execute('PRAGMA journal_mode=WAL')  ## readers do not block the workers' progress updates
+        con.execute(SCHEMA)
+        with con:  ## commit
+            yield con
+    finally:
+        con.close()
+
+
+def _update(db_path: Path, job_id: str, **fields):
+    fields['updated'] = time.time()
+    with _connect(db_path) as con:
+        con.execute(f"UPDATE jobs SET {', '.join(f'{k} = ?' for k in fields)} WHERE id = ?",
+                    [*fields.values(), job_id])
+
+
+_TABLES = None
+
+
+def _init_worker():
+    ## once per process; the store is memory-mapped so the pages are shared between workers
+    global _TABLES
+    _TABLES = shared_growth_database()
+
+
+def run_job(root: Path, job_id: str, file_format: str = 'auto', chunk_rows: int = CHUNK_ROWS):
+    """Score one queued job, writing the progress after every chunk of rows"""
+    root = Path(root)
+    db_path = root / 'jobs.sqlite'
+    tables = _TABLES if _TABLES is not None else shared_growth_database()
+    with _connect(db_path) as con:
+        filename, dob, gender = con.execute('SELECT filename, dob, gender FROM jobs WHERE id = ?', [job_id]).fetchone()
+    _update(db_path, job_id, status=RUNNING)
+    try:
+        child = Child('child', gender, dob)
+        df = parse_upload(read_upload((root / f'{job_id}.input').read_bytes(), file_format), child)
+        df = df.reset_index(drop=True)
+        _update(db_path, job_id, total_rows=len(df))
+        chunks = []
+        for start in range(0, len(df), chunk_rows):
+            chunks.append(percentile(df.iloc[start:start + chunk_rows].copy(), child, tables))
+            _update(db_path, job_id, done_rows=min(start + chunk_rows, len(df)))
+        result = pd.concat(chunks, ignore_index=True) if chunks else df
+        tmp = root / f'{job_id}.result.tmp'
+        result.to_pickle(tmp)
+        tmp.replace(root / f'{job_id}.result.pkl')
+        _update(db_path, job_id, status=DONE, done_rows=len(df))
+    except Exception as e:
+        logger.error(f"Job {job_id[:12]} ({filename}) failed: {e}")
+        _update(db_path, job_id, status=FAILED, message=f'{type(e).__name__}: {e}')
+
+
+class JobQueue:
+    """Queue of upload scoring jobs, run by a process pool.
+
+    Args:
+        root (Path): Directory of the job table and the input and result files.
+        max_workers (int): Processes scoring jobs, by default one per cpu.
+        chunk_rows (int): Rows scored between two progress updates.
+    """
+    def __init__(self, root: Path = JOB_DIR, max_workers: int = None, chunk_rows: int = CHUNK_ROWS):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.db_path = self.root / 'jobs.sqlite'
+        self.chunk_rows = chunk_rows
+        self.max_workers = max_workers or os.cpu_count()
+        self._pool = None
+        self._cleaned = 0.0
+
+    @property
+    def pool(self) -> ProcessPoolExecutor:
+        ## started on first use, so importing the dashboard does not fork
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(self.max_workers, initializer=_init_worker)
+        return self._pool
+
+    def submit(self, data: bytes, filename: str, dob: str, gender: str, file_format: str = 'auto') -> str:
+        """Enqueue an upload and return its job id. An upload already scored, or being
+        scored, for the same child is not run again"""
+        job_id = job_key(data, dob, gender, file_format)
+        result_missing = not self._result_file(job_id).exists()
+        now = time.time()
+        ## claim the job in one statement, so of two simultaneous uploads only one enqueues it
+        with _connect(self.db_path) as con:
+            claimed = con.execute(CLAIM, [job_id, filename, dob, gender, QUEUED, now, now,
+                                          DONE, result_missing, FAILED, QUEUED, RUNNING, now - STALE_SECONDS]).rowcount
+        if not claimed:
+            logger.debug(f"{filename}: job {job_id[:12]} is {self.job(job_id).status}, not run again")
+            return job_id
+        tmp = self.root / f'{job_id}.input.{os.getpid()}.tmp'
+        tmp.write_bytes(data)
+        os.replace(tmp, self.root / f'{job_id}.input')
+        self.pool.submit(run_job, self.root, job_id, file_format, self.chunk_rows)
+        return job_id
+
+    def job(self, job_id: str) -> Optional[Job]:
+        with _connect(self.db_path) as con:
+            row = con.execute('SELECT * FROM jobs WHERE id = ?', [job_id]).fetchone()
+        return Job(*row) if row else None
+
+    def jobs(self, job_ids: List[str]) -> List[Job]:
+        """The jobs in the order of `job_ids`, unknown ids are skipped"""
+        jobs = (self.job(job_id) for job_id in job_ids)
+        return [job for job in jobs if job is not None]
+
+    def _result_file(self, job_id: str) -> Path:
+        return self.root / f'{job_id}.result.pkl'
+
+    def result(self, job_id: str) -> pd.DataFrame:
+        """The scored rows of a finished job"""
+        return pd.read_pickle(self._result_file(job_id))
+
+    def wait(self, job_ids: List[str], timeout: float = None, interval: float = 0.1) -> List[Job]:
+        """Block until the jobs are finished, for scripts and tests"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            jobs = self.jobs(job_ids)
+            if all(job.finished for job in jobs):
+                return jobs
+            if deadline is not None and time.monotonic() > deadline:
+                raise TimeoutError(f"Jobs not finished after {timeout}s")
+            time.sleep(interval)
+
+    def cleanup(self, max_age: float = MAX_AGE_SECONDS):
+        """Remove finished jobs, and their files, not updated for `max_age` seconds"""
+        self._cleaned = time.time()
+        cutoff = self._cleaned - max_age
+        with _connect(self.db_path) as con:
+            old = [r[0] for r in con.execute('SELECT id FROM jobs WHERE updated < ? AND status IN (?, ?)', [cutoff, DONE, FAILED])]
+            con.executemany('DELETE FROM jobs WHERE id = ?', [[job_id] for job_id in old])
+        for job_id in old:
+            for suffix in ('.input', '.result.pkl'):
+                (self.root / f'{job_id}{suffix}').unlink(missing_ok=True)
+        if old:
+            logger.info(f"Removed {len(old)} jobs older than {max_age / 3600:.0f}h from {self.root}")
+
+    def maybe_cleanup(self, interval: float = CLEANUP_INTERVAL_SECONDS):
+        """`cleanup` if it did not run in the last `interval` seconds, cheap enough to call on every poll"""
+        if time.time() - self._cleaned >= interval:
+            self.cleanup()
+
+    def shutdown(self, wait: bool = True):
+        if self._pool is not None:
+            self._pool.shutdown(wait=wait)
+            self._pool = None
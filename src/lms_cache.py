@@ -0,0 +1,176 @@
+# Bounded, thread-safe LRU memo of single-point LMS lookups.
+#
+# Interactive paths (dashboard, single-child CLI runs, API calls) ask for the same
+# (metric, gender, age) again and again. A hit here is one dict lookup instead of a
+# table selection and a pandas interpolation. `zscores` scores through the process-wide
+# `lms_cache` with `lms_array`, so the dashboard, the CLI, the watcher, the jobs and the
+# pipeline all share it. Keys include the reference version, so entries computed from
+# other tables are never returned; `clear` drops everything when tables of another version
+# are loaded.
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Tuple
+
+import numpy as np
+import pandas as pd
+from scipy.stats import norm
+
+from src.database import lms_for_months
+from src.calculations import ZscoreWeight, ZscoreHeight
+from src.reference_store import reference_version, on_reload
+
+
+## room for every age of the 0-5 year tables at 0.01 month steps, for a few metrics and both sexes
+DEFAULT_MAXSIZE = 65536
+## versions remembered per tables object; older tables objects are released
+MAX_TABLE_VERSIONS = 8
+## `lms_array` looks up at most this many distinct ages in the cache; a dict lookup costs
+## more per age than the vectorized interpolation, so larger batches only interpolate
+## their distinct ages, once each
+MAX_CACHED_AGES = 64
+## ages are quantized to this many months; the ingest path rounds months to 2 decimals too
+DEFAULT_RESOLUTION = 0.01
+
+## metrics whose +-3 SD tails are restricted (ZscoreWeight), the others use ZscoreHeight
+RESTRICTED = {'wfa', 'bmi'}
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    size: int = 0
+    maxsize: int = DEFAULT_MAXSIZE
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+class LMSCache:
+    """LRU cache of interpolated (L, M, S) keyed by (reference version, metric, gender, quantized age).
+
+    Args:
+        maxsize (int): Maximum number of entries, the least recently used entry is evicted.
+        resolution (float): Ages are rounded to a multiple of this (months) before the lookup.
+    """
+    def __init__(self, maxsize: int = DEFAULT_MAXSIZE, resolution: float = DEFAULT_RESOLUTION):
+        if maxsize < 1:
+            raise ValueError(f"maxsize must be at least 1: {maxsize}")
+        self.maxsize = maxsize
+        self.resolution = resolution
+        self._entries: OrderedDict = OrderedDict()
+        self._versions: OrderedDict = OrderedDict()  ## id(tables) -> (tables, version), at most MAX_TABLE_VERSIONS
+        self._lock = threading.Lock()
+        self._hits = self._misses = self._evictions = 0
+
+    def _version(self, tables: dict) -> str:
+        ## hashing the tables costs far more than a lookup, so remember it per tables object.
+        ## The tables are kept referenced so their id cannot be reused by another object,
+        ## and only the most recently used ones, so reloaded tables are not kept alive.
+        entry = self._versions.get(id(tables))
+        if entry is None or entry[0] is not tables:
+            entry = (tables, reference_version(tables))
+            self._versions[id(tables)] = entry
+        self._versions.move_to_end(id(tables))
+        while len(self._versions) > MAX_TABLE_VERSIONS:
+            self._versions.popitem(last=False)
+        return entry[1]
+
+    def _store(self, key: tuple, value: tuple):
+        ## called with the lock held
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self._evictions += 1
+
+    def quantize(self, ages) -> np.ndarray:
+        """Ages rounded to a multiple of `resolution`, the cache key of `lms` and `lms_array`.
+        Ages already at the resolution (the ingest path rounds months to 2 decimals) are unchanged"""
+        return np.round(np.round(np.asarray(ages, dtype='float64') / self.resolution) * self.resolution, 6)
+
+    def lms(self, tables: dict, metric: str, gender: str, age: float) -> Tuple[float, float, float]:
+        """Return (L, M, S) for the age in months, NaN outside the reference tables"""
+        age = float(self.quantize(age))
+        gender = gender.lower()
+        with self._lock:
+            key = (self._version(tables), metric, gender, age)
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+                self._hits += 1
+                return value
+            self._misses += 1
+        L, M, S = lms_for_months(tables, metric, gender, [age])
+        value = (float(L[0]), float(M[0]), float(S[0]))
+        with self._lock:
+            self._store(key, value)
+        return value
+
+    def lms_array(self, tables: dict, metric: str, gender: str, months) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """`lms_for_months` over the distinct quantized ages only, keyed like `lms`. Up to
+        `MAX_CACHED_AGES` distinct ages are looked up in the cache and the misses interpolated
+        together. Hits and misses are counted per distinct age"""
+        months = self.quantize(months)
+        gender = gender.lower()
+        codes, ages = pd.factorize(months.ravel())  ## NaN gets code -1
+        values = np.full((len(ages) + 1, 3), np.nan)  ## the last row is picked by code -1
+        if len(ages) > MAX_CACHED_AGES:
+            if 2 * len(ages) > months.size:  ## mostly distinct, nothing to save
+                return lms_for_months(tables, metric, gender, months)
+            values[:-1] = np.column_stack(lms_for_months(tables, metric, gender, ages))
+            out = values[codes].reshape(months.shape + (3,))
+            return out[..., 0], out[..., 1], out[..., 2]
+        with self._lock:
+            version = self._version(tables)
+            missing, keys = [], ages.tolist()
+            for i, age in enumerate(keys):
+                key = (version, metric, gender, age)
+                value = self._entries.get(key)
+                if value is None:
+                    missing.append(i)
+                else:
+                    self._entries.move_to_end(key)
+                    values[i] = value
+            self._hits += len(ages) - len(missing)
+            self._misses += len(missing)
+        if missing:
+            L, M, S = lms_for_months(tables, metric, gender, ages[missing])
+            values[missing] = np.column_stack([L, M, S])
+            with self._lock:
+                for i, value in zip(missing, zip(L.tolist(), M.tolist(), S.tolist())):
+                    self._store((version, metric, gender, keys[i]), value)
+        out = values[codes].reshape(months.shape + (3,))
+        return out[..., 0], out[..., 1], out[..., 2]
+
+    def zscore(self, tables: dict, metric: str, gender: str, age: float, value: float) -> float:
+        """Return the z-score of a single measurement using the cached LMS.
+        Raises ValueError, like ZscoreWeight, when the age is outside the reference tables"""
+        L, M, S = self.lms(tables, metric, gender, age)
+        zscore_cls = ZscoreWeight if metric in RESTRICTED else ZscoreHeight
+        return zscore_cls(L, M, S, value).zscore()
+
+    def percentile(self, tables: dict, metric: str, gender: str, age: float, value: float) -> float:
+        """Return the percentile of a single measurement using the cached LMS"""
+        return norm.cdf(self.zscore(tables, metric, gender, age, value)) * 100
+
+    def clear(self):
+        """Drop all entries and remembered versions, e.g. after the reference tables were reloaded.
+        The statistics are kept."""
+        with self._lock:
+            self._entries.clear()
+            self._versions.clear()
+
+    @property
+    def stats(self) -> CacheStats:
+        with self._lock:
+            return CacheStats(self._hits, self._misses, self._evictions, len(self._entries), self.maxsize)
+
+
+## process-wide cache used by `zscores`, cleared when tables of another reference version are loaded
+lms_cache = LMSCache()
+on_reload(lms_cache.clear)
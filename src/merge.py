@@ -0,0 +1,160 @@
+# Merge measurements of the same child from several sources (huckleberry exports,
+# clinic csv files, scales) and collapse the near-duplicates before scoring.
+#
+# The combined frame is sorted once by child and date. A group starts at a measurement and
+# takes the following measurements of the same child no more than `window` after it, so a
+# group never spans more than `window` (a dense series is not chained into one group). Each
+# group becomes one measurement: per metric, the value of the preferred source that has one
+# ('priority') or the median of the values ('median'). Everything is numpy sorts and
+# per-group reductions, no python loops over the rows.
+from pathlib import Path
+from typing import Dict, List, Literal, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+
+from src import logger
+from src.database import Child
+from src.calculations import calc_bmi
+from src.ingest_csv import percentile
+from src.ingest_polars import get_reader, get_parser
+from src.validation import flag_plausibility
+
+
+MERGE_STRATEGIES = ['priority', 'median']
+DEFAULT_WINDOW = '1h'
+MERGED_METRICS = ['weight_kg', 'height_cm', 'hc_cm']
+
+
+def combine_sources(frames: Dict[str, pd.DataFrame], source_col: str = 'source') -> pd.DataFrame:
+    """Concatenate parsed frames, {source name: frame}, tagging each row with its source.
+    The order of the dict is the priority order used by `merge_measurements`"""
+    tagged = [df.assign(**{source_col: name}) for name, df in frames.items()]
+    return pd.concat(tagged, ignore_index=True) if tagged else pd.DataFrame()
+
+
+def merge_groups(df: pd.DataFrame, window: pd.Timedelta, child_col: Optional[str] = 'child') -> np.ndarray:
+    """Group id of every row of `df`, which must be sorted by child and date.
+    A group starts at a row and holds the following rows up to `window` after it"""
+    dates = pd.to_datetime(df['date']).to_numpy(dtype='datetime64[ns]')
+    new_group = np.ones(len(df), dtype=bool)
+    if len(df) > 1:
+        new_group[1:] = (np.diff(dates) > np.timedelta64(window.value, 'ns')) | np.isnat(dates[1:]) | np.isnat(dates[:-1])
+        if child_col is not None and child_col in df.columns:
+            children = df[child_col].to_numpy()
+            new_group[1:] |= children[1:] != children[:-1]
+    ## runs of rows each within `window` of the previous one are split where a row is more
+    ## than `window` after the first row of its group
+    run_start = np.flatnonzero(new_group)
+    run_end = np.repeat(np.r_[run_start[1:], len(df)], np.diff(np.r_[run_start, len(df)]))
+    ns = dates.view('int64')
+    ## nxt: the first row of the run more than `window` after each row, found by advancing
+    ## all rows together, as many steps as there are rows within `window` of one another
+    nxt = np.arange(1, len(df) + 1)
+    active = np.flatnonzero(nxt < run_end)
+    while len(active):
+        active = active[ns[nxt[active]] - ns[active] <= window.value]
+        nxt[active] += 1
+        active = active[nxt[active] < run_end[active]]
+    ## follow nxt from the start of every run, all runs at once, one group per step
+    first = run_start
+    while len(first):
+        first = nxt[first][nxt[first] < run_end[first]]
+        new_group[first] = True
+    return np.cumsum(new_group) - 1
+
+
+def merge_measurements(df: pd.DataFrame, window: str = DEFAULT_WINDOW,
+            strategy: Literal['priority', 'median'] = 'priority', priority: List[str] = None,
+            child_col: Optional[str] = 'child', source_col: str = 'source',
+            metrics: List[str] = MERGED_METRICS) -> pd.DataFrame:
+    """Collapse the measurements of a child taken within `window` of each other into one.
+
+    Args:
+        df (pd.DataFrame): Parsed measurements with a `date` column and the metric columns,
+            e.g. from `combine_sources`.
+        window (str): Measurements no more than this after the first of a group (pandas Timedelta
+            string) are duplicates, a group never spans more than `window`.
+        strategy (str): 'priority' takes, per metric, the value of the first source in `priority`
+            that has one; 'median' takes the median of the values.
+        priority (List[str]): Source names, preferred first. Defaults to the order the sources
+            appear in `df`. Unknown sources come last.
+        child_col (str): Column identifying the child, if the frame holds several children.
+        source_col (str): Column with the source name of each row.
+
+    Returns:
+        pd.DataFrame: One row per measurement with `date`, the metrics, `source` (the preferred
+            source of the group) and `merged_rows` (how many rows were collapsed), sorted newest
+            first like the exports. Scores are not carried over, score the result.
+    """
+    if strategy not in MERGE_STRATEGIES:
+        raise ValueError(f"Unknown merge strategy {strategy}, choose from {MERGE_STRATEGIES}")
+    window = pd.Timedelta(window)
+    if child_col is not None and child_col not in df.columns:
+        child_col = None
+    metrics = [m for m in metrics if m in df.columns]
+
+    dates = pd.to_datetime(df['date'])
+    sources = (df[source_col] if source_col in df.columns else pd.Series('unknown', index=df.index)).astype(str)
+    priority = priority or list(pd.unique(sources))
+    rank = sources.map({name: i for i, name in enumerate(priority)}).fillna(len(priority)).to_numpy(dtype='int64')
+    date_ns = dates.to_numpy(dtype='datetime64[ns]')
+    date_ns = np.where(np.isnat(date_ns), np.iinfo('int64').max, date_ns.view('int64'))  ## NaT last
+    child_code = pd.factorize(df[child_col])[0] if child_col else np.zeros(len(df), dtype='int64')
+
+    ## one sort for the grouping: child, date, then the preferred source first for equal dates
+    order = np.lexsort((rank, date_ns, child_code))
+    df = df.iloc[order].reset_index(drop=True)
+    df['date'] = dates.iloc[order].to_numpy()
+    group = merge_groups(df, window, child_col)
+
+    ## within each group the preferred source first: it gives the date and the source
+    order = np.lexsort((date_ns[order], rank[order], group))
+    group = group[order]
+    df = df.iloc[order].reset_index(drop=True)
+    first = np.flatnonzero(np.r_[True, group[1:] != group[:-1]])
+    merged = df.iloc[first][[c for c in [child_col, 'date', source_col] if c in df.columns]].reset_index(drop=True)
+    if source_col not in merged.columns:
+        merged[source_col] = 'unknown'
+    merged['merged_rows'] = np.diff(np.r_[first, len(df)])
+    for col in metrics:
+        values = pd.to_numeric(df[col], errors='coerce').to_numpy(dtype='float64', na_value=np.nan)
+        values = np.where(values == 0, np.nan, values)  ## 0 means not measured in the exports
+        if strategy == 'priority':
+            ## first value in priority order: the first valid row of each group
+            valid = np.flatnonzero(~np.isnan(values))
+            groups, at = np.unique(group[valid], return_index=True)
+            out = np.full(len(first), np.nan)
+            out[groups] = values[valid[at]]
+            merged[col] = out
+        else:
+            merged[col] = pd.Series(values).groupby(group).median().to_numpy()
+
+    merged = merged.sort_values('date', ascending=False, kind='stable').reset_index(drop=True)
+    dropped = len(df) - len(merged)
+    if dropped:
+        logger.info(f"Merged {len(df)} measurements into {len(merged)}, {dropped} duplicates within {window}")
+    return merged
+
+
+def add_age_and_bmi(df: pd.DataFrame, child: Child) -> pd.DataFrame:
+    """Recompute `months` and `bmi` of merged measurements, as the readers do"""
+    df['months'] = ((df['date'] - child.dob).dt.days / 30).round(2)
+    if 'weight_kg' in df.columns and 'height_cm' in df.columns:
+        df['bmi'] = calc_bmi(df['weight_kg'], df['height_cm'])
+    return df
+
+
+def score_exports(files: Sequence[Path], child: Child, growth_tables: dict, input_format: str = 'auto',
+                  backend: str = 'pandas', window: str = DEFAULT_WINDOW, strategy: str = 'priority') -> pd.DataFrame:
+    """The scored rows `growth` writes and caches: one export scored as is, or several
+    exports merged first, preferred source first. Flagged and rounded to 2 decimals"""
+    if len(files) > 1:
+        ## parse every source, drop the duplicates and only score the unique measurements
+        parser = get_parser(backend, input_format)
+        combined = combine_sources({str(f): parser(f, child) for f in files})
+        merged = merge_measurements(combined, window=window, strategy=strategy)
+        df = percentile(add_age_and_bmi(merged, child), child, growth_tables)
+    else:
+        df = get_reader(backend, input_format)(files[0], child, growth_tables)
+    return flag_plausibility(df).round(2)
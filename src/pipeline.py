@@ -0,0 +1,288 @@
+# Pipelined ingest of a directory of exports.
+#
+# Reading, scoring and writing / charting run as stages connected by bounded queues:
+#   reader threads  -> parse queue -> scoring threads -> write queue -> writer threads
+# so disk reads, numpy scoring and html rendering overlap instead of running one file at a
+# time. A full queue blocks the stage that feeds it (backpressure), which bounds the number
+# of frames held in memory. Each stage records how busy it was and each queue how deep it
+# got, to show which stage limits the throughput.
+# Reading is I/O and runs in threads. Scoring and rendering hold the GIL for much of their
+# time, so with `processes` set their threads hand the work to a process pool and wait,
+# and the stages keep the same queues and backpressure.
+# With `site` set the writers add every child to a static report site (src.report_site)
+# instead of rendering a self-contained html chart per file.
+import time
+import queue
+import threading
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from typing import Callable, List, Optional
+
+import pandas as pd
+
+from src import logger
+from src.database import Child
+from src.ingest_csv import percentile, resolve_format
+from src.validation import flag_plausibility
+from src.plot import plot_subplot_growth_percentiles
+from src.reference_store import shared_growth_database
+from src.report_site import ReportSite, child_ids
+from src.watcher import ChildConfig, match_child
+
+
+DEFAULT_READERS = 2
+DEFAULT_SCORERS = 2
+DEFAULT_WRITERS = 2
+DEFAULT_QUEUE_SIZE = 8
+
+_DONE = object()  ## end of stream marker, one per downstream worker
+
+
+@dataclass
+class QueueStats:
+    name: str
+    maxsize: int
+    samples: int = 0
+    depth_sum: int = 0
+    max_depth: int = 0
+
+    @property
+    def mean_depth(self) -> float:
+        return self.depth_sum / self.samples if self.samples else 0.0
+
+    def sample(self, depth: int):
+        self.samples += 1
+        self.depth_sum += depth
+        self.max_depth = max(self.max_depth, depth)
+
+
+@dataclass
+class StageStats:
+    name: str
+    workers: int
+    items: int = 0
+    failed: int = 0
+    busy_seconds: float = 0.0
+
+    def utilization(self, wall_seconds: float) -> float:
+        """Fraction of the wall time the stage's workers spent working"""
+        return self.busy_seconds / (wall_seconds * self.workers) if wall_seconds else 0.0
+
+
+@dataclass
+class PipelineReport:
+    files: int
+    wall_seconds: float
+    stages: List[StageStats] = field(default_factory=list)
+    queues: List[QueueStats] = field(default_factory=list)
+
+    def log(self):
+        logger.info(f"Processed {self.files} files in {self.wall_seconds:.2f}s "
+                    f"({self.files / self.wall_seconds if self.wall_seconds else 0:.1f} files/s)")
+        for s in self.stages:
+            logger.info(f"  {s.name}: {s.items} items ({s.failed} failed), {s.items / self.wall_seconds if self.wall_seconds else 0:.1f}/s, "
+                        f"{s.workers} workers {100 * s.utilization(self.wall_seconds):.0f}% busy")
+        for q in self.queues:
+            logger.info(f"  {q.name} queue: mean depth {q.mean_depth:.1f}, max {q.max_depth}/{q.maxsize}")
+
+
+class _Stage:
+    """`workers` threads applying `func` to the items of `inbox` and putting the results in `outbox`"""
+    def __init__(self, name: str, func: Callable, workers: int, inbox: queue.Queue, outbox: Optional[queue.Queue],
+                 inbox_stats: QueueStats, downstream_workers: int = 0):
+        self.func = func
+        self.inbox, self.outbox = inbox, outbox
+        self.inbox_stats = inbox_stats
+        self.downstream_workers = downstream_workers
+        self.stats = StageStats(name, workers)
+        self._lock = threading.Lock()
+        self._running = workers
+        self.threads = [threading.Thread(target=self._work, name=f'{name}-{i}', daemon=True) for i in range(workers)]
+
+    def start(self):
+        for t in self.threads:
+            t.start()
+
+    def join(self):
+        for t in self.threads:
+            t.join()
+
+    def _work(self):
+        while True:
+            item = self.inbox.get()
+            with self._lock:
+                self.inbox_stats.sample(self.inbox.qsize())
+            if item is _DONE:
+                break
+            start = time.perf_counter()
+            try:
+                result = self.func(item)
+                failed = False
+            except Exception as e:
+                logger.error(f"{self.stats.name} failed on {getattr(item, 'file', item)}: {e}")
+                result, failed = None, True
+            with self._lock:
+                self.stats.busy_seconds += time.perf_counter() - start
+                self.stats.items += 1
+                self.stats.failed += failed
+            if self.outbox is not None and result is not None:
+                self.outbox.put(result)  ## blocks while the next stage is behind
+        with self._lock:
+            self._running -= 1
+            last = self._running == 0
+        if last and self.outbox is not None:
+            for _ in range(self.downstream_workers):
+                self.outbox.put(_DONE)
+
+
+def score_frame(df: pd.DataFrame, child: Child, growth_tables: dict) -> pd.DataFrame:
+    return flag_plausibility(percentile(df, child, growth_tables)).round(2)
+
+
+def write_outputs(df: pd.DataFrame, child: Child, growth_tables: dict, csv_path: Path, html_path: Optional[Path],
+            site: Optional[ReportSite] = None, site_id: str = None) -> Optional[dict]:
+    """Write the csv and the chart, or the child's data file of the site, whose index entry is returned"""
+    df.to_csv(csv_path, index=False)
+    if html_path is not None:
+        plot_subplot_growth_percentiles(df, child, growth_tables, html_path, show=False)
+    if site is not None:
+        return site.write_child(site_id, df, child)
+
+
+_TABLES = None
+
+
+def _init_process():
+    ## once per process; the store is memory-mapped so the pages are shared between processes
+    global _TABLES
+    _TABLES = shared_growth_database()
+
+
+def _score_in_process(df: pd.DataFrame, child: Child) -> pd.DataFrame:
+    return score_frame(df, child, _TABLES)
+
+
+def _write_in_process(df: pd.DataFrame, child: Child, csv_path: Path, html_path: Optional[Path],
+            site: Optional[ReportSite], site_id: str) -> Optional[dict]:
+    return write_outputs(df, child, _TABLES, csv_path, html_path, site, site_id)
+
+
+@dataclass
+class _Job:
+    file: Path
+    config: ChildConfig
+    child: Child
+    df: pd.DataFrame = None
+
+
+class DirectoryPipeline:
+    """Reads, scores and writes every export of a directory with overlapping stages.
+
+    Args:
+        children (List[ChildConfig]): Maps file names to children (see src.watcher).
+        savepath (Path): Where `<file>_growth.csv` and `<file>.html` are written.
+        growth_tables (dict): Reference tables, shared by all the scoring threads.
+        readers, scorers, writers (int): Threads per stage, at least 1.
+        queue_size (int): Capacity of the queues between the stages, at least 1.
+        render (bool): Write the html chart of every file.
+        processes (int): Size of the process pool scoring and rendering run in, 0 to run them
+            in the stage threads. The processes load the shared reference store themselves.
+        site (Path): Write a static report site of all the children there, instead of an html
+            chart per file. The child ids are the file stems, made distinct where they collide.
+    """
+    def __init__(self, children: List[ChildConfig], savepath: Path, growth_tables: dict,
+                 readers: int = DEFAULT_READERS, scorers: int = DEFAULT_SCORERS, writers: int = DEFAULT_WRITERS,
+                 queue_size: int = DEFAULT_QUEUE_SIZE, render: bool = True, processes: int = 0,
+                 site: Optional[Path] = None):
+        ## a stage without workers never drains its bounded queue and the pipeline blocks forever
+        for name, count in (('readers', readers), ('scorers', scorers), ('writers', writers), ('queue_size', queue_size)):
+            if count < 1:
+                raise ValueError(f"{name} must be at least 1, got {count}")
+        if processes < 0:
+            raise ValueError(f"processes must be at least 0, got {processes}")
+        self.children = children
+        self.savepath = Path(savepath)
+        self.growth_tables = growth_tables
+        self.workers = {'read': readers, 'score': scorers, 'write': writers}
+        self.queue_size = queue_size
+        self.render = render
+        self.processes = processes
+        self.site = ReportSite(site) if site is not None else None
+        self._site_entries = []
+        self._site_ids = {}
+        self._lock = threading.Lock()
+        self._pool = None
+
+    def read(self, job: _Job) -> _Job:
+        fmt = resolve_format(job.config.format, job.file)
+        job.df = fmt.parse(fmt.read(job.file), job.child)
+        return job
+
+    def score(self, job: _Job) -> _Job:
+        if self._pool is not None:
+            job.df = self._pool.submit(_score_in_process, job.df, job.child).result()
+        else:
+            job.df = score_frame(job.df, job.child, self.growth_tables)
+        return job
+
+    def write(self, job: _Job) -> _Job:
+        csv_path = self.savepath / f'{job.file.stem}_growth.csv'
+        html_path = self.savepath / f'{job.file.stem}.html' if self.render and self.site is None else None
+        site_id = self._site_ids.get(job.file.stem)
+        if self._pool is not None:
+            entry = self._pool.submit(_write_in_process, job.df, job.child, csv_path, html_path, self.site, site_id).result()
+        else:
+            entry = write_outputs(job.df, job.child, self.growth_tables, csv_path, html_path, self.site, site_id)
+        if entry is not None:
+            with self._lock:
+                self._site_entries.append(entry)
+        return job
+
+    def jobs(self, directory: Path, pattern: str = '*.csv') -> List[_Job]:
+        jobs = []
+        for file in sorted(Path(directory).glob(pattern)):
+            config = match_child(file, self.children)
+            if config is None:
+                logger.warning(f"No child matches {file.name}, add it to the children file")
+                continue
+            jobs.append(_Job(file, config, Child(config.name, config.gender, config.dob)))
+        return jobs
+
+    def run(self, directory: Path, pattern: str = '*.csv') -> PipelineReport:
+        """Process every matching export of `directory` and return the stage and queue statistics"""
+        self.savepath.mkdir(parents=True, exist_ok=True)
+        jobs = self.jobs(directory, pattern)
+        names = list(self.workers)
+        queues = [queue.Queue(self.queue_size) for _ in names]  ## in front of read, score and write
+        queue_stats = [QueueStats(name, self.queue_size) for name in ['files', 'parsed', 'scored']]
+        funcs = {'read': self.read, 'score': self.score, 'write': self.write}
+        stages = []
+        for i, name in enumerate(names):
+            outbox = queues[i + 1] if i + 1 < len(names) else None
+            downstream = self.workers[names[i + 1]] if i + 1 < len(names) else 0
+            stages.append(_Stage(name, funcs[name], self.workers[name], queues[i], outbox, queue_stats[i], downstream))
+
+        start = time.perf_counter()
+        if self.site is not None:
+            self.site.write_shared(self.growth_tables)
+            self._site_entries = []
+            self._site_ids = child_ids(job.file.stem for job in jobs)
+        if self.processes:
+            self._pool = ProcessPoolExecutor(self.processes, initializer=_init_process)
+        try:
+            for stage in stages:
+                stage.start()
+            for job in jobs:
+                queues[0].put(job)  ## blocks while the readers are behind
+            for _ in range(self.workers[names[0]]):
+                queues[0].put(_DONE)
+            for stage in stages:
+                stage.join()
+        finally:
+            if self._pool is not None:
+                self._pool.shutdown()
+                self._pool = None
+        if self.site is not None:
+            self.site.write_index(self._site_entries)
+        return PipelineReport(len(jobs), time.perf_counter() - start, [s.stats for s in stages], queue_stats)
@@ -1,14 +1,20 @@
 
+import threading
+import numpy as np
 import pandas as pd
 from pathlib import Path
-from typing import List
+from collections import OrderedDict
+from typing import List, Dict, Tuple, Optional
+from dataclasses import dataclass
 
 import seaborn as sns
 from plotly.offline import iplot
 from plotly import graph_objs as go
 from plotly.subplots import make_subplots
 
-from src.database import Child, get_growth_table
+from src.database import Child
+from src.ingest_csv import METRICS
+from src.validation import FLAGS
 
 
 PERCENTILES = ['P1', "P5", 'P10', "P25", 'P50', "P75", 'P90', "P95", 'P99']
@@ -38,16 +44,61 @@ def growth_percentiles(df) -> List[go.Scatter]:
         plots.append(_plot_growth_percentiles(df, col))
     return plots
 
-def plot_growth_percentiles_with_subject(
-        who_reference_df: pd.DataFrame, 
-        subject_df: pd.DataFrame, 
-        subject_ycol: str, 
-        # percentiles: str,
-        # title: str
-        ) -> go.Figure:
-    """Plots the growth percentiles with the subject's data"""
-    plots = growth_percentiles(who_reference_df)
-    trace = go.Scatter(
+## above this many measurements the report switches to the dense mode (WebGL + downsampling)
+MAX_POINTS = 500
+## the dense mode shows at most this many rows in the results table
+MAX_TABLE_ROWS = 60
+
+
+def lttb(x, y, n_out: int) -> np.ndarray:
+    """Largest-Triangle-Three-Buckets downsampling.
+    Returns the indices of the `n_out` points that best preserve the visual shape of the
+    series. x must be sorted. The first and last points are always kept.
+    ## https://skemman.is/bitstream/1946/15343/3/SS_MSthesis.pdf
+    """
+    x = np.asarray(x, dtype='float64')
+    y = np.asarray(y, dtype='float64')
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    edges = np.linspace(1, n - 1, n_out - 1).astype(int)  ## n_out - 2 buckets between the end points
+    idx = np.empty(n_out, dtype=int)
+    idx[0], idx[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        start, stop = edges[i], edges[i + 1]
+        ## average of the next bucket (or the last point) is the third corner of the triangle
+        nstart, nstop = stop, edges[i + 2] if i + 2 < len(edges) else n
+        cx, cy = x[nstart:nstop].mean(), y[nstart:nstop].mean()
+        bx, by = x[start:stop], y[start:stop]
+        area = np.abs((x[a] - cx) * (by - y[a]) - (x[a] - bx) * (cy - y[a]))
+        a = start + int(np.argmax(area))
+        idx[i + 1] = a
+    return idx
+
+
+def downsample(subject_df: pd.DataFrame, subject_ycol: str, max_points: int = MAX_POINTS) -> pd.DataFrame:
+    """Returns at most `max_points` rows of the subject's series, chosen with `lttb`"""
+    dfx = subject_df.sort_values('months')
+    if len(dfx) <= max_points:
+        return dfx
+    return dfx.iloc[lttb(dfx['months'], dfx[subject_ycol], max_points)]
+
+
+def summary_table(df: pd.DataFrame, max_rows: int = MAX_TABLE_ROWS) -> pd.DataFrame:
+    """Summarises a long history for the results table: the last measurement of each
+    month of age, limited to the latest `max_rows` months"""
+    df = df.sort_values('months')
+    last = df.groupby(df['months'].fillna(-1).astype(float).floordiv(1), sort=True).tail(1)
+    return last.tail(max_rows)
+
+
+def subject_trace(subject_df: pd.DataFrame, subject_ycol: str, webgl: bool = False, **kwargs) -> go.Scatter:
+    """Returns the marker trace for the subject's measurements.
+    With webgl=True a go.Scattergl trace is returned, which renders thousands of points smoothly.
+    Extra keyword arguments are passed to the trace, e.g. xaxis/yaxis"""
+    scatter = go.Scattergl if webgl else go.Scatter
+    return scatter(
         x=subject_df['months'],
         y=subject_df[subject_ycol],
         mode='markers',
@@ -57,8 +108,20 @@ def plot_growth_percentiles_with_subject(
         marker=dict(
             size=5,
             color='red',
-        )
+        ),
+        **kwargs
     )
+
+def plot_growth_percentiles_with_subject(
+        who_reference_df: pd.DataFrame, 
+        subject_df: pd.DataFrame, 
+        subject_ycol: str, 
+        # percentiles: str,
+        # title: str
+        ) -> go.Figure:
+    """Plots the growth percentiles with the subject's data"""
+    plots = growth_percentiles(who_reference_df)
+    trace = subject_trace(subject_df, subject_ycol)
     plots.append(trace)
     # title = f"{title}"
     # layout = go.Layout(
@@ -70,12 +133,133 @@ def plot_growth_percentiles_with_subject(
     return plots
 
 
+## subject column: WHO table, in subplot order
+SUBPLOT_METRICS = {
+    'weight_kg': 'wfa',
+    'bmi': 'bmi',
+    'height_cm': 'lhfa',
+    'hc_cm': 'hcfa'
+}
 
-def plot_subplot_growth_percentiles(df: pd.DataFrame, child: Child, growth_tables: dict, output: Path):
-    """Plots the growth percentiles for Weight, BMI, Height and Head circumference. 
-    The growth_tables is a dictionary of pandas DataFrames.
-    The output is the path to save the plot as ineractive html file.
+METRIC_LABELS = {
+    'weight_kg': 'Weight (kg)',
+    'bmi': 'BMI',
+    'height_cm': 'Height (cm)',
+    'hc_cm': 'Head circumference (cm)',
+}
+PERCENTILE_COLUMNS = {
+    'weight_kg': 'weight_percentile',
+    'bmi': 'bmi_percentile',
+    'height_cm': 'height_percentile',
+    'hc_cm': 'hc_percentile',
+}
+
+def _table_numbers(df: pd.DataFrame, col: str, fmt: str) -> np.ndarray:
+    """A column formatted for the results table, '-' where it is missing or could not be scored"""
+    if col not in df.columns:
+        return np.full(len(df), '-', dtype=object)
+    values = pd.to_numeric(df[col], errors='coerce').to_numpy(dtype='float64', na_value=np.nan)
+    out = np.char.mod(fmt, values).astype(object)
+    out[np.isnan(values)] = '-'
+    return out
+
+
+def table_cells(df: pd.DataFrame) -> list:
+    """Cell values of the results table: month, the percentiles and the plausibility flags
+    of `src.validation.flag_plausibility` (e.g. 'weight biv'), when the frame has them"""
+    cells = [_table_numbers(df, 'months', '%.2f')]
+    cells += [_table_numbers(df, pcol, '%.2f') for pcol in PERCENTILE_COLUMNS.values()]
+    flags = [np.full(len(df), '', dtype=object)]
+    for name in METRICS:
+        for flag in FLAGS:
+            if f'{name}_{flag}' in df.columns:
+                hit = df[f'{name}_{flag}'].fillna(False).to_numpy(dtype=bool)
+                flags.append(np.where(hit, f'{name} {flag}', ''))
+    cells.append([', '.join(f for f in row if f) for row in zip(*flags)])
+    return cells
+
+
+def band_curves(metric_tables: dict, ranges=None) -> pd.DataFrame:
+    """The tables of consecutive age ranges of one metric as one frame with a 'Month' column.
+    Adjacent WHO tables share their boundary month (24: length in the 0-2 year table, height
+    in the 2-5 year one). The earlier range wins there, as in scoring (lms_for_months), so
+    every month appears once and the curves have no vertical step."""
+    frames, last = [], -np.inf
+    for age_range in sorted(metric_tables if ranges is None else ranges):
+        table = metric_tables[age_range]
+        table = table[table.index > last]
+        if len(table):
+            frames.append(table)
+            last = table.index[-1]
+    return pd.concat(frames).reset_index()
+
+
+def reference_curves(tables: dict) -> dict:
+    """Percentile curves for every gender and metric as plain lists, for the browser, with the
+    colours and labels the charts drawn there need (dashboard and static report site).
+    The age ranges are joined with `band_curves`: at 24 months the 0-2 year row is drawn.
+    curves: {gender: {value column: {'months': [...], 'P1': [...], ...}}}"""
+    curves = {}
+    for gender in tables:
+        curves[gender] = {}
+        for ycol, metric in SUBPLOT_METRICS.items():
+            if metric not in tables[gender]:
+                continue
+            df = band_curves(tables[gender][metric])
+            curves[gender][ycol] = {'months': df['Month'].tolist()} | {p: df[p].tolist() for p in PERCENTILES}
+    return {
+        'curves': curves,
+        'colors': PERCENTILES_TO_COLOR,
+        'labels': METRIC_LABELS,
+        'percentile_columns': PERCENTILE_COLUMNS,
+    }
+
+
+@dataclass
+class FigureTemplate:
+    """Pre-built reference layer of the growth report.
+    figure: the figure as a plain dict (subplots, layout and the percentile traces)
+    axes: subject column -> {'xaxis': .., 'yaxis': ..} of its subplot
+    table_domain: domain of the results table
     """
+    figure: dict
+    axes: Dict[str, dict]
+    table_domain: dict
+
+    def new_figure(self) -> go.Figure:
+        """Returns a fresh figure with the reference layer, safe to modify"""
+        return go.Figure(self.figure)
+
+
+## templates kept, the least recently used is dropped: a few age bands of both sexes, and the
+## tables objects they were built from, so reloaded tables are not kept alive
+MAX_FIGURE_TEMPLATES = 16
+## (id(growth_tables), gender, age bands) -> (growth_tables, FigureTemplate)
+## growth_tables is kept alive so its id cannot be reused by another dict
+_FIGURE_TEMPLATES: "OrderedDict[tuple, Tuple[dict, FigureTemplate]]" = OrderedDict()
+_TEMPLATES_LOCK = threading.Lock()
+
+
+def _age_bands(growth_tables: dict, gender: str, months) -> tuple:
+    """The age ranges of the tables the measurements are scored with, per metric: the first
+    range containing the age at measurement, as in lms_for_months. All the ranges of a metric
+    when no measurement falls in any of them"""
+    months = np.asarray(months, dtype='float64')
+    months = months[~np.isnan(months)]
+    bands = []
+    for metric in SUBPLOT_METRICS.values():
+        ranges = sorted(growth_tables[gender.lower()][metric])
+        todo, used = np.ones(len(months), dtype=bool), []
+        for age_range in ranges:
+            hit = todo & (months >= age_range[0] * 12) & (months <= age_range[1] * 12)
+            if hit.any():
+                used.append(age_range)
+                todo &= ~hit
+        bands.append(tuple(used or ranges))
+    return tuple(bands)
+
+
+def _build_figure_template(growth_tables: dict, gender: str, bands: tuple) -> FigureTemplate:
     fig = make_subplots(rows=3, cols=2, 
                         subplot_titles=(
                             "Weight growth percentiles", 
@@ -95,66 +279,99 @@ def plot_subplot_growth_percentiles(df: pd.DataFrame, child: Child, growth_table
                             [{"type": "table", "colspan": 2}, None]
                         ]
                     )
-
-    mapper= {
-        'weight_kg': 'wfa',
-        'bmi': 'bmi',
-        'height_cm': 'lhfa',
-        'hc_cm': 'hcfa'
-    }
-
-    for idx, ycol in enumerate([ 'weight_kg','bmi',  'height_cm', 'hc_cm']):
-        # print(row, col, ycol)
+    axes = {}
+    for idx, ((ycol, metric), ranges) in enumerate(zip(SUBPLOT_METRICS.items(), bands)):
         row = idx//2 + 1
         col = idx%2 + 1
-        table = get_growth_table(growth_tables, mapper[ycol], child.gender, child.age).reset_index()
-        # percentiles_col = f'{ycol.split("_")[0]}_percentile'
-
-        dfx = df.loc[df[ycol].notna(), ['months', ycol]] ## remove NaN rows values
-
-        traces =  plot_growth_percentiles_with_subject(
-            who_reference_df=table, 
-            subject_df=dfx, 
-            subject_ycol=ycol, 
-            # percentiles=f'{ycol.split("_")[0]}_percentile', 
-            # title=f'{ycol.split("_")[0].capitalize()} growth percentiles'
-            )
-        # print(traces)
+        table = band_curves(growth_tables[gender.lower()][metric], ranges)
+        traces = growth_percentiles(table)
         fig.add_traces(
             traces,
             rows=[row]*len(traces), cols=[col]*len(traces),
         )
-    df = df.fillna(0).round(2)
-    df.style.format({
-        "weight_percentile": "{:.2f}%",
-        "bmi_percentile": "{:.2f}%",
-        "height_percentile": "{:.2f}%",
-        "hc_percentile": "{:.2f}%"
-    })
+        axes[ycol] = dict(xaxis=fig.data[-1].xaxis, yaxis=fig.data[-1].yaxis)
+    table_subplot = fig.get_subplot(3, 1)
+    fig.update_layout(
+        height=800, width=1200, 
+        showlegend=False,
+        )
+    return FigureTemplate(
+        figure=fig.to_dict(),
+        axes=axes,
+        table_domain=dict(x=list(table_subplot.x), y=list(table_subplot.y)),
+    )
+
+
+def get_figure_template(growth_tables: dict, gender: str, months) -> FigureTemplate:
+    """Returns the cached reference layer for the gender and the age bands of the ages at
+    measurement `months` (see _age_bands), building it on first use"""
+    bands = _age_bands(growth_tables, gender, months)
+    key = (id(growth_tables), gender.lower(), bands)
+    with _TEMPLATES_LOCK:
+        entry = _FIGURE_TEMPLATES.get(key)
+        if entry is not None:
+            _FIGURE_TEMPLATES.move_to_end(key)
+            return entry[1]
+    template = _build_figure_template(growth_tables, gender, bands)
+    with _TEMPLATES_LOCK:
+        _FIGURE_TEMPLATES[key] = (growth_tables, template)
+        while len(_FIGURE_TEMPLATES) > MAX_FIGURE_TEMPLATES:
+            _FIGURE_TEMPLATES.popitem(last=False)
+    return template
+
+
+def clear_figure_templates():
+    """Drop all cached reference layers, e.g. after the reference tables were reloaded"""
+    with _TEMPLATES_LOCK:
+        _FIGURE_TEMPLATES.clear()
+
+
+def plot_subplot_growth_percentiles(df: pd.DataFrame, child: Child, growth_tables: dict, output: Path, show: bool = True,
+            dense: Optional[bool] = None, max_points: int = MAX_POINTS, max_table_rows: int = MAX_TABLE_ROWS):
+    """Plots the growth percentiles for Weight, BMI, Height and Head circumference. 
+    The growth_tables is a dictionary of pandas DataFrames.
+    The output is the path to save the plot as ineractive html file.
+    The reference percentile layer is cached per gender and the age bands of the measurements,
+    the tables they are scored with (see get_figure_template),
+    so only the subject markers and the table are built per child. Set show=False for batch runs.
+    In the dense mode (default: when there are more than max_points rows) the markers are WebGL
+    traces downsampled with LTTB and the table is summarised with summary_table, so the file size
+    stays bounded however long the history is.
+    """
+    if dense is None:
+        dense = len(df) > max_points
+    template = get_figure_template(growth_tables, child.gender, df['months'])
+    fig = template.new_figure()
+
+    for ycol in SUBPLOT_METRICS:
+        dfx = df.loc[df[ycol].notna(), ['months', ycol]] ## remove NaN rows values
+        if dense:
+            dfx = downsample(dfx, ycol, max_points)
+        fig.add_trace(subject_trace(dfx, ycol, webgl=dense, **template.axes[ycol]))
+
+    if dense:
+        df = summary_table(df, max_table_rows)
+    ## measurements that could not be scored are shown as '-' and flagged, not as a 0th percentile
     fig.add_trace(
         go.Table(
             header=dict(
-                values=["Month", "Weight (%)", "BMI (%)", "Height (%)", "Head Circumference (%)"],
+                values=["Month", "Weight (%)", "BMI (%)", "Height (%)", "Head Circumference (%)", "Flags"],
                 font=dict(size=10),
                 align="left"
             ),
             cells=dict(
-                values=[df['months'], df['weight_percentile'] , df['bmi_percentile'], df['height_percentile'], df['hc_percentile']],
+                values=table_cells(df),
                 align = "left"
-            )
-        ),
-        row=3, col=1
+            ),
+            domain=template.table_domain,
+        )
     )
 
     fig.update_layout(
         title_text=f"Growth percentiles for {child.name}",
-        height=800, width=1200, 
-        showlegend=False,
-
         )
     
     fig.write_html(output)
     ## save figure to file
-    fig.show()
-
-
+    if show:
+        fig.show()
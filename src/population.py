@@ -0,0 +1,212 @@
+# Cohort summaries of scored measurements: prevalence of stunting, wasting, underweight and
+# overweight, and the z-score distribution of every indicator by sex and age group.
+#
+# The summary is a set of running aggregates (counts, Welford mean / M2, histogram bins),
+# updated one chunk at a time, so a cohort of any size is summarized in one streaming pass.
+# Two summaries merge exactly (Chan et al. parallel variance), so files or chunks can be
+# summarized by parallel workers and combined at the end.
+## https://www.who.int/tools/child-growth-standards/software (prevalence cut-offs)
+from pathlib import Path
+from dataclasses import dataclass, field
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterable, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+from src import logger
+from src.ingest_csv import METRICS
+from src.validation import BIV_LIMITS
+
+
+SEXES = ['F', 'M']
+## age groups in months, [lower, upper)
+AGE_GROUPS: List[Tuple[int, int]] = [(0, 6), (6, 12), (12, 24), (24, 36), (36, 48), (48, 61)]
+## z-score histogram bin edges; values outside are counted in the first / last bin
+Z_BINS = np.linspace(-6, 6, 49)
+CHUNKSIZE = 100_000
+
+## indicator: (z-score columns, preferred first, direction, cut-off)
+## wasting and overweight use weight-for-length/height, or BMI-for-age when it is not scored
+PREVALENCE: Dict[str, Tuple[List[str], str, float]] = {
+    'stunting': (['height_zscore'], '<', -2),
+    'underweight': (['weight_zscore'], '<', -2),
+    'wasting': (['wflh_zscore', 'bmi_zscore'], '<', -2),
+    'overweight': (['wflh_zscore', 'bmi_zscore'], '>', 2),
+}
+
+
+def group_labels() -> List[Tuple[str, str]]:
+    """(sex, age group) of every summary group, in the order of the aggregate arrays"""
+    return [(sex, f'{lo}-{hi}m') for sex in SEXES for lo, hi in AGE_GROUPS]
+
+
+def group_index(sex: pd.Series, months: pd.Series) -> np.ndarray:
+    """Group of every row, -1 when the sex or the age is outside the summary groups"""
+    ## 'M', 'male', 'F', 'Female' ...: the distinct values are mapped, not every row
+    codes, uniques = pd.factorize(pd.Series(sex))
+    lookup = np.array([SEXES.index(str(u)[:1].upper()) if str(u)[:1].upper() in SEXES else -1 for u in uniques] + [-1])
+    s = lookup[codes]  ## code -1 (missing) picks the trailing -1
+    edges = np.array([lo for lo, _ in AGE_GROUPS] + [AGE_GROUPS[-1][1]], dtype='float64')
+    m = pd.to_numeric(months, errors='coerce').to_numpy(dtype='float64', na_value=np.nan)
+    a = np.searchsorted(edges, m, side='right') - 1
+    a[(a < 0) | (a >= len(AGE_GROUPS)) | np.isnan(m)] = -1
+    return np.where((s >= 0) & (a >= 0), s * len(AGE_GROUPS) + a, -1)
+
+
+def _plausible_z(df: pd.DataFrame, zcol: str) -> np.ndarray:
+    """The z-scores of a column, NaN outside the WHO BIV cut-offs"""
+    z = pd.to_numeric(df[zcol], errors='coerce').to_numpy(dtype='float64', na_value=np.nan)
+    lo, hi = BIV_LIMITS.get(zcol[:-len('_zscore')], (-np.inf, np.inf))
+    return np.where((z >= lo) & (z <= hi), z, np.nan)
+
+
+@dataclass
+class ZStats:
+    """Running count, mean and M2 (sum of squared deviations) per group, plus a histogram"""
+    count: np.ndarray
+    mean: np.ndarray
+    m2: np.ndarray
+    hist: np.ndarray
+
+    @classmethod
+    def empty(cls, n_groups: int) -> 'ZStats':
+        return cls(np.zeros(n_groups, dtype='int64'), np.zeros(n_groups), np.zeros(n_groups),
+                   np.zeros((n_groups, len(Z_BINS) - 1), dtype='int64'))
+
+    @property
+    def sd(self) -> np.ndarray:
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.count > 1, np.sqrt(self.m2 / (self.count - 1)), np.nan)
+
+    def merge(self, other: 'ZStats') -> 'ZStats':
+        """Combine two sets of aggregates as if their values had been seen together"""
+        n = self.count + other.count
+        delta = other.mean - self.mean
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.where(n > 0, self.mean + delta * other.count / n, 0.0)
+            m2 = np.where(n > 0, self.m2 + other.m2 + delta ** 2 * self.count * other.count / n, 0.0)
+        return ZStats(n, mean, m2, self.hist + other.hist)
+
+    @classmethod
+    def from_values(cls, group: np.ndarray, z: np.ndarray, n_groups: int) -> 'ZStats':
+        """Aggregates of one chunk: the group of every value and the values (NaN skipped)"""
+        keep = (group >= 0) & ~np.isnan(z)
+        g, z = group[keep], z[keep]
+        count = np.bincount(g, minlength=n_groups)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.where(count > 0, np.bincount(g, z, minlength=n_groups) / count, 0.0)
+        m2 = np.bincount(g, (z - mean[g]) ** 2, minlength=n_groups)
+        bins = np.clip(np.searchsorted(Z_BINS, z, side='right') - 1, 0, len(Z_BINS) - 2)
+        hist = np.bincount(g * (len(Z_BINS) - 1) + bins, minlength=n_groups * (len(Z_BINS) - 1))
+        return cls(count, mean, m2, hist.reshape(n_groups, -1))
+
+
+@dataclass
+class PopulationSummary:
+    """Mergeable cohort summary. Feed it scored chunks with `update`, combine the summaries
+    of parallel workers with `merge` (or `+`) and read the results with `prevalence` and `stats`."""
+    zstats: Dict[str, ZStats] = field(default_factory=dict)
+    cases: Dict[str, np.ndarray] = field(default_factory=dict)   ## rows beyond the cut-off
+    valid: Dict[str, np.ndarray] = field(default_factory=dict)   ## rows with a plausible z-score
+    rows: int = 0
+
+    def __post_init__(self):
+        n_groups = len(group_labels())
+        for name in METRICS:
+            self.zstats.setdefault(f'{name}_zscore', ZStats.empty(n_groups))
+        for indicator in PREVALENCE:
+            self.cases.setdefault(indicator, np.zeros(n_groups, dtype='int64'))
+            self.valid.setdefault(indicator, np.zeros(n_groups, dtype='int64'))
+
+    def update(self, chunk: pd.DataFrame, sex_col: str = 'gender', sex: str = None) -> 'PopulationSummary':
+        """Add a chunk of scored rows (the output of `percentile`). The sex comes from
+        `sex_col`, or `sex` for a chunk of one child"""
+        n_groups = len(group_labels())
+        if sex is None and sex_col not in chunk.columns:
+            raise ValueError(f"No sex column {sex_col!r} in {list(chunk.columns)}, pass the sex of the rows instead")
+        sexes = chunk[sex_col] if sex is None else pd.Series(sex, index=chunk.index)
+        group = group_index(sexes, chunk['months'])
+        for zcol in self.zstats:
+            if zcol in chunk.columns:
+                self.zstats[zcol] = self.zstats[zcol].merge(ZStats.from_values(group, _plausible_z(chunk, zcol), n_groups))
+        for indicator, (zcols, direction, cutoff) in PREVALENCE.items():
+            z = np.full(len(chunk), np.nan)
+            for zcol in reversed([c for c in zcols if c in chunk.columns]):
+                values = _plausible_z(chunk, zcol)
+                z = np.where(np.isnan(values), z, values)  ## the preferred column where it has a value
+            keep = (group >= 0) & ~np.isnan(z)
+            hit = keep & ((z < cutoff) if direction == '<' else (z > cutoff))
+            self.valid[indicator] += np.bincount(group[keep], minlength=n_groups)
+            self.cases[indicator] += np.bincount(group[hit], minlength=n_groups)
+        self.rows += len(chunk)
+        return self
+
+    def merge(self, other: 'PopulationSummary') -> 'PopulationSummary':
+        return PopulationSummary(
+            zstats={k: self.zstats[k].merge(other.zstats[k]) for k in self.zstats},
+            cases={k: self.cases[k] + other.cases[k] for k in self.cases},
+            valid={k: self.valid[k] + other.valid[k] for k in self.valid},
+            rows=self.rows + other.rows,
+        )
+
+    __add__ = merge
+
+    def _frame(self, columns: Dict[str, np.ndarray]) -> pd.DataFrame:
+        index = pd.MultiIndex.from_tuples(group_labels(), names=['sex', 'age_group'])
+        return pd.DataFrame(columns, index=index)
+
+    def prevalence(self) -> pd.DataFrame:
+        """Per sex and age group: the plausible measurements and % beyond the cut-off of every indicator"""
+        columns = {}
+        for indicator in PREVALENCE:
+            valid, cases = self.valid[indicator], self.cases[indicator]
+            columns[f'{indicator}_n'] = valid
+            with np.errstate(invalid='ignore', divide='ignore'):
+                columns[f'{indicator}_%'] = np.where(valid > 0, 100 * cases / valid, np.nan)
+        return self._frame(columns)
+
+    def stats(self) -> pd.DataFrame:
+        """Per sex and age group: count, mean and SD of every z-score"""
+        columns = {}
+        for zcol, s in self.zstats.items():
+            name = zcol[:-len('_zscore')]
+            columns[f'{name}_n'] = s.count
+            columns[f'{name}_mean'] = np.where(s.count > 0, s.mean, np.nan)
+            columns[f'{name}_sd'] = s.sd
+        return self._frame(columns)
+
+    def histogram(self, zcol: str) -> pd.DataFrame:
+        """Counts of a z-score in the `Z_BINS` bins, one row per sex and age group"""
+        columns = {f'{lo:g}': self.zstats[zcol].hist[:, i] for i, lo in enumerate(Z_BINS[:-1])}
+        return self._frame(columns)
+
+
+def without_column(paths: Iterable[Path], col: str) -> List[Path]:
+    """The csv files whose header does not have `col`, e.g. files scored by another tool"""
+    return [path for path in paths if col not in pd.read_csv(path, nrows=0).columns]
+
+
+def summarize_csv(path: Path, sex_col: str = 'gender', sex: str = None, chunksize: int = CHUNKSIZE) -> PopulationSummary:
+    """Summarize a scored csv file in chunks of `chunksize` rows"""
+    summary = PopulationSummary()
+    for chunk in pd.read_csv(path, chunksize=chunksize):
+        summary.update(chunk, sex_col=sex_col, sex=sex)
+    return summary
+
+
+def summarize_files(paths: Iterable[Path], sex_col: str = 'gender', sex: str = None,
+            chunksize: int = CHUNKSIZE, workers: int = 1) -> PopulationSummary:
+    """Summarize scored csv files, one file per worker process, and merge the results"""
+    paths = list(paths)
+    summary = PopulationSummary()
+    if workers > 1 and len(paths) > 1:
+        with ProcessPoolExecutor(workers) as pool:
+            parts = pool.map(summarize_csv, paths, [sex_col] * len(paths), [sex] * len(paths), [chunksize] * len(paths))
+            for part in parts:
+                summary = summary + part
+    else:
+        for path in paths:
+            summary = summary + summarize_csv(path, sex_col, sex, chunksize)
+    logger.info(f"Summarized {summary.rows} measurements from {len(paths)} files")
+    return summary
@@ -0,0 +1,242 @@
+# Read-only memory-mapped store of the compiled WHO reference tables.
+#
+# Every table from `build_growth_database` is packed into one float64 array and
+# written as a single `.npy` file, with a small JSON sidecar describing where each
+# (gender, metric, age_range) table lives. The data file is named after the reference
+# version and the index names its data file, so replacing the index switches both at
+# once: a reader never pairs a new matrix with old offsets. Worker processes map that file with
+# `mmap_mode='r'`, so the OS page cache holds one copy of the data no matter how
+# many workers are running, and loading it does not parse any Excel files.
+import json
+import hashlib
+from pathlib import Path
+from collections import defaultdict
+from typing import Dict, Tuple, List, Callable
+
+import numpy as np
+import pandas as pd
+
+from src import logger
+from src.database import build_growth_database
+
+
+DEFAULT_DATAPATH = Path('data')
+DEFAULT_STORE = DEFAULT_DATAPATH / 'who_reference.npy'
+STORE_FORMAT = 3
+
+Tables = Dict[str, Dict[str, Dict[Tuple[int, int], pd.DataFrame]]]
+
+## called with no arguments when shared_growth_database loads tables of another reference version
+_RELOAD_CALLBACKS: List[Callable[[], None]] = []
+## reference version of the last tables shared_growth_database returned in this process
+_loaded_version = None
+
+
+def on_reload(callback: Callable[[], None]) -> Callable[[], None]:
+    """Register a callback that invalidates caches derived from the reference tables"""
+    _RELOAD_CALLBACKS.append(callback)
+    return callback
+
+
+def _notify_reload(version: str):
+    ## mapping the unchanged store again (every watcher poll, job or worker start) keeps the caches
+    global _loaded_version
+    if version == _loaded_version:
+        return
+    _loaded_version = version
+    for callback in _RELOAD_CALLBACKS:
+        callback()
+
+
+def _index_path(path: Path) -> Path:
+    return Path(path).with_suffix('.json')
+
+
+def _data_path(path: Path, version: str) -> Path:
+    """The data file of one version, e.g. who_reference.<version>.npy"""
+    path = Path(path)
+    return path.with_name(f'{path.stem}.{version}.npy')
+
+
+def _read_index(path: Path) -> dict:
+    index = json.loads(_index_path(path).read_text())
+    if index.get('format') != STORE_FORMAT:
+        raise ValueError(f"Unsupported reference store format: {index.get('format')}")
+    return index
+
+
+def _replace(path: Path, write: Callable[[Path], None]):
+    """Write to a temporary file and rename it over `path`: readers see the old or the new file, never a partial one"""
+    tmp = path.with_name(f'{path.stem}.tmp{path.suffix}')
+    write(tmp)
+    tmp.replace(path)
+
+
+def _source_fingerprint(datapath: Path) -> List[list]:
+    """Cheap fingerprint of the source xlsx files: name, size and mtime"""
+    return sorted(
+        [file.name, file.stat().st_size, file.stat().st_mtime_ns]
+        for file in Path(datapath).glob('*.xlsx')
+    )
+
+
+def _iter_tables(tables: Tables):
+    for gender in sorted(tables):
+        for metric in sorted(tables[gender]):
+            for age_range in sorted(tables[gender][metric]):
+                yield gender, metric, age_range, tables[gender][metric][age_range]
+
+
+def reference_version(tables: Tables) -> str:
+    """Return a short content hash of the reference tables.
+    Any change to a value, column or table changes the version."""
+    digest = hashlib.sha1()
+    for gender, metric, age_range, df in _iter_tables(tables):
+        df = df[sorted(df.columns)]  ## the store may reorder columns; the version must not change
+        digest.update(f'{gender}.{metric}.{age_range[0]}_{age_range[1]}'.encode())
+        digest.update(','.join(map(str, df.columns)).encode())
+        digest.update(np.ascontiguousarray(df.index.to_numpy(dtype='float64')).tobytes())
+        digest.update(np.ascontiguousarray(df.to_numpy(dtype='float64')).tobytes())
+    return digest.hexdigest()[:16]
+
+
+def compile_reference_store(tables: Tables, path: Path = DEFAULT_STORE, sources: List[list] = None) -> Path:
+    """Write the tables to a single memory-mappable `.npy` file and its JSON index.
+
+    `path` names the store: the index is written to `path` with a `.json` suffix and the
+    data to `<stem>.<version>.npy` beside it. Columns shared by every table are stored
+    first, so each table is a contiguous row/column slice of the array and can be mapped
+    back without copying.
+    """
+    path = Path(path)
+    frames = list(_iter_tables(tables))
+    if not frames:
+        raise ValueError("No tables to compile")
+
+    common = [c for c in frames[0][3].columns if all(c in df.columns for *_, df in frames)]
+    extra = []
+    for *_, df in frames:
+        extra += [c for c in df.columns if c not in common and c not in extra]
+    columns = ['index'] + common + extra  ## first column holds each table's index (Month, Length or Height)
+
+    n_rows = sum(len(df) for *_, df in frames)
+    data = np.full((n_rows, len(columns)), np.nan, dtype='float64')
+    segments = []
+    start = 0
+    for gender, metric, age_range, df in frames:
+        stop = start + len(df)
+        data[start:stop, 0] = df.index.to_numpy(dtype='float64')
+        table_columns = [c for c in columns[1:] if c in df.columns]
+        for col in table_columns:
+            data[start:stop, columns.index(col)] = df[col].to_numpy(dtype='float64')
+        segments.append({
+            'gender': gender,
+            'metric': metric,
+            'age_range': list(age_range),
+            'start': start,
+            'stop': stop,
+            'columns': table_columns,
+            'index': df.index.name or 'Month',
+        })
+        start = stop
+
+    version = reference_version(tables)
+    data_path = _data_path(path, version)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    ## the data first, then the index that points to it; both are swapped in atomically
+    _replace(data_path, lambda tmp: np.save(tmp, data))
+    index = {
+        'format': STORE_FORMAT,
+        'version': version,
+        'data': data_path.name,
+        'columns': columns,
+        'segments': segments,
+        'sources': sources or [],
+    }
+    _replace(_index_path(path), lambda tmp: tmp.write_text(json.dumps(index, indent=2)))
+    for old in path.parent.glob(f'{path.stem}.*.npy'):
+        if old != data_path and not old.name.endswith('.tmp.npy'):
+            ## processes that still map an old version keep their mapping (posix); elsewhere it stays until the next compile
+            try:
+                old.unlink()
+            except OSError:
+                pass
+    logger.debug(f"Compiled reference store {path} ({data.nbytes / 1024:.0f} KB, version {index['version']})")
+    return path
+
+
+def load_reference_store(path: Path = DEFAULT_STORE) -> Tables:
+    """Map the compiled store read-only and return the usual nested dict of tables.
+    The DataFrames are views on the shared mapping; writing to them raises an error."""
+    return _load(path)[0]
+
+
+def _load(path: Path) -> Tuple[Tables, str]:
+    """The mapped tables and the reference version of the index they were read with"""
+    path = Path(path)
+    if not _index_path(path).exists():
+        raise FileNotFoundError(f"Reference store {path} not found, run compile_reference_store first")
+    ## the index is read once and the data file it names is mapped; a recompile in between
+    ## may remove that file, then the new index is read again
+    for attempt in range(2):
+        index = _read_index(path)
+        try:
+            data = np.load(path.with_name(index['data']), mmap_mode='r')
+            break
+        except FileNotFoundError:
+            if attempt:
+                raise
+    columns, version = index['columns'], index['version']
+
+    tables = defaultdict(lambda: defaultdict(dict))
+    for seg in index['segments']:
+        start, stop = seg['start'], seg['stop']
+        col_idx = [columns.index(c) for c in seg['columns']]
+        if col_idx == list(range(1, len(col_idx) + 1)):
+            values = data[start:stop, 1:len(col_idx) + 1]  ## basic slice: zero-copy view
+        else:
+            logger.debug(f"Columns of {seg['metric']}.{seg['gender']} are not contiguous, copying")
+            values = np.asarray(data[start:stop][:, col_idx])
+        index = data[start:stop, 0]
+        if seg['index'] == 'Month':
+            index = index.astype('int64')
+        df = pd.DataFrame(
+            values,
+            index=pd.Index(index, name=seg['index']),
+            columns=seg['columns'],
+            copy=False,
+        )
+        tables[seg['gender']][seg['metric']][tuple(seg['age_range'])] = df
+    return tables, version
+
+
+def store_version(path: Path = DEFAULT_STORE) -> str:
+    """Return the reference version recorded in the store index without mapping the data"""
+    return json.loads(_index_path(path).read_text())['version']
+
+
+def shared_growth_database(datapath: Path = DEFAULT_DATAPATH, store: Path = DEFAULT_STORE, rebuild: bool = False) -> Tables:
+    """Return the reference tables from the memory-mapped store.
+
+    The store is (re)compiled from the xlsx files when it is missing, when the
+    source files changed since it was written, or when `rebuild` is set. Call this
+    once in the parent process (e.g. gunicorn `--preload`) and forked workers
+    share the mapping.
+    """
+    store = Path(store)
+    sources = _source_fingerprint(datapath)
+    if not rebuild and _index_path(store).exists():
+        try:
+            index = json.loads(_index_path(store).read_text())
+            if index.get('format') == STORE_FORMAT and index.get('sources') == sources:
+                tables, version = _load(store)
+                _notify_reload(version)
+                return tables
+            logger.info(f"Reference store {store} is stale, recompiling")
+        except (ValueError, KeyError, FileNotFoundError) as e:
+            logger.warning(f"Reference store {store} is unreadable ({e}), recompiling")
+    tables = build_growth_database(datapath)
+    compile_reference_store(tables, store, sources=sources)
+    tables, version = _load(store)
+    _notify_reload(version)
+    return tables
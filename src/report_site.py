@@ -0,0 +1,286 @@
+# Static report site for many children.
+#
+# `plot_subplot_growth_percentiles` writes one self-contained html per child, each with its
+# own copy of plotly.js (~4.8MB) and of the reference curves. The site instead has:
+#   index.html, assets/        one page and script bundle, plotly.js written once per version
+#   reference/<sex>_<col>.js   the percentile curves of one sex and metric, shared by all children
+#   children/<id>.js           the scored measurements of one child, fetched when it is opened
+#   children.js                the list of children shown by the page
+# so the output grows with the number of measurements, not with the number of children.
+# The data files are JSON wrapped in a `GrowthSite.receive(...)` call and loaded with script
+# tags, so the site also works opened from disk, where browsers block fetch() of file:// urls.
+import re
+import json
+import hashlib
+from pathlib import Path
+from typing import Dict, Iterable, List
+
+import numpy as np
+import pandas as pd
+import plotly
+from plotly.offline import get_plotlyjs
+
+from src import logger
+from src.database import Child
+from src.plot import MAX_POINTS, MAX_TABLE_ROWS, PERCENTILE_COLUMNS, SUBPLOT_METRICS, reference_curves
+
+
+PLOTLY_JS = f'plotly-{plotly.__version__}.min.js'
+## decimals kept in the data files
+DECIMALS = 2
+
+
+def child_id(name: str) -> str:
+    """File name safe id, e.g. of the export file stem"""
+    return re.sub(r'[^A-Za-z0-9_.-]+', '_', name).strip('._') or 'child'
+
+
+def child_ids(names: Iterable[str]) -> Dict[str, str]:
+    """A distinct `child_id` for every name. Names whose ids collide ('emma 1' and 'emma_1', or ids
+    only differing in case, one file on case-insensitive file systems) get a short hash of the
+    name appended, except the name that is already its own id, so ids do not depend on the other names"""
+    groups = {}
+    for name in sorted(set(names)):
+        groups.setdefault(child_id(name).lower(), []).append(name)
+    ids = {}
+    for group in groups.values():
+        ## the name that needs no sanitizing keeps the plain id
+        group.sort(key=lambda name: child_id(name) != name)
+        for i, name in enumerate(group):
+            ids[name] = child_id(name) if i == 0 else f'{child_id(name)}-{hashlib.sha1(name.encode()).hexdigest()[:8]}'
+    return ids
+
+
+def _column(values: pd.Series, decimals: int = DECIMALS) -> list:
+    values = pd.to_numeric(values, errors='coerce').to_numpy(dtype='float64', na_value=np.nan).round(decimals)
+    return [None if np.isnan(v) else v for v in values.tolist()]  ## NaN is not valid JSON
+
+
+def child_data(df: pd.DataFrame, child: Child) -> dict:
+    """The scored measurements of a child as columns, sorted by age: date, months and the value
+    and percentile of every charted metric that is in `df`"""
+    df = df.sort_values('months', kind='stable')
+    columns = {'date': pd.to_datetime(df['date']).dt.strftime('%Y-%m-%d %H:%M').fillna('').tolist() if 'date' in df.columns else [],
+               'months': _column(df['months'])}
+    for ycol, pcol in PERCENTILE_COLUMNS.items():
+        for col in (ycol, pcol):
+            if col in df.columns:
+                columns[col] = _column(df[col])
+    return {'name': child.name, 'sex': child.gender, 'dob': child.dob.strftime('%Y-%m-%d'),
+            'rows': len(df), 'columns': columns}
+
+
+def _script(key: str, data) -> str:
+    return f'GrowthSite.receive({json.dumps(key)}, {json.dumps(data, separators=(",", ":"), allow_nan=False)});\n'
+
+
+def _write(path: Path, text: str):
+    tmp = path.with_name(path.name + '.tmp')
+    tmp.write_text(text, encoding='utf-8')
+    tmp.replace(path)
+
+
+class ReportSite:
+    """Static site with the growth charts of many children.
+
+    Write the shared files once with `write_shared`, every child with `write_child` (safe to
+    call from several threads or processes) and the list of children with `write_index`.
+
+    Args:
+        root (Path): Site directory, open `root/index.html` in a browser.
+    """
+    def __init__(self, root: Path):
+        self.root = Path(root)
+
+    def write_shared(self, growth_tables: dict):
+        """The page, the scripts and the reference curves of every sex and metric"""
+        for sub in ('assets', 'reference', 'children'):
+            (self.root / sub).mkdir(parents=True, exist_ok=True)
+        plotly_js = self.root / 'assets' / PLOTLY_JS
+        if not plotly_js.exists():  ## versioned name: written once, cached by the browser
+            _write(plotly_js, get_plotlyjs())
+        _write(self.root / 'assets' / 'site.js', SITE_JS.replace('__MAX_POINTS__', str(MAX_POINTS))
+               .replace('__MAX_TABLE_ROWS__', str(MAX_TABLE_ROWS)))
+        _write(self.root / 'index.html', INDEX_HTML.replace('__PLOTLY_JS__', PLOTLY_JS))
+        reference = reference_curves(growth_tables)
+        for sex, curves in reference['curves'].items():
+            for ycol, curve in curves.items():
+                curve = {k: [round(v, 3) for v in values] for k, values in curve.items()}
+                _write(self.root / 'reference' / f'{sex}_{ycol}.js', _script(f'reference/{sex}_{ycol}', curve))
+        _write(self.root / 'assets' / 'labels.js', _script('assets/labels', {
+            'metrics': {ycol: reference['labels'][ycol] for ycol in SUBPLOT_METRICS},
+            'percentile_columns': reference['percentile_columns'],
+            'colors': reference['colors'],
+        }))
+
+    def write_child(self, key: str, df: pd.DataFrame, child: Child) -> dict:
+        """Write the data file of a child and return its entry for `write_index`"""
+        data = child_data(df, child)
+        _write(self.root / 'children' / f'{key}.js', _script(f'children/{key}', data))
+        months = [m for m in data['columns']['months'] if m is not None]
+        return {'id': key, 'name': child.name, 'sex': child.gender, 'dob': data['dob'],
+                'rows': data['rows'], 'last_months': months[-1] if months else None}
+
+    def write_index(self, entries: List[dict]):
+        entries = sorted(entries, key=lambda e: (e['name'].lower(), e['id']))
+        _write(self.root / 'children.js', _script('children', entries))
+        logger.info(f"Report site of {len(entries)} children written to {self.root / 'index.html'}")
+
+    def write(self, children: Dict[str, tuple], growth_tables: dict):
+        """Write a whole site from {id: (scored frame, Child)}"""
+        self.write_shared(growth_tables)
+        self.write_index([self.write_child(key, df, child) for key, (df, child) in children.items()])
+
+
+INDEX_HTML = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>Growth charts</title>
+<style>
+  body { font-family: sans-serif; margin: 0; display: flex; height: 100vh; }
+  #sidebar { width: 260px; border-right: 1px solid #ddd; display: flex; flex-direction: column; }
+  #filter { margin: 8px; padding: 4px; }
+  #children { list-style: none; margin: 0; padding: 0; overflow-y: auto; flex: 1; }
+  #children li { padding: 4px 8px; cursor: pointer; }
+  #children li:hover, #children li.selected { background: #eef; }
+  #children small { color: #888; }
+  #main { flex: 1; overflow-y: auto; padding: 8px 16px; }
+  #charts { display: grid; grid-template-columns: 1fr 1fr; gap: 8px; }
+  #charts > div { height: 360px; }
+  table { border-collapse: collapse; font-size: 12px; margin-top: 12px; }
+  td, th { border: 1px solid #ddd; padding: 2px 8px; text-align: right; }
+</style>
+<script src="assets/__PLOTLY_JS__"></script>
+<script src="assets/site.js"></script>
+</head>
+<body>
+<div id="sidebar">
+  <input id="filter" placeholder="Filter children">
+  <ul id="children"></ul>
+</div>
+<div id="main">
+  <h2 id="title">Select a child</h2>
+  <div id="charts"></div>
+  <div id="table"></div>
+</div>
+<script>GrowthSite.start();</script>
+</body>
+</html>
+"""
+
+
+SITE_JS = """// Growth report site: loads the data files on demand and draws the charts.
+const GrowthSite = (function() {
+  const MAX_POINTS = __MAX_POINTS__, MAX_TABLE_ROWS = __MAX_TABLE_ROWS__;
+  const loaded = {}, waiting = {};
+  let labels = null, children = [];
+
+  // data files call GrowthSite.receive(key, data); every file is requested once
+  function load(key) {
+    if (!loaded[key]) {
+      loaded[key] = new Promise(function(resolve, reject) {
+        waiting[key] = resolve;
+        const script = document.createElement('script');
+        script.src = key + '.js';
+        script.onerror = function() { delete loaded[key]; reject(new Error('Cannot load ' + key)); };
+        document.head.appendChild(script);
+      });
+    }
+    return loaded[key];
+  }
+
+  function receive(key, data) {
+    if (waiting[key]) { waiting[key](data); delete waiting[key]; }
+  }
+
+  function listChildren() {
+    const filter = document.getElementById('filter').value.toLowerCase();
+    const list = document.getElementById('children');
+    list.innerHTML = '';
+    children.filter(c => c.name.toLowerCase().includes(filter) || c.id.toLowerCase().includes(filter)).forEach(function(c) {
+      const li = document.createElement('li'), small = document.createElement('small');
+      small.textContent = ' ' + c.id + ', ' + c.rows + ' rows';
+      li.append(c.name, small);
+      li.onclick = function() { location.hash = c.id; };
+      if (location.hash.slice(1) === c.id) li.className = 'selected';
+      list.appendChild(li);
+    });
+  }
+
+  function column(data, name) { return data.columns[name] || []; }
+
+  function drawChart(div, metric, data, ref) {
+    const months = column(data, 'months'), values = column(data, metric), pcol = labels.percentile_columns[metric];
+    const pct = column(data, pcol), dates = column(data, 'date');
+    const idx = months.map((m, i) => i).filter(i => values[i] !== null && values[i] !== 0 && months[i] !== null);
+    const maxMonths = idx.length ? Math.max(6, months[idx[idx.length - 1]] * 1.1) : 60;
+    const traces = [];
+    if (ref) {
+      const keep = ref.months.map(m => m <= maxMonths);
+      Object.keys(labels.colors).forEach(function(p) {
+        traces.push({x: ref.months.filter((m, i) => keep[i]), y: ref[p].filter((v, i) => keep[i]),
+                     mode: 'lines', name: p + 'th', hoverinfo: 'name+y', line: {width: 1, color: labels.colors[p]}});
+      });
+    }
+    traces.push({
+      type: idx.length > MAX_POINTS ? 'scattergl' : 'scatter',
+      x: idx.map(i => months[i]), y: idx.map(i => values[i]),
+      text: idx.map(i => dates[i] + (pct[i] !== null && pct[i] !== undefined ? ' (' + pct[i] + '%)' : '')),
+      mode: 'markers', name: 'Subject', marker: {size: 5, color: 'red'}
+    });
+    Plotly.react(div, traces, {title: labels.metrics[metric] + ' growth percentiles', showlegend: false,
+                               margin: {t: 40, r: 10, b: 40, l: 50}, xaxis: {title: 'Age (months)'}});
+  }
+
+  // last measurement of every month of age, latest months first
+  function drawTable(data) {
+    const months = column(data, 'months'), byMonth = {};
+    months.forEach(function(m, i) { if (m !== null) byMonth[Math.floor(m)] = i; });
+    const rows = Object.keys(byMonth).map(Number).sort((a, b) => b - a).slice(0, MAX_TABLE_ROWS).map(m => byMonth[m]);
+    const metrics = Object.keys(labels.metrics);
+    let html = '<table><tr><th>Date</th><th>Month</th>' + metrics.map(m => '<th>' + labels.metrics[m] + '</th><th>%</th>').join('') + '</tr>';
+    rows.forEach(function(i) {
+      html += '<tr><td>' + column(data, 'date')[i] + '</td><td>' + months[i] + '</td>' + metrics.map(function(m) {
+        const v = column(data, m)[i], p = column(data, labels.percentile_columns[m])[i];
+        return '<td>' + (v === null || v === undefined ? '' : v) + '</td><td>' + (p === null || p === undefined ? '' : p) + '</td>';
+      }).join('') + '</tr>';
+    });
+    document.getElementById('table').innerHTML = html + '</table>';
+  }
+
+  function show(id) {
+    const entry = children.find(c => c.id === id);
+    if (!entry) return;
+    listChildren();
+    document.getElementById('title').textContent = 'Growth percentiles for ' + entry.name + ' (' + entry.id + ')';
+    const metrics = Object.keys(labels.metrics);
+    // the reference files of a sex are loaded once and shared by all its children
+    Promise.all([load('children/' + id)].concat(metrics.map(m => load('reference/' + entry.sex + '_' + m).catch(() => null))))
+      .then(function(results) {
+        const data = results[0], charts = document.getElementById('charts');
+        charts.innerHTML = '';
+        metrics.forEach(function(metric, i) {
+          const div = document.createElement('div');
+          charts.appendChild(div);
+          drawChart(div, metric, data, results[i + 1]);
+        });
+        drawTable(data);
+      })
+      .catch(function(e) { document.getElementById('title').textContent = e.message; });
+  }
+
+  function start() {
+    Promise.all([load('assets/labels'), load('children')]).then(function(results) {
+      labels = results[0];
+      children = results[1];
+      document.getElementById('filter').oninput = listChildren;
+      window.onhashchange = function() { show(location.hash.slice(1)); };
+      listChildren();
+      if (location.hash) show(location.hash.slice(1));
+    });
+  }
+
+  return {receive: receive, start: start};
+})();
+"""
@@ -0,0 +1,112 @@
+# Content-addressed cache of scored `growth` results.
+#
+# A result is stored under a key made of everything it depends on: the content of the
+# input files, the child's DOB and gender, the options that change the rows, the version
+# of the code in src/ and the version of the reference tables. The cached rows are computed
+# entirely in src/ (`merge.score_exports`), so the code version covers every module they
+# depend on and main.py only decides where they are written. Re-running `growth` on an
+# unchanged export goes straight to the output and the chart. Entries are evicted least
+# recently used first once the cache is over its size limit.
+import os
+import json
+import hashlib
+from pathlib import Path
+from typing import Iterable, Optional
+
+import pandas as pd
+
+from src import logger
+
+
+CACHE_DIR = Path('.cache') / 'growth'
+MAX_CACHE_BYTES = 256 * 1024 * 1024
+
+_CODE_VERSION = None
+
+
+def code_version() -> str:
+    """Hash of the python sources in src/, the modules the cached results are computed by.
+    Any change to them invalidates the cache"""
+    global _CODE_VERSION
+    if _CODE_VERSION is None:
+        digest = hashlib.sha1()
+        for path in sorted(Path(__file__).parent.glob('*.py')):
+            digest.update(path.name.encode())
+            digest.update(path.read_bytes())
+        _CODE_VERSION = digest.hexdigest()[:16]
+    return _CODE_VERSION
+
+
+def file_digest(path: Path, chunk_size: int = 1 << 20) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def result_key(files: Iterable[Path], reference: str, **params) -> str:
+    """Cache key of a result: the input contents (in order), the reference version,
+    the code version and the parameters, e.g. dob, gender and the merge options"""
+    parts = {
+        'files': [file_digest(f) for f in files],
+        'reference': reference,
+        'code': code_version(),
+        'params': {k: str(v) for k, v in sorted(params.items())},
+    }
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()
+
+
+class ResultCache:
+    """Scored frames on disk, one pickle per key.
+
+    Args:
+        root (Path): Cache directory.
+        max_bytes (int): Size above which the least recently used entries are removed.
+    """
+    def __init__(self, root: Path = CACHE_DIR, max_bytes: int = MAX_CACHE_BYTES):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+
+    def _path(self, key: str) -> Path:
+        return self.root / f'{key}.pkl'
+
+    def get(self, key: str) -> Optional[pd.DataFrame]:
+        path = self._path(key)
+        if not path.exists():
+            return None
+        try:
+            df = pd.read_pickle(path)
+        except Exception as e:
+            logger.warning(f"Unreadable cache entry {path.name} ({e}), removing it")
+            path.unlink(missing_ok=True)
+            return None
+        os.utime(path)  ## recently used, evicted last
+        return df
+
+    def put(self, key: str, df: pd.DataFrame):
+        self.root.mkdir(parents=True, exist_ok=True)
+        tmp = self._path(key).with_suffix('.tmp')
+        df.to_pickle(tmp)
+        tmp.replace(self._path(key))
+        self.evict()
+
+    def size(self) -> int:
+        return sum(p.stat().st_size for p in self.root.glob('*.pkl')) if self.root.exists() else 0
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits in `max_bytes`"""
+        if not self.root.exists():
+            return
+        entries = sorted(((p.stat().st_mtime, p.stat().st_size, p) for p in self.root.glob('*.pkl')), key=lambda e: e[0])
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            path.unlink(missing_ok=True)
+            total -= size
+            logger.debug(f"Evicted {path.name} from the result cache")
+
+    def clear(self):
+        for path in self.root.glob('*.pkl'):
+            path.unlink(missing_ok=True)
@@ -0,0 +1,141 @@
+# Growth velocity and trajectory analytics on the scored output of `percentile`.
+#
+# Everything is computed per child between consecutive valid measurements of a metric:
+# velocity (units per month), the number of major centile lines crossed, and a
+# conditional z-score of the new measurement given the previous one.
+# `update_trajectory` carries the last observation of each child forward, so nightly runs
+# only need the newest rows instead of the full history.
+from typing import Tuple, Iterable
+
+import numpy as np
+import pandas as pd
+from scipy.stats import norm
+
+from src.ingest_csv import METRICS
+
+
+## z-scores of the major centile lines: 0.4th, 2nd, 9th, 25th, 50th, 75th, 91st, 98th, 99.6th
+MAJOR_CENTILES = [0.4, 2, 9, 25, 50, 75, 91, 98, 99.6]
+MAJOR_CENTILE_Z = norm.ppf(np.array(MAJOR_CENTILES) / 100)
+
+## correlation between consecutive z-scores used for the conditional z-score.
+## It depends on age and interval in reality; pass a value estimated for your population.
+DEFAULT_CORRELATION = 0.9
+
+## crossing this many major centile lines downwards between two visits is flagged
+DEFAULT_DROP_LINES = 2
+
+STATE_FLAG = '_trajectory_state'
+
+## scored against length/height, not age: the change per month of their value column
+## (weight_kg) is the weight velocity, so they only get the z-score based columns
+LENGTH_INDEXED_METRICS = {'wflh'}
+
+
+def _child_key(df: pd.DataFrame, child_col: str) -> pd.Series:
+    if child_col in df.columns:
+        return df[child_col]
+    return pd.Series('child', index=df.index)
+
+
+def _centile_band(z: np.ndarray) -> np.ndarray:
+    """Index of the band between major centile lines that each z-score falls in"""
+    return np.searchsorted(MAJOR_CENTILE_Z, z, side='right').astype('float64')
+
+
+def growth_trajectory(df: pd.DataFrame, child_col: str = 'child', metrics: Iterable[str] = None,
+            correlation: float = DEFAULT_CORRELATION, drop_lines: int = DEFAULT_DROP_LINES) -> pd.DataFrame:
+    """Return the velocity, centile crossing and conditional growth columns for each row.
+
+    The input is the output of `percentile` (columns `months`, the value columns and
+    `<metric>_zscore`), optionally with a `child_col` column holding several children.
+    For each metric the following columns are added, all NaN on the first valid
+    measurement of a child:
+        <metric>_velocity        change in value per month since the previous measurement
+        <metric>_centiles_crossed signed number of major centile lines crossed
+        <metric>_centile_drop    True when at least `drop_lines` lines were crossed downwards
+        <metric>_conditional_z   (z - r * z_prev) / sqrt(1 - r^2)
+    Length-indexed metrics (weight-for-length/height) have no velocity column.
+    """
+    metrics = list(metrics or METRICS)
+    out = df.reset_index(drop=True)
+    out['_child'] = _child_key(out, child_col).to_numpy()
+    out = out.sort_values(['_child', 'months'], kind='stable')
+    scale = np.sqrt(1 - correlation ** 2)
+
+    for name in metrics:
+        col = METRICS[name][0]
+        zcol = f'{name}_zscore'
+        if col not in out.columns or zcol not in out.columns:
+            continue
+        value = pd.to_numeric(out[col], errors='coerce')
+        valid = value.notna() & out[zcol].notna() & (value != 0)
+        obs = pd.DataFrame({
+            'child': out.loc[valid, '_child'],
+            'months': out.loc[valid, 'months'].astype('float64'),
+            'value': value[valid].astype('float64'),
+            'z': out.loc[valid, zcol].astype('float64'),
+        })
+        prev = obs.groupby('child', sort=False)[['months', 'value', 'z']].shift(1)
+
+        if name not in LENGTH_INDEXED_METRICS:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                velocity = (obs['value'] - prev['value']) / (obs['months'] - prev['months'])
+            out[f'{name}_velocity'] = velocity.where(np.isfinite(velocity))
+        crossed = _centile_band(obs['z'].to_numpy()) - _centile_band(prev['z'].to_numpy())
+        crossed[prev['z'].isna().to_numpy()] = np.nan
+
+        out[f'{name}_centiles_crossed'] = pd.Series(crossed, index=obs.index)
+        out[f'{name}_centile_drop'] = out[f'{name}_centiles_crossed'] <= -drop_lines
+        out[f'{name}_conditional_z'] = (obs['z'] - correlation * prev['z']) / scale
+
+    out = out.drop(columns='_child').sort_index()
+    out.index = df.index
+    return out
+
+
+def trajectory_state(df: pd.DataFrame, child_col: str = 'child', metrics: Iterable[str] = None) -> pd.DataFrame:
+    """Return the last valid measurement of each child for each metric.
+    This is all `update_trajectory` needs to carry forward between runs."""
+    metrics = list(metrics or METRICS)
+    df = df.assign(**{child_col: _child_key(df, child_col).to_numpy()})
+    rows = []
+    for name in metrics:
+        col = METRICS[name][0]
+        zcol = f'{name}_zscore'
+        if col not in df.columns or zcol not in df.columns:
+            continue
+        value = pd.to_numeric(df[col], errors='coerce')
+        valid = df[value.notna() & (value != 0) & df[zcol].notna()]
+        last = valid.sort_values('months', kind='stable').groupby(child_col, sort=False).tail(1)
+        rows.append(last[[child_col, 'months', col, zcol]])
+    if not rows:
+        return pd.DataFrame(columns=[child_col, 'months'])
+    return pd.concat(rows, ignore_index=True)
+
+
+def update_trajectory(state: pd.DataFrame, new_rows: pd.DataFrame, child_col: str = 'child',
+            **kwargs) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """Compute the trajectory columns for `new_rows` only, continuing from `state`.
+
+    `state` is the result of `trajectory_state` (or of a previous `update_trajectory`),
+    and may be empty on the first run. Returns the scored new rows and the updated state.
+    Keyword arguments are passed to `growth_trajectory`.
+    """
+    new_rows = new_rows.assign(**{child_col: _child_key(new_rows, child_col).to_numpy(), STATE_FLAG: False})
+    if state is not None and len(state):
+        children = new_rows[child_col].unique()
+        carried = state[state[child_col].isin(children)].assign(**{STATE_FLAG: True})
+        combined = pd.concat([carried, new_rows], ignore_index=True)
+    else:
+        combined = new_rows.reset_index(drop=True)
+
+    scored = growth_trajectory(combined, child_col=child_col, **kwargs)
+    result = scored[~scored[STATE_FLAG].astype(bool)].drop(columns=STATE_FLAG)
+    result.index = new_rows.index
+
+    new_state = trajectory_state(scored.drop(columns=STATE_FLAG), child_col=child_col, metrics=kwargs.get('metrics'))
+    if state is not None and len(state):
+        untouched = state[~state[child_col].isin(new_rows[child_col].unique())]
+        new_state = pd.concat([untouched, new_state], ignore_index=True)
+    return result, new_state
@@ -0,0 +1,104 @@
+# Plausibility checks on scored measurements.
+#
+# Applies the WHO biologically implausible value (BIV) cut-offs used by WHO Anthro / igrowup
+# and a within-child jump check, all vectorized. Results are returned as boolean flag
+# columns plus a count table, nothing is printed per row.
+## https://www.who.int/tools/child-growth-standards/software
+from typing import Dict, Tuple, Iterable
+
+import numpy as np
+import pandas as pd
+
+from src import logger
+from src.ingest_csv import METRICS
+
+
+## metric name: (lowest plausible z-score, highest plausible z-score)
+BIV_LIMITS: Dict[str, Tuple[float, float]] = {
+    'weight': (-6, 5),   ## WAZ
+    'height': (-6, 6),   ## HAZ / LAZ
+    'bmi': (-5, 5),      ## BAZ
+    'hc': (-5, 5),       ## HCZ
+    'wflh': (-5, 5),     ## WHZ / WLZ
+}
+
+## change in z-score between consecutive measurements of a child that is flagged as a jump
+DEFAULT_MAX_Z_JUMP = 3.0
+## length/height loss between consecutive measurements (cm) that is flagged as a jump
+DEFAULT_MAX_HEIGHT_LOSS = 1.5
+
+FLAGS = ['invalid', 'biv', 'jump']
+
+
+def flag_plausibility(df: pd.DataFrame, child_col: str = 'child', metrics: Iterable[str] = None,
+            max_z_jump: float = DEFAULT_MAX_Z_JUMP, max_height_loss: float = DEFAULT_MAX_HEIGHT_LOSS) -> pd.DataFrame:
+    """Adds boolean flag columns to the output of `percentile`.
+
+    For each metric:
+        <metric>_invalid  a value was recorded but could not be scored (non-numeric,
+                          negative, or age outside the reference tables)
+        <metric>_biv      the z-score is outside the WHO BIV cut-offs in `BIV_LIMITS`
+        <metric>_jump     the z-score moved more than `max_z_jump` since the child's previous
+                          valid measurement (for height also a loss over `max_height_loss` cm)
+    and `flagged`, True when any flag is set on the row.
+    """
+    metrics = list(metrics or METRICS)
+    df = df.copy()
+    child = df[child_col] if child_col in df.columns else pd.Series('child', index=df.index)
+    months = df['months'].astype('float64')
+    order = np.lexsort((months.to_numpy(), child.astype(str).to_numpy()))
+    flagged = pd.Series(False, index=df.index)
+
+    for name in metrics:
+        col = METRICS[name][0]
+        zcol = f'{name}_zscore'
+        if col not in df.columns or zcol not in df.columns:
+            continue
+        raw = df[col]
+        value = pd.to_numeric(raw, errors='coerce')
+        z = df[zcol].astype('float64')
+        recorded = raw.notna() & (value != 0)
+        if name == 'wflh':  ## needs a length/height as well as a weight
+            recorded &= pd.to_numeric(df.get('height_cm', pd.Series(np.nan, index=df.index)), errors='coerce').fillna(0) != 0
+        low, high = BIV_LIMITS.get(name, (-np.inf, np.inf))
+
+        df[f'{name}_invalid'] = recorded & z.isna()
+        df[f'{name}_biv'] = (z < low) | (z > high)
+
+        ## previous valid measurement of the same child, in age order
+        ## positional, the index may have duplicate labels after concatenating exports
+        valid = (z.notna() & ~df[f'{name}_biv']).to_numpy()
+        pos = order[valid[order]]
+        obs = pd.DataFrame({'child': child.to_numpy()[pos], 'z': z.to_numpy()[pos], 'value': value.to_numpy(dtype='float64', na_value=np.nan)[pos]})
+        prev = obs.groupby('child', sort=False)[['z', 'value']].shift(1)
+        jump = (obs['z'] - prev['z']).abs() > max_z_jump
+        if name == 'height':
+            jump |= (prev['value'] - obs['value']) > max_height_loss
+        flags = np.zeros(len(df), dtype=bool)
+        flags[pos] = jump.to_numpy()
+        df[f'{name}_jump'] = flags
+
+        flagged |= df[f'{name}_invalid'] | df[f'{name}_biv'] | df[f'{name}_jump']
+
+    df['flagged'] = flagged
+    return df
+
+
+def flag_summary(df: pd.DataFrame) -> pd.DataFrame:
+    """Return the number of flagged rows per metric (rows) and flag (columns)"""
+    counts = {}
+    for name in METRICS:
+        if f'{name}_biv' not in df.columns:
+            continue
+        counts[name] = {flag: int(df[f'{name}_{flag}'].sum()) for flag in FLAGS}
+    return pd.DataFrame.from_dict(counts, orient='index', columns=FLAGS)
+
+
+def log_flag_summary(df: pd.DataFrame) -> pd.DataFrame:
+    """Log one line with the flag counts and return the summary table"""
+    summary = flag_summary(df)
+    total = int(df['flagged'].sum()) if 'flagged' in df.columns else 0
+    if total:
+        counts = ', '.join(f'{name} {flag}={n}' for name, row in summary.iterrows() for flag, n in row.items() if n)
+        logger.warning(f"{total} of {len(df)} rows flagged as implausible: {counts}")
+    return summary
@@ -0,0 +1,231 @@
+# Watch-folder ingest: score new rows of exports dropped into a directory.
+#
+# Files are polled; a file is only read when its size or mtime changed, and only
+# processed when its content hash changed too. Exports are cumulative, so each file
+# keeps the hashes of the rows already scored and only the new rows go through the
+# readers. The hashes are taken on the raw text of the rows, before the readers drop empty
+# columns or infer types, so a later export filling a new column does not change them. The scored rows are appended to the child's output csv and the child's
+# chart is re-rendered. The reference tables are loaded once for the whole session.
+import io
+import json
+import time
+import hashlib
+from fnmatch import fnmatch
+from pathlib import Path
+from dataclasses import dataclass, asdict
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from src import logger
+from src.database import Child
+from src.ingest_csv import percentile, resolve_format
+from src.validation import flag_plausibility, log_flag_summary
+from src.reference_store import shared_growth_database
+from src.plot import plot_subplot_growth_percentiles
+
+
+STATE_DIR = '.watch'
+DEFAULT_INTERVAL = 2.0
+
+
+@dataclass
+class ChildConfig:
+    """Which child an export belongs to.
+    Args:
+        pattern (str): glob matched against the file name, e.g. 'emma*.csv'
+        name, dob, gender: as for Child
+        format (str): the registered export format (src.ingest_csv.FORMATS), detected from the header if not set
+    """
+    pattern: str
+    name: str
+    dob: str
+    gender: str
+    format: Optional[str] = None
+
+
+@dataclass
+class FileState:
+    size: int
+    mtime_ns: int
+    sha256: str
+    rows: int = 0
+
+
+def load_children(path: Path) -> List[ChildConfig]:
+    """Read the json list of ChildConfig entries"""
+    with open(path, 'r') as f:
+        entries = json.load(f)
+    for d in entries:
+        ## older children files mark huckleberry exports with a flag
+        if d.pop('huckleberry', False):
+            d.setdefault('format', 'huckleberry')
+    return [ChildConfig(**d) for d in entries]
+
+
+def match_child(file: Path, children: List[ChildConfig]) -> Optional[ChildConfig]:
+    """The first child whose pattern matches the file name"""
+    for config in children:
+        if fnmatch(file.name, config.pattern):
+            return config
+    return None
+
+
+def file_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def read_text(source) -> pd.DataFrame:
+    """Every cell of a csv file (path or buffer) as the text in the file, '' for empty cells"""
+    return pd.read_csv(source, dtype=str, keep_default_na=False)
+
+
+def row_hashes(df: pd.DataFrame) -> np.ndarray:
+    """A hash of the non-empty cells of each row of `read_text`, with their column names.
+    Independent of the row's position, of the column order and of columns empty in the row"""
+    key = pd.Series('', index=df.index, dtype=object)
+    for col in sorted(df.columns):
+        cells = df[col].astype(str)
+        key += np.where(cells == '', '', f'{col}\x1f' + cells + '\x1e')
+    return pd.util.hash_pandas_object(key, index=False).to_numpy()
+
+
+class FolderWatcher:
+    """Polls `directory` and scores the new rows of changed exports.
+
+    Args:
+        directory (Path): The folder the exports are dropped into.
+        children (List[ChildConfig]): Maps file names to children.
+        savepath (Path): Where the per-child csv, charts and the watch state are written.
+        growth_tables (dict): Reference tables, loaded once if not given.
+        render (bool): Re-render the child's chart after new rows were scored.
+    """
+    def __init__(self, directory: Path, children: List[ChildConfig], savepath: Path,
+                 growth_tables: dict = None, render: bool = True):
+        self.directory = Path(directory)
+        self.children = children
+        self.savepath = Path(savepath)
+        self.render = render
+        self.growth_tables = growth_tables if growth_tables is not None else shared_growth_database()
+        self.state_dir = self.savepath / STATE_DIR
+        self.state_dir.mkdir(parents=True, exist_ok=True)
+        self.state: Dict[str, FileState] = self._load_state()
+
+    def _state_file(self) -> Path:
+        return self.state_dir / 'files.json'
+
+    def _load_state(self) -> Dict[str, FileState]:
+        if not self._state_file().exists():
+            return {}
+        with open(self._state_file(), 'r') as f:
+            return {name: FileState(**d) for name, d in json.load(f).items()}
+
+    def _save_state(self):
+        tmp = self._state_file().with_suffix('.tmp')
+        with open(tmp, 'w') as f:
+            json.dump({name: asdict(s) for name, s in self.state.items()}, f, indent=2)
+        tmp.replace(self._state_file())
+
+    def _hashes_file(self, name: str) -> Path:
+        return self.state_dir / f'{name}.rows.npy'
+
+    def child_for(self, file: Path) -> Optional[ChildConfig]:
+        return match_child(file, self.children)
+
+    def changed_files(self) -> List[Path]:
+        """Files whose size or mtime differ from the last time they were processed"""
+        changed = []
+        for file in sorted(self.directory.glob('*.csv')):
+            stat = file.stat()
+            known = self.state.get(file.name)
+            if known is None or known.size != stat.st_size or known.mtime_ns != stat.st_mtime_ns:
+                changed.append(file)
+        return changed
+
+    def process(self, file: Path) -> int:
+        """Score the new measurement rows of one file. Returns the number of new measurements"""
+        stat = file.stat()
+        data = file.read_bytes()  ## read once: hashed, sniffed and parsed from memory
+        digest = file_hash(data)
+        known = self.state.get(file.name)
+        if known is not None and known.sha256 == digest:
+            ## touched but not modified
+            self.state[file.name] = FileState(stat.st_size, stat.st_mtime_ns, digest, known.rows)
+            return 0
+
+        config = self.child_for(file)
+        if config is None:
+            logger.warning(f"No child matches {file.name}, add it to the children file")
+            self.state[file.name] = FileState(stat.st_size, stat.st_mtime_ns, digest, 0)
+            return 0
+
+        child = Child(config.name, config.gender, config.dob)
+        fmt = resolve_format(config.format, data)
+        text = read_text(io.BytesIO(data))
+        hashes = row_hashes(text)
+        seen_file = self._hashes_file(file.name)
+        seen = np.load(seen_file) if seen_file.exists() else np.empty(0, dtype=hashes.dtype)
+        new = ~np.isin(hashes, seen)
+        n_new = 0
+        if new.any():
+            raw = pd.read_csv(io.BytesIO(data))  ## the same rows, with the types the readers expect
+            ## only the measurement rows are new measurements, e.g. not the feeds of a huckleberry export
+            rows = fmt.frame(raw.loc[new])
+            n_new = len(rows)
+            if n_new:
+                scored = percentile(fmt.parse(rows, child), child, self.growth_tables)
+                self._update_child(config, child, scored)
+                logger.info(f"{file.name}: scored {n_new} new rows for {child.name}")
+            np.save(seen_file, np.union1d(seen, hashes))
+        self.state[file.name] = FileState(stat.st_size, stat.st_mtime_ns, digest, len(text))
+        return n_new
+
+    def child_output(self, config: ChildConfig) -> Path:
+        return self.savepath / f'{config.name}_growth.csv'
+
+    def _update_child(self, config: ChildConfig, child: Child, scored: pd.DataFrame):
+        output = self.child_output(config)
+        if output.exists():
+            previous = pd.read_csv(output, parse_dates=['date'])
+            combined = pd.concat([previous, scored], ignore_index=True)
+            combined['gender'] = child.sex  ## outputs written before the column was added
+        else:
+            combined = scored
+        ## a measurement already in the output (e.g. hashed by an older version) is kept once, the new scores win
+        keys = combined[[c for c in ['weight_kg', 'height_cm', 'hc_cm'] if c in combined.columns]].round(2)
+        combined = combined[~keys.assign(date=combined['date']).duplicated(keep='last')]
+        combined = combined.sort_values('date', ascending=False, kind='stable').reset_index(drop=True)
+        ## the flags of older rows can depend on the new ones (jumps), so they are recomputed
+        flag_cols = [c for c in combined.columns if c.endswith(('_invalid', '_biv', '_jump')) or c == 'flagged']
+        combined = flag_plausibility(combined.drop(columns=flag_cols))
+        log_flag_summary(combined)
+        combined.round(2).to_csv(output, index=False)
+        if self.render:
+            plot_subplot_growth_percentiles(combined, child, self.growth_tables,
+                                            self.savepath / f'{config.name}.html', show=False)
+
+    def scan(self) -> int:
+        """Process every changed file once. Returns the number of new rows"""
+        total = 0
+        for file in self.changed_files():
+            try:
+                total += self.process(file)
+            except Exception as e:
+                ## a half-written or malformed export must not stop the watcher; it is retried when it changes
+                logger.error(f"Failed to process {file.name}: {e}")
+                stat = file.stat()
+                rows = self.state[file.name].rows if file.name in self.state else 0
+                self.state[file.name] = FileState(stat.st_size, stat.st_mtime_ns, '', rows)
+        self._save_state()
+        return total
+
+    def run(self, interval: float = DEFAULT_INTERVAL):
+        """Poll the folder until interrupted"""
+        logger.info(f"Watching {self.directory} every {interval}s, writing to {self.savepath}")
+        try:
+            while True:
+                self.scan()
+                time.sleep(interval)
+        except KeyboardInterrupt:
+            logger.info("Stopped watching")
@@ -1,24 +1,857 @@
 from src.calculations import ZscoreWeight, ZscoreHeight, interpolate_lms
-from src.database import Child, get_growth_table
+from src.database import Child, get_growth_table, lms_for_months
 import pandas as pd
 from pathlib import Path
 import unittest
+from unittest import mock
+import json
+import tempfile
+import re
+import base64
+import time
+import numpy as np
+from src.database import build_growth_database
+from src.reference_store import shared_growth_database, reference_version, store_version, compile_reference_store, load_reference_store, on_reload, _RELOAD_CALLBACKS
+from src.ingest_csv import zscores, percentile
+from src.trajectory import growth_trajectory, update_trajectory, MAJOR_CENTILE_Z
+from src.validation import flag_plausibility, flag_summary
+from src.plot import lttb, reference_curves, get_figure_template, clear_figure_templates, plot_subplot_growth_percentiles, MAX_FIGURE_TEMPLATES, _FIGURE_TEMPLATES
+from src.lms_cache import LMSCache, lms_cache, MAX_TABLE_VERSIONS
+from src.conformance import run_conformance, assert_conformance, check_golden, check_golden_tables
+from src.watcher import FolderWatcher, ChildConfig
+from src.ingest_csv import huckleberry_reader, standardize_reader, sniff_format, register_format, parse_export, InputFormat, FORMATS
+from src.jobs import JobQueue, job_key
+from src.population import PopulationSummary
+from src.pipeline import DirectoryPipeline
+from src.report_site import ReportSite, child_ids
+from src.result_cache import ResultCache, result_key
+from src.merge import combine_sources, merge_measurements, score_exports
+from src.ingest_polars import pl, reader_polars, frame_polars, _lazy_frame
+from src.console_output import print_growth, DEFAULT_ROWS
+from click.testing import CliRunner
+from main import cli
+import contextlib
+from rich.console import Console
+import io
 
 class TestZscoreWeight(unittest.TestCase):
     def test_zscore1(self):
         bmi = 30
         z = ZscoreWeight(-1.7862, 16.9392, 0.11070, bmi)
-        self.assertEqual(z.zscore(), 3.35)
+        self.assertAlmostEqual(z.zscore(), 3.35, delta=0.01)
 
     def test_zscore2(self):
         bmi = 14
         z = ZscoreWeight(-1.3529, 20.4951, 0.12579, bmi)
-        self.assertEqual(z.zscore(), -3.80)
+        self.assertAlmostEqual(z.zscore(), -3.80, delta=0.01)
 
     def test_zscore3(self):
         bmi = 19
         z = ZscoreWeight(-1.6318, 16.0490, 0.10038, bmi)
-        self.assertEqual(z.zscore(), 1.47)
+        self.assertAlmostEqual(z.zscore(), 1.47, delta=0.01)
+
+
+class TestZscoreHeight(unittest.TestCase):
+    def test_median_is_zero(self):
+        self.assertAlmostEqual(ZscoreHeight(1, 49.8842, 0.03795, 49.8842).zscore(), 0.0)
+
+    def test_no_tail_restriction(self):
+        ## L=1 is the normal distribution: z = (y - M) / (M * S)
+        L, M, S = 1, 50.0, 0.04
+        self.assertAlmostEqual(ZscoreHeight(L, M, S, 50.0 + 4.5 * M * S).zscore(), 4.5)
+
+
+class TestZscoreTails(unittest.TestCase):
+    def test_tails_use_sd23(self):
+        z = ZscoreWeight(-0.3521, 7.9340, 0.10958, 1)
+        sd3pos, sd2pos = z.sdx(3), z.sdx(2)
+        self.assertAlmostEqual(ZscoreWeight(z.L, z.M, z.S, sd3pos).zscore(), 3.0)
+        self.assertAlmostEqual(ZscoreWeight(z.L, z.M, z.S, sd3pos + (sd3pos - sd2pos)).zscore(), 4.0)
+        sd3neg, sd2neg = z.sdx(-3), z.sdx(-2)
+        self.assertAlmostEqual(ZscoreWeight(z.L, z.M, z.S, sd3neg - (sd2neg - sd3neg)).zscore(), -4.0)
+
+
+class TestInterpolateLMS(unittest.TestCase):
+    def setUp(self):
+        self.table = build_growth_database()['girls']['wfa'][(0, 5)]
+
+    def test_on_table_row(self):
+        L, M, S = interpolate_lms(5.0, self.table)
+        self.assertEqual((L, M, S), tuple(self.table.loc[5, ['L', 'M', 'S']]))
+
+    def test_between_rows(self):
+        L, M, S = interpolate_lms(5.5, self.table)
+        self.assertAlmostEqual(M, self.table.loc[[5, 6], 'M'].mean())
+
+    def test_first_month_is_rounded(self):
+        self.assertEqual(interpolate_lms(0.4, self.table), interpolate_lms(0, self.table))
+
+
+class TestConformance(unittest.TestCase):
+    def test_golden(self):
+        self.assertEqual(check_golden(), [])
+
+    def test_golden_tables(self):
+        tables = build_growth_database()
+        self.assertEqual(check_golden_tables(tables), [])
+        ## a lookup one row off, or in the height instead of the length table at 24 months, is caught
+        shifted = build_growth_database()
+        wfa = shifted['girls']['wfa'][(0, 5)]
+        shifted['girls']['wfa'][(0, 5)] = wfa.set_axis(wfa.index + 1)
+        self.assertTrue(any('wfa girls 12' in f for f in check_golden_tables(shifted)))
+        swapped = build_growth_database()
+        swapped['boys']['lhfa'][(0, 2)] = swapped['boys']['lhfa'][(0, 2)].copy()
+        swapped['boys']['lhfa'][(0, 2)].loc[24] = swapped['boys']['lhfa'][(2, 5)].loc[24]
+        self.assertTrue(any('lhfa boys 24' in f for f in check_golden_tables(swapped)))
+
+    def test_optimized_paths_match_scalar(self):
+        report = run_conformance(build_growth_database(), n_cases=200_000, n_scalar=1_000, seed=1)
+        assert_conformance(report)
+
+
+class TestReferenceStore(unittest.TestCase):
+    def test_store_matches_excel_tables(self):
+        tables = build_growth_database()
+        with tempfile.TemporaryDirectory() as tmp:
+            store = Path(tmp) / 'who_reference.npy'
+            shared = shared_growth_database(store=store)
+            self.assertEqual(store_version(store), reference_version(tables))
+            for gender in tables:
+                for metric in tables[gender]:
+                    for age_range, df in tables[gender][metric].items():
+                        mapped = shared[gender][metric][age_range]
+                        self.assertTrue((mapped.index == df.index).all())
+                        np.testing.assert_allclose(mapped[df.columns].to_numpy(), df.to_numpy())
+
+    def test_recompile_swaps_data_and_index_together(self):
+        tables = build_growth_database()
+        with tempfile.TemporaryDirectory() as tmp:
+            store = Path(tmp) / 'who_reference.npy'
+            compile_reference_store(tables, store)
+            old_version = store_version(store)
+            stale_index = (Path(tmp) / 'who_reference.json').read_text()
+            changed = {g: {m: dict(t) for m, t in tables[g].items()} for g in tables}
+            changed['girls']['wfa'][(0, 5)] = tables['girls']['wfa'][(0, 5)] * 1.01
+            compile_reference_store(changed, store)
+            self.assertNotEqual(store_version(store), old_version)
+            self.assertEqual([p.name for p in Path(tmp).glob('*.npy')], [f'who_reference.{store_version(store)}.npy'])
+            np.testing.assert_allclose(load_reference_store(store)['girls']['wfa'][(0, 5)]['M'],
+                                       changed['girls']['wfa'][(0, 5)]['M'])
+            ## a reader that read the old index gets the new one, never the old offsets with the new data
+            with mock.patch('src.reference_store._read_index', side_effect=[json.loads(stale_index), json.loads((Path(tmp) / 'who_reference.json').read_text())]):
+                mapped = load_reference_store(store)['girls']['wfa'][(0, 5)]
+            np.testing.assert_allclose(mapped['M'], changed['girls']['wfa'][(0, 5)]['M'])
+
+    def test_store_is_read_only(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            shared = shared_growth_database(store=Path(tmp) / 'who_reference.npy')
+            with self.assertRaises(ValueError):
+                shared['boys']['wfa'][(0, 5)].iloc[0, 0] = 1.0
+
+
+class TestTrajectory(unittest.TestCase):
+    def setUp(self):
+        df = pd.DataFrame({
+            'child': ['a'] * 4 + ['b'] * 3,
+            'months': [1.0, 2.0, 3.0, 4.0, 6.0, 7.0, 8.0],
+            'weight_kg': [4.5, 5.6, 6.4, 6.2, 7.9, 7.0, 8.4],
+            'height_cm': [54.0, None, 61.0, 63.0, 67.0, 68.0, 70.0],
+        })
+        df['bmi'] = df['weight_kg'] / (df['height_cm'] / 100) ** 2
+        self.df = zscores(df, Child('a', 'F', '2020-01-01'), build_growth_database())
+
+    def test_velocity(self):
+        res = growth_trajectory(self.df)
+        self.assertTrue(np.isnan(res.loc[0, 'weight_velocity']))
+        self.assertAlmostEqual(res.loc[1, 'weight_velocity'], 1.1)
+        self.assertAlmostEqual(res.loc[2, 'height_velocity'], 3.5)
+        self.assertTrue(np.isnan(res.loc[4, 'weight_velocity']))  ## first row of the second child
+        self.assertTrue(res.loc[5, 'weight_centile_drop'])
+
+    def test_incremental_matches_full(self):
+        full = growth_trajectory(self.df)
+        first, state = update_trajectory(None, self.df.iloc[[0, 1, 4]])
+        second, _ = update_trajectory(state, self.df.iloc[[2, 3, 5, 6]])
+        inc = pd.concat([first, second]).loc[full.index]
+        cols = [c for c in full.columns if c.endswith(('_velocity', '_crossed', '_conditional_z'))]
+        pd.testing.assert_frame_equal(inc[cols].astype(float), full[cols].astype(float))
+
+
+class TestValidation(unittest.TestCase):
+    def test_flags(self):
+        df = pd.DataFrame({
+            'months': [3.0, 3.1, 3.2, 3.3, 80.0],
+            'weight_kg': [5.5, 25.0, 5.6, 5.7, 12.0],
+            'height_cm': [60.0, 60.2, 56.0, 61.0, None],
+        })
+        df['bmi'] = df['weight_kg'] / (df['height_cm'] / 100) ** 2
+        df = flag_plausibility(zscores(df, Child('a', 'F', '2020-01-01'), build_growth_database()))
+        self.assertEqual(df['weight_biv'].tolist(), [False, True, False, False, False])
+        self.assertTrue(df.loc[2, 'height_jump'])          ## 4 cm shorter than the previous visit
+        self.assertTrue(df.loc[4, 'weight_invalid'])       ## older than the WHO tables
+        self.assertEqual(df['flagged'].tolist(), [False, True, True, False, True])
+        self.assertEqual(flag_summary(df).loc['weight', 'biv'], 1)
+
+    def test_duplicate_index(self):
+        ## concatenated exports keep their own row labels
+        df = pd.DataFrame({'months': [3.0, 3.2], 'weight_kg': [5.5, 5.6], 'height_cm': [60.0, 56.0]})
+        df = pd.concat([df, df.assign(months=[3.1, 3.3])])
+        df['bmi'] = df['weight_kg'] / (df['height_cm'] / 100) ** 2
+        df = flag_plausibility(zscores(df, Child('a', 'F', '2020-01-01'), build_growth_database()))
+        self.assertEqual(df['height_jump'].tolist(), [False, True, False, False])
+
+
+class TestDownsample(unittest.TestCase):
+    def test_lttb_keeps_shape(self):
+        x = np.linspace(0, 60, 5000)
+        y = np.sin(x)
+        y[2500] = 10.0
+        idx = lttb(x, y, 200)
+        self.assertEqual(len(idx), 200)
+        self.assertEqual((idx[0], idx[-1]), (0, 4999))
+        self.assertIn(2500, idx)
+        self.assertTrue((np.diff(idx) > 0).all())
+
+    def test_lttb_short_series(self):
+        self.assertEqual(list(lttb([1, 2, 3], [1, 2, 3], 10)), [0, 1, 2])
+
+
+
+class TestFigureTemplate(unittest.TestCase):
+    def setUp(self):
+        clear_figure_templates()
+        self.tables = build_growth_database()
+
+    def test_template_reuse(self):
+        template = get_figure_template(self.tables, 'girls', [30.0, 40.0])
+        self.assertIs(get_figure_template(self.tables, 'girls', [48.0]), template)  ## same 2-5 year tables
+        self.assertIsNot(get_figure_template(self.tables, 'boys', [30.0]), template)
+        self.assertIsNot(get_figure_template(self.tables, 'girls', [12.0]), template)
+        self.assertIsNot(get_figure_template(build_growth_database(), 'girls', [30.0]), template)
+
+    def test_template_follows_the_ages_at_measurement(self):
+        ## a 3 year old's infant measurements are drawn on the 0-2 year curves they are scored with
+        def height_months(template):
+            x = next(trace for trace in template.figure['data'] if trace['xaxis'] == 'x3')['x']
+            ## plotly stores arrays base64 encoded
+            return np.frombuffer(base64.b64decode(x['bdata']), dtype=x['dtype']) if isinstance(x, dict) else np.asarray(x)
+        self.assertEqual(height_months(get_figure_template(self.tables, 'girls', [3.0, 4.0])).max(), 24)
+        months = height_months(get_figure_template(self.tables, 'girls', [3.0, 40.0]))
+        self.assertEqual((months.min(), months.max()), (0, 60))
+
+    def test_reference_curves_have_one_row_per_month(self):
+        curves = reference_curves(self.tables)['curves']
+        for gender in curves:
+            for ycol, curve in curves[gender].items():
+                self.assertTrue((np.diff(curve['months']) > 0).all(), (gender, ycol))
+        height = curves['girls']['height_cm']
+        infant = self.tables['girls']['lhfa'][(0, 2)]
+        self.assertEqual(height['P50'][height['months'].index(24)], infant.loc[24, 'P50'])  ## length, as scored
+
+    def test_templates_are_bounded(self):
+        for _ in range(MAX_FIGURE_TEMPLATES + 4):
+            get_figure_template(dict(self.tables), 'girls', [3.0])  ## a reloaded tables object
+        self.assertEqual(len(_FIGURE_TEMPLATES), MAX_FIGURE_TEMPLATES)
+
+    def test_children_get_their_own_traces(self):
+        figures = []
+        with mock.patch('plotly.graph_objs.Figure.write_html', autospec=True, side_effect=lambda fig, output: figures.append(fig)):
+            for weight in (5.0, 6.0):
+                df = pd.DataFrame({'months': [3.0, 4.0], 'weight_kg': [weight, weight + 0.5], 'height_cm': [60.0, 62.0],
+                                   'hc_cm': [40.0, 41.0]})
+                df['bmi'] = df['weight_kg'] / (df['height_cm'] / 100) ** 2
+                child = Child(f'child{weight}', 'F', '2023-10-01')
+                df = percentile(df, child, self.tables)
+                plot_subplot_growth_percentiles(df, child, self.tables, 'unused.html', show=False)
+        template = get_figure_template(self.tables, 'girls', [3.0, 4.0])
+        n_reference = len(template.figure['data'])
+        self.assertEqual(len(template.new_figure().data), n_reference)  ## rendering did not modify the template
+        weights = [list(fig.data[n_reference].y) for fig in figures]
+        self.assertEqual(weights, [[5.0, 5.5], [6.0, 6.5]])
+        self.assertEqual([fig.layout.title.text for fig in figures], ['Growth percentiles for child5.0', 'Growth percentiles for child6.0'])
+        self.assertEqual(figures[0].data[0].y, figures[1].data[0].y)  ## shared reference curves
+
+
+    def test_table_does_not_zero_unscored_values(self):
+        df = pd.DataFrame({'months': [3.0, 3.1, 80.0], 'weight_kg': [5.5, 25.0, 12.0], 'height_cm': [60.0, None, None],
+                           'hc_cm': [40.0, 40.5, None]})
+        df['bmi'] = df['weight_kg'] / (df['height_cm'] / 100) ** 2
+        child = Child('a', 'F', '2020-01-01')  ## older than the tables, the template follows the measurements
+        df = flag_plausibility(percentile(df, child, self.tables))
+        figures = []
+        with mock.patch('plotly.graph_objs.Figure.write_html', autospec=True, side_effect=lambda fig, output: figures.append(fig)):
+            plot_subplot_growth_percentiles(df, child, self.tables, 'unused.html', show=False)
+        months, weight, bmi, height, hc, flags = figures[0].data[-1].cells.values
+        self.assertEqual(list(height), ['%.2f' % df.loc[0, 'height_percentile'], '-', '-'])
+        self.assertEqual(weight[2], '-')                          ## older than the WHO tables
+        self.assertEqual(list(flags), ['', 'weight biv', 'weight invalid'])
+
+
+class TestConsoleOutput(unittest.TestCase):
+    def history(self, n: int) -> pd.DataFrame:
+        dates = pd.date_range('2024-01-01', periods=n, freq='D')
+        return pd.DataFrame({'date': dates, 'months': np.arange(n) / 30, 'weight_kg': 3.0 + np.arange(n) / 100,
+                             'weight_percentile': np.linspace(10, 60, n)})
+
+    def printed(self, df: pd.DataFrame, **kwargs) -> str:
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            print_growth(df, Console(width=200), **kwargs)
+        return out.getvalue()
+
+    def test_auto_full_and_tail(self):
+        short = self.printed(self.history(10))
+        self.assertEqual(short.count('2024-01-'), 10)
+        text = self.printed(self.history(60))  ## longer than AUTO_FULL_ROWS: the tail
+        self.assertIn(f'Latest {DEFAULT_ROWS} of 60 measurements', text)
+        self.assertEqual(text.count('2024-'), DEFAULT_ROWS)
+        self.assertIn('2024-02-29', text)
+        self.assertNotIn('2024-01-01', text)
+        self.assertEqual(self.printed(self.history(60), mode='full').count('2024-'), 60)
+
+    def test_tail_rows(self):
+        text = self.printed(self.history(60), mode='tail', rows=3)
+        self.assertIn('Latest 3 of 60 measurements', text)
+        self.assertEqual(text.count('2024-'), 3)
+        self.assertLess(text.index('2024-02-29'), text.index('2024-02-27'))  ## newest first
+        self.assertIn('3.59 (60.0%)', text)
+
+    def test_summary(self):
+        df = self.history(60)
+        df.loc[59, 'weight_kg'] = np.nan  ## the latest value is the last one measured
+        text = self.printed(df, mode='summary')
+        self.assertIn('60 measurements', text)
+        self.assertNotIn('2024-', text)
+        row = next(line for line in text.splitlines() if 'Weight' in line)
+        for cell in ('59', '3.58', '59.2%', '10.0% - 59.2%'):
+            self.assertIn(cell, row)
+
+    def test_page_and_unknown_mode(self):
+        pages = []
+        with mock.patch('pydoc.pager', side_effect=pages.append):
+            self.assertEqual(self.printed(self.history(60), mode='page'), '')
+        self.assertEqual(pages[0].count('2024-'), 60)
+        with self.assertRaises(ValueError):
+            self.printed(self.history(3), mode='head')
+
+    def test_cli_rows(self):
+        with tempfile.TemporaryDirectory() as out, mock.patch('plotly.graph_objs.Figure.show'), \
+                mock.patch('main.ResultCache', lambda: ResultCache(Path(out) / 'cache')):
+            result = CliRunner().invoke(cli, ['growth', '-i', 'example.csv', '-d', '2023-10-01', '-g', 'F', '-s', out,
+                                              '--display', 'tail', '--rows', '4'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('Latest 4 of 14 measurements', result.output)
+
+class TestWeightForLength(unittest.TestCase):
+    def setUp(self):
+        ## synthetic table in the shape of the WHO weight-for-length table
+        length = np.round(np.arange(45.0, 110.05, 0.1), 1)
+        self.wfl = pd.DataFrame({
+            'L': np.full(len(length), -0.35),
+            'M': 2.4 + (length - 45) * 0.2,
+            'S': np.full(len(length), 0.09),
+        }, index=pd.Index(length, name='Length'))
+        self.tables = build_growth_database()
+        self.tables['girls']['wfl'] = {(0, 2): self.wfl}
+
+    def test_zscore_by_length(self):
+        df = pd.DataFrame({'months': [6.0, 6.0, 30.0], 'weight_kg': [7.0, 7.0, 12.0], 'height_cm': [65.03, 130.0, 90.0]})
+        df = zscores(df, Child('a', 'F', '2020-01-01'), self.tables)
+        expected = ZscoreWeight(*interpolate_lms(65.03, self.wfl), 7.0).zscore()
+        self.assertAlmostEqual(df.loc[0, 'wflh_zscore'], expected, places=9)
+        self.assertTrue(np.isnan(df.loc[1, 'wflh_zscore']))   ## longer than the table
+        self.assertTrue(np.isnan(df.loc[2, 'wflh_zscore']))   ## no weight-for-height table loaded
+
+    def test_trajectory(self):
+        ## weight-for-length has no velocity of its own, its crossings follow the wflh z-scores
+        df = pd.DataFrame({'months': [3.0, 4.0, 5.0], 'weight_kg': [5.5, 6.0, 6.4], 'height_cm': [58.0, 62.0, 63.0]})
+        res = growth_trajectory(zscores(df, Child('a', 'F', '2020-01-01'), self.tables))
+        self.assertNotIn('wflh_velocity', res.columns)
+        self.assertAlmostEqual(res.loc[1, 'weight_velocity'], 0.5)
+        bands = np.searchsorted(MAJOR_CENTILE_Z, res['wflh_zscore'], side='right')
+        self.assertEqual(res.loc[1, 'wflh_centiles_crossed'], bands[1] - bands[0])
+        self.assertNotEqual(res.loc[1, 'wflh_centiles_crossed'], res.loc[1, 'weight_centiles_crossed'])
+
+    def test_store_keeps_length_index(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            store = Path(tmp) / 'who_reference.npy'
+            compile_reference_store(self.tables, store)
+            mapped = load_reference_store(store)['girls']['wfl'][(0, 2)]
+            self.assertEqual(mapped.index.name, 'Length')
+            np.testing.assert_allclose(mapped.index.to_numpy(), self.wfl.index.to_numpy())
+
+
+class TestLMSCache(unittest.TestCase):
+    def test_hits_and_evictions(self):
+        tables = build_growth_database()
+        cache = LMSCache(maxsize=2)
+        expected = interpolate_lms(5.3, get_growth_table(tables, 'wfa', 'girls', 0))
+        np.testing.assert_allclose(cache.lms(tables, 'wfa', 'girls', 5.3), expected)
+        cache.lms(tables, 'wfa', 'girls', 5.3001)  ## same quantized age
+        cache.lms(tables, 'wfa', 'boys', 5.3)
+        cache.lms(tables, 'lhfa', 'girls', 5.3)
+        stats = cache.stats
+        self.assertEqual((stats.hits, stats.misses, stats.evictions, stats.size), (1, 3, 1, 2))
+        cache.clear()
+        self.assertEqual(cache.stats.size, 0)
+
+    def test_scoring_uses_the_shared_cache(self):
+        tables = build_growth_database()
+        df = pd.DataFrame({'months': [3.0, 3.0, 4.5, np.nan], 'weight_kg': [5.5, 5.6, 6.0, 6.1]})
+        before = lms_cache.stats
+        first = zscores(df.copy(), Child('a', 'F', '2020-01-01'), tables)
+        middle = lms_cache.stats
+        second = zscores(df.copy(), Child('a', 'F', '2020-01-01'), tables)
+        after = lms_cache.stats
+        self.assertGreater(middle.misses, before.misses)
+        self.assertEqual(after.misses, middle.misses)  ## every age is a hit the second time
+        self.assertGreater(after.hits, middle.hits)
+        pd.testing.assert_frame_equal(first, second)
+        L, M, S = lms_for_months(tables, 'wfa', 'girls', df['months'])
+        np.testing.assert_array_equal(lms_cache.lms_array(tables, 'wfa', 'girls', df['months'])[1], M)
+
+    def test_lms_and_lms_array_share_keys(self):
+        tables = build_growth_database()
+        cache = LMSCache()
+        cache.lms_array(tables, 'wfa', 'girls', [5.3, 5.3001, 7.25])
+        self.assertEqual(cache.stats.size, 2)  ## 5.3001 is quantized to 5.3
+        cache.lms(tables, 'wfa', 'girls', 5.3)
+        cache.lms(tables, 'wfa', 'girls', 7.25)
+        self.assertEqual((cache.stats.size, cache.stats.hits), (2, 2))
+
+    def test_unchanged_reload_keeps_the_cache(self):
+        cleared = []
+        on_reload(lambda: cleared.append(True))
+        try:
+            shared_growth_database()
+            cleared.clear()
+            lms_cache.lms(build_growth_database(), 'wfa', 'girls', 5.3)
+            size = lms_cache.stats.size
+            shared_growth_database()  ## same store mapped again, e.g. by a watcher poll
+            self.assertEqual((cleared, lms_cache.stats.size), ([], size))
+        finally:
+            _RELOAD_CALLBACKS.pop()
+
+    def test_table_versions_are_bounded(self):
+        cache = LMSCache()
+        tables = build_growth_database()
+        for _ in range(MAX_TABLE_VERSIONS + 3):
+            cache.lms(dict(tables), 'wfa', 'girls', 5.3)  ## a new tables object, as after a reload
+        self.assertEqual(len(cache._versions), MAX_TABLE_VERSIONS)
+
+
+class TestFolderWatcher(unittest.TestCase):
+    def test_only_new_rows_are_scored(self):
+        rows = Path('example.csv').read_text().splitlines()
+        with tempfile.TemporaryDirectory() as folder, tempfile.TemporaryDirectory() as out:
+            export = Path(folder) / 'emma.csv'
+            children = [ChildConfig('emma*.csv', 'emma', '2023-10-01', 'F')]
+            watcher = FolderWatcher(folder, children, out, growth_tables=build_growth_database(), render=False)
+            export.write_text('\n'.join(rows[:1] + rows[6:]) + '\n')
+            self.assertEqual(watcher.scan(), 9)
+            export.write_text('\n'.join(rows) + '\n')  ## cumulative export with 5 newer rows on top
+            self.assertEqual(watcher.scan(), 5)
+            self.assertEqual(watcher.scan(), 0)
+            self.assertEqual(len(pd.read_csv(Path(out) / 'emma_growth.csv')), 14)
+
+    def test_new_column_does_not_rescore(self):
+        rows = Path('example.csv').read_text().splitlines()
+        with tempfile.TemporaryDirectory() as folder, tempfile.TemporaryDirectory() as out:
+            export = Path(folder) / 'emma.csv'
+            children = [ChildConfig('emma*.csv', 'emma', '2023-10-01', 'F')]
+            watcher = FolderWatcher(folder, children, out, growth_tables=build_growth_database(), render=False)
+            export.write_text('\n'.join(rows[:6]) + '\n')  ## height and head circumference are empty
+            self.assertEqual(watcher.scan(), 5)
+            ## the new row fills both columns, and writes the weight as an integer
+            export.write_text('\n'.join(rows[:1] + ['2024-03-10 09:00:00,5,58.0,37.1'] + rows[1:6]) + '\n')
+            self.assertEqual(watcher.scan(), 1)
+            output = pd.read_csv(Path(out) / 'emma_growth.csv')
+            self.assertEqual(len(output), 6)
+            self.assertEqual(output['hc_cm'].notna().sum(), 1)
+            ## hashes lost or from an older version: the rows are scored again but not duplicated
+            next(Path(out, '.watch').glob('*.rows.npy')).unlink()
+            export.write_text(export.read_text() + '2023-12-01 10:00:00,3.1,,\n')
+            self.assertEqual(watcher.scan(), 7)
+            self.assertEqual(len(pd.read_csv(Path(out) / 'emma_growth.csv')), 7)
+
+
+    def test_only_measurements_are_counted(self):
+        with tempfile.TemporaryDirectory() as folder, tempfile.TemporaryDirectory() as out:
+            export = Path(folder) / 'emma.csv'
+            children = [ChildConfig('emma*.csv', 'emma', '2023-12-01', 'F', format='huckleberry')]
+            watcher = FolderWatcher(folder, children, out, growth_tables=build_growth_database(), render=False)
+            export.write_text(TestPolarsBackend.HUCKLEBERRY)
+            with mock.patch('src.watcher.pd.read_csv', wraps=pd.read_csv) as read_csv:
+                self.assertEqual(watcher.scan(), 3)  ## the feed row is not a measurement
+            ## parsed from the bytes read for the hash, not read from the file again
+            self.assertTrue(all(isinstance(c.args[0], io.BytesIO) for c in read_csv.call_args_list))
+            export.write_text(export.read_text() + 'Feed,2024-03-09 10:00,,,,,,\n')
+            self.assertEqual(watcher.scan(), 0)
+            export.write_text(export.read_text() + 'Growth,2024-03-10 10:00,,,5.4kg,,,\n')
+            self.assertEqual(watcher.scan(), 1)
+
+
+class TestJobQueue(unittest.TestCase):
+    def test_upload_is_scored_once(self):
+        data = Path('example.csv').read_bytes()
+        with tempfile.TemporaryDirectory() as root:
+            queue = JobQueue(root, max_workers=1, chunk_rows=5)
+            try:
+                job_id = queue.submit(data, 'example.csv', '2023-10-01', 'F')
+                job, = queue.wait([job_id], timeout=60)
+                self.assertEqual(job.status, 'done')
+                self.assertEqual((job.done_rows, job.total_rows), (14, 14))
+                result = queue.result(job_id)
+                self.assertEqual(len(result), 14)
+                self.assertIn('weight_percentile', result.columns)
+                ## same content and child: the finished job is reused
+                self.assertEqual(queue.submit(data, 'copy.csv', '2023-10-01', 'F'), job_id)
+                self.assertEqual(queue.job(job_id).updated, job.updated)
+                self.assertNotEqual(queue.submit(data, 'example.csv', '2023-10-01', 'M'), job_id)
+            finally:
+                queue.shutdown()
+
+    def test_key_includes_format(self):
+        data = Path('example.csv').read_bytes()
+        self.assertNotEqual(job_key(data, '2023-10-01', 'F', 'auto'), job_key(data, '2023-10-01', 'F', 'huckleberry'))
+
+    def test_key_includes_reference_and_code(self):
+        data = Path('example.csv').read_bytes()
+        key = job_key(data, '2023-10-01', 'F')
+        with mock.patch('src.jobs.store_version', return_value='other'):
+            self.assertNotEqual(job_key(data, '2023-10-01', 'F'), key)
+        with mock.patch('src.jobs.code_version', return_value='other'):
+            self.assertNotEqual(job_key(data, '2023-10-01', 'F'), key)
+
+    def test_simultaneous_uploads_enqueue_once(self):
+        data = Path('example.csv').read_bytes()
+        with tempfile.TemporaryDirectory() as root:
+            queue = JobQueue(root)
+            queue._pool = mock.Mock()
+            first = queue.submit(data, 'example.csv', '2023-10-01', 'F')
+            ## still queued, so the second upload claims nothing
+            self.assertEqual(queue.submit(data, 'copy.csv', '2023-10-01', 'F'), first)
+            self.assertEqual(queue._pool.submit.call_count, 1)
+            self.assertEqual(queue.job(first).filename, 'example.csv')
+            ## a job that lost its process is taken over
+            with mock.patch('time.time', return_value=time.time() + 2 * 600):
+                queue.submit(data, 'copy.csv', '2023-10-01', 'F')
+            self.assertEqual(queue._pool.submit.call_count, 2)
+            self.assertEqual(queue.job(first).filename, 'copy.csv')
+
+    def test_old_jobs_are_removed(self):
+        data = Path('example.csv').read_bytes()
+        with tempfile.TemporaryDirectory() as root:
+            queue = JobQueue(root, max_workers=1)
+            try:
+                job_id = queue.submit(data, 'example.csv', '2023-10-01', 'F')
+                queue.wait([job_id], timeout=60)
+                queue.maybe_cleanup()  ## first call runs, the job is too recent to remove
+                self.assertIsNotNone(queue.job(job_id))
+                with mock.patch('time.time', return_value=time.time() + 8 * 24 * 3600):
+                    queue.maybe_cleanup()
+                self.assertIsNone(queue.job(job_id))
+                self.assertEqual(sorted(p.name for p in Path(root).iterdir() if p.name.startswith(job_id)), [])
+            finally:
+                queue.shutdown()
+
+
+class TestPopulationSummary(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        n = 10_000
+        self.df = pd.DataFrame({
+            'gender': rng.choice(['M', 'F'], n), 'months': rng.uniform(0, 60, n),
+            'weight_zscore': rng.normal(-0.5, 1.2, n), 'height_zscore': rng.normal(-1, 1, n),
+            'bmi_zscore': rng.normal(0, 1, n),
+        })
+
+    def test_merged_chunks_match_one_pass(self):
+        whole = PopulationSummary().update(self.df)
+        merged = PopulationSummary().update(self.df.iloc[:3000]) + PopulationSummary().update(self.df.iloc[3000:])
+        pd.testing.assert_frame_equal(whole.stats(), merged.stats())
+        pd.testing.assert_frame_equal(whole.prevalence(), merged.prevalence())
+        self.assertTrue((whole.zstats['weight_zscore'].hist == merged.zstats['weight_zscore'].hist).all())
+
+    def test_matches_pandas(self):
+        stats, prevalence = PopulationSummary().update(self.df).stats(), PopulationSummary().update(self.df).prevalence()
+        rows = self.df[(self.df['gender'] == 'F') & (self.df['months'] >= 12) & (self.df['months'] < 24)]
+        self.assertAlmostEqual(stats.loc[('F', '12-24m'), 'height_mean'], rows['height_zscore'].mean())
+        self.assertAlmostEqual(stats.loc[('F', '12-24m'), 'height_sd'], rows['height_zscore'].std())
+        self.assertAlmostEqual(prevalence.loc[('F', '12-24m'), 'stunting_%'], 100 * (rows['height_zscore'] < -2).mean())
+
+    def test_cli_on_growth_output(self):
+        ## the per-child outputs carry the child's sex, so the files of two children are summarized as they are
+        with tempfile.TemporaryDirectory() as out, mock.patch('plotly.graph_objs.Figure.show'), \
+                mock.patch('main.ResultCache', lambda: ResultCache(Path(out) / 'cache')):
+            for gender in ['F', 'M']:
+                result = CliRunner().invoke(cli, ['growth', '-i', 'example.csv', '-d', '2023-10-01', '-g', gender,
+                                                  '-s', out, '-p', gender, '-q'])
+                self.assertEqual(result.exit_code, 0, result.output)
+            scored = sorted(Path(out).glob('*.csv'))
+            self.assertEqual(pd.read_csv(scored[0])['gender'].unique().tolist(), ['F'])
+            result = CliRunner().invoke(cli, ['population', *[a for f in scored for a in ('-i', str(f))], '-o', str(Path(out) / 'cohort')])
+            self.assertEqual(result.exit_code, 0, result.output)
+            prevalence = pd.read_csv(Path(out) / 'cohort_prevalence.csv', index_col=[0, 1])
+            ## a file without a sex column is a usage error unless its sex is given
+            other = Path(out) / 'other.csv'
+            pd.read_csv(scored[0]).drop(columns='gender').to_csv(other, index=False)
+            result = CliRunner().invoke(cli, ['population', '-i', str(other)])
+            self.assertEqual(result.exit_code, 2, result.output)
+            self.assertIn("no column 'gender'", result.output)
+        self.assertEqual(prevalence.loc[('F', '0-6m'), 'underweight_n'], 14)
+        self.assertEqual(prevalence.loc[('M', '0-6m'), 'underweight_n'], 14)
+
+class TestDirectoryPipeline(unittest.TestCase):
+    def test_every_file_is_written(self):
+        with tempfile.TemporaryDirectory() as folder, tempfile.TemporaryDirectory() as out:
+            for i in range(5):
+                (Path(folder) / f'emma{i}.csv').write_text(Path('example.csv').read_text())
+            (Path(folder) / 'unknown.csv').write_text(Path('example.csv').read_text())
+            (Path(folder) / 'emma_broken.csv').write_text('date,weight_kg\nnot a date,5\n')
+            children = [ChildConfig('emma*.csv', 'emma', '2023-10-01', 'F')]
+            pipeline = DirectoryPipeline(children, out, build_growth_database(), readers=2, scorers=1, writers=2,
+                                         queue_size=2, render=False)
+            report = pipeline.run(folder)
+            self.assertEqual(report.files, 6)
+            self.assertEqual([s.items for s in report.stages], [6, 5, 5])
+            self.assertEqual(report.stages[0].failed, 1)
+            self.assertTrue(all(q.max_depth <= 2 for q in report.queues))
+            self.assertEqual(len(list(Path(out).glob('*_growth.csv'))), 5)
+            self.assertEqual(len(pd.read_csv(Path(out) / 'emma0_growth.csv')), 14)
+
+    def test_stage_without_workers_is_rejected(self):
+        with tempfile.TemporaryDirectory() as out:
+            with self.assertRaises(ValueError):
+                DirectoryPipeline([], out, {}, scorers=0)
+            result = CliRunner().invoke(cli, ['batch', '-i', out, '-c', 'example.csv', '--writers', '0'])
+        self.assertEqual(result.exit_code, 2, result.output)
+        self.assertIn('--writers', result.output)
+
+
+
+class TestReportSite(unittest.TestCase):
+    def read_data(self, path: Path):
+        ## GrowthSite.receive("key", {...});
+        key, data = path.read_text().split(', ', 1)
+        return key[len('GrowthSite.receive('):], json.loads(data.rstrip().rstrip(');'))
+
+    def test_colliding_ids(self):
+        ids = child_ids(['emma 1', 'emma_1', 'emma2'])
+        self.assertEqual((ids['emma_1'], ids['emma2']), ('emma_1', 'emma2'))
+        self.assertTrue(ids['emma 1'].startswith('emma_1-'))
+        ## an id only depends on the names it collides with
+        self.assertEqual(child_ids(['emma 1', 'emma_1'])['emma 1'], ids['emma 1'])
+        self.assertEqual(child_ids(['emma 1']), {'emma 1': 'emma_1'})
+        ## one file on case-insensitive file systems
+        self.assertEqual(len({i.lower() for i in child_ids(['Emma', 'emma', 'EMMA']).values()}), 3)
+
+    def test_site_from_pipeline(self):
+        with tempfile.TemporaryDirectory() as folder, tempfile.TemporaryDirectory() as out:
+            for name in ['emma 1', 'emma_1', 'emma3']:
+                (Path(folder) / f'{name}.csv').write_text(Path('example.csv').read_text())
+            children = [ChildConfig('emma*.csv', 'emma', '2023-10-01', 'F')]
+            site = Path(out) / 'site'
+            DirectoryPipeline(children, out, build_growth_database(), site=site).run(folder)
+            self.assertEqual(list(Path(out).glob('*.html')), [])  ## no chart per file
+            self.assertTrue((site / 'index.html').exists())
+            self.assertEqual(len(list((site / 'assets').glob('plotly-*.min.js'))), 1)
+            self.assertEqual(sorted(p.name for p in (site / 'reference').glob('girls_*.js')),
+                             ['girls_bmi.js', 'girls_hc_cm.js', 'girls_height_cm.js', 'girls_weight_kg.js'])
+            key, entries = self.read_data(site / 'children.js')
+            self.assertEqual(key, '"children"')
+            self.assertEqual(sorted(e['id'] for e in entries), sorted(child_ids(['emma 1', 'emma_1', 'emma3']).values()))
+            self.assertEqual(len(list((site / 'children').glob('*.js'))), 3)
+            key, data = self.read_data(site / 'children' / 'emma_1.js')
+            self.assertEqual(key, '"children/emma_1"')
+            self.assertEqual((data['sex'], data['rows']), ('girls', 14))
+            self.assertEqual(data['columns']['months'], sorted(data['columns']['months']))
+            self.assertEqual(len(data['columns']['weight_percentile']), 14)
+
+class TestResultCache(unittest.TestCase):
+    def test_key_and_eviction(self):
+        with tempfile.TemporaryDirectory() as root:
+            export = Path(root) / 'export.csv'
+            export.write_text(Path('example.csv').read_text())
+            key = result_key([export], 'ref1', dob='2023-10-01', gender='F')
+            self.assertEqual(key, result_key([export], 'ref1', dob='2023-10-01', gender='F'))
+            self.assertNotEqual(key, result_key([export], 'ref2', dob='2023-10-01', gender='F'))
+            self.assertNotEqual(key, result_key([export], 'ref1', dob='2023-10-01', gender='M'))
+            export.write_text(Path('example.csv').read_text() + '2024-03-09 10:00:00,5.3,,\n')
+            self.assertNotEqual(key, result_key([export], 'ref1', dob='2023-10-01', gender='F'))
+
+            df = pd.read_csv('example.csv')
+            cache = ResultCache(Path(root) / 'cache')
+            self.assertIsNone(cache.get('a'))
+            cache.put('a', df)
+            pd.testing.assert_frame_equal(cache.get('a'), df)
+            cache.max_bytes = cache.size() + 1  ## room for one entry
+            cache.put('b', df)
+            self.assertIsNone(cache.get('a'))
+            self.assertIsNotNone(cache.get('b'))
+
+
+    def test_cached_rows_are_computed_in_src(self):
+        ## main.py only writes what `score_exports` returns, so the src/ code version covers the cached rows
+        with tempfile.TemporaryDirectory() as out, mock.patch('plotly.graph_objs.Figure.show'), \
+                mock.patch('main.ResultCache', lambda: ResultCache(Path(out) / 'cache')):
+            result = CliRunner().invoke(cli, ['growth', '-i', 'example.csv', '-d', '2023-10-01', '-g', 'F', '-s', out, '-q'])
+            self.assertEqual(result.exit_code, 0, result.output)
+            cache = ResultCache(Path(out) / 'cache')
+            key = result_key(['example.csv'], store_version(), dob=pd.Timestamp('2023-10-01'), gender='F', format='auto', backend='pandas')
+            cached = cache.get(key)
+        expected = score_exports(['example.csv'], Child('child', 'F', pd.Timestamp('2023-10-01')), shared_growth_database())
+        pd.testing.assert_frame_equal(cached, expected)
+
+class TestMerge(unittest.TestCase):
+    def setUp(self):
+        clinic = pd.DataFrame({'date': pd.to_datetime(['2024-01-01 10:00', '2024-02-01 10:00']),
+                               'weight_kg': [5.0, 6.0], 'height_cm': [np.nan, 60.0]})
+        app = pd.DataFrame({'date': pd.to_datetime(['2024-01-01 10:30', '2024-01-01 10:50', '2024-03-01 09:00']),
+                            'weight_kg': [5.2, 5.3, 7.0], 'height_cm': [55.0, np.nan, 64.0]})
+        self.combined = combine_sources({'clinic': clinic, 'app': app})
+
+    def test_priority(self):
+        merged = merge_measurements(self.combined, window='1h')
+        self.assertEqual(len(merged), 3)
+        first = merged.iloc[-1]
+        self.assertEqual(first['source'], 'clinic')
+        self.assertEqual(first['merged_rows'], 3)
+        self.assertEqual(first['weight_kg'], 5.0)
+        self.assertEqual(first['height_cm'], 55.0)  ## clinic has no height, taken from the app
+        self.assertEqual(merge_measurements(self.combined, priority=['app', 'clinic']).iloc[-1]['weight_kg'], 5.2)
+
+    def test_median_and_window(self):
+        self.assertAlmostEqual(merge_measurements(self.combined, strategy='median').iloc[-1]['weight_kg'], 5.2)
+        self.assertEqual(len(merge_measurements(self.combined, window='10min')), 5)
+
+    def test_dense_series_is_not_chained(self):
+        ## readings 50 minutes apart for two days: each group spans at most the window
+        app = pd.DataFrame({'date': pd.date_range('2024-01-01', periods=48, freq='50min'),
+                            'weight_kg': np.linspace(5.0, 5.5, 48)})
+        merged = merge_measurements(combine_sources({'app': app}), window='1h')
+        self.assertEqual(len(merged), 24)
+        self.assertEqual(merged['merged_rows'].tolist(), [2] * 24)
+        self.assertEqual(len(merge_measurements(combine_sources({'app': app}), window='10min')), 48)
+        dates = merged['date'].sort_values()
+        self.assertEqual(dates.iloc[0], pd.Timestamp('2024-01-01 00:00'))
+        self.assertEqual(dates.iloc[1], pd.Timestamp('2024-01-01 01:40'))
+
+    def test_children_are_not_merged(self):
+        df = pd.concat([self.combined.assign(child='a'), self.combined.assign(child='b')], ignore_index=True)
+        merged = merge_measurements(df, window='1h')
+        self.assertEqual(len(merged), 6)
+        self.assertEqual(sorted(merged['child'].unique()), ['a', 'b'])
+
+
+class TestInputFormats(unittest.TestCase):
+    def test_sniff(self):
+        self.assertEqual(sniff_format('example.csv').name, 'standard')
+        self.assertEqual(sniff_format(TestPolarsBackend.HUCKLEBERRY.encode()).name, 'huckleberry')
+        with self.assertRaises(ValueError):
+            sniff_format(b'when,what\n2024-01-01,5\n')
+
+    def test_standard_export_without_weights(self):
+        ## any one measurement column identifies a standard export, the date alone does not
+        self.assertEqual(sniff_format(b'date,height_cm,hc_cm\n2024-03-08,57.5,38.1\n').name, 'standard')
+        self.assertEqual(sniff_format(b'date,hc_cm\n2024-03-08,38.1\n').name, 'standard')
+        with self.assertRaises(ValueError):
+            sniff_format(b'date,notes\n2024-03-08,checkup\n')
+        with tempfile.TemporaryDirectory() as folder:
+            export = Path(folder) / 'lengths.csv'
+            export.write_text('date,height_cm,hc_cm\n2024-03-08,57.5,38.1\n')
+            df = parse_export(export, Child('emma', 'F', '2023-12-01'))
+        self.assertEqual(df['height_cm'].iloc[0], 57.5)
+        self.assertTrue(np.isnan(df['bmi'].iloc[0]))
+
+    def test_plugged_in_format(self):
+        clinic = register_format(InputFormat(
+            name='clinic_test',
+            columns={'Visit': 'date', 'Weight (lb)': 'weight', 'Length (in)': 'height'},
+            units={'weight': 'lbs', 'height': 'in'},
+            date_format='%d/%m/%Y',
+        ))
+        try:
+            with tempfile.TemporaryDirectory() as folder:
+                export = Path(folder) / 'visits.csv'
+                export.write_text('Visit,Weight (lb),Length (in)\n08/03/2024,11,22.5\n')
+                self.assertIs(sniff_format(export), clinic)
+                df = parse_export(export, Child('emma', 'F', '2023-12-01'))
+            self.assertEqual(df['date'].iloc[0], pd.Timestamp('2024-03-08'))
+            self.assertAlmostEqual(df['weight_kg'].iloc[0], 11 * 0.453592)
+            self.assertAlmostEqual(df['height_cm'].iloc[0], 22.5 * 2.54)
+            self.assertEqual(df['months'].iloc[0], round(98 / 30, 2))
+        finally:
+            FORMATS.pop('clinic_test')
+
+    def test_deprecated_huckleberry_flag(self):
+        with tempfile.TemporaryDirectory() as out, mock.patch('main.ResultCache', lambda: ResultCache(Path(out) / 'cache')):
+            export = Path(out) / 'export.csv'
+            export.write_text(TestPolarsBackend.HUCKLEBERRY)
+            args = ['growth', '-i', str(export), '-d', '2023-12-01', '-g', 'F', '-s', out, '-q']
+            result = CliRunner().invoke(cli, args + ['-hb'])
+            self.assertEqual(result.exit_code, 0, result.output)
+            self.assertEqual(len(pd.read_csv(Path(out) / 'child_huckleberry.csv')), 3)
+            result = CliRunner().invoke(cli, args + ['--huckleberry', '--format', 'standard'])
+            self.assertEqual(result.exit_code, 2, result.output)
+
+
+@unittest.skipIf(pl is None, 'polars is not installed')
+class TestPolarsBackend(unittest.TestCase):
+    HUCKLEBERRY = (
+        'Type,Start,End,Duration,Start Condition,Start Location,End Condition,Notes\n'
+        'Feed,2024-03-08 10:00,,,,,,\n'
+        'Growth,2024-03-08 16:23,,,5.22kg,57.5cm,38.1cm,\n'
+        'Growth,2024-02-08 16:23,,,11.5lbs.oz,22.5in,,\n'
+        'Growth,2024-01-08 16:23,,,10lbs,1.8ft.in,14in,\n'
+    )
+
+    def assertSameFrame(self, expected, result):
+        self.assertEqual(list(expected.columns), list(result.columns))
+        for col in expected.columns:
+            if not pd.api.types.is_float_dtype(result[col]):
+                self.assertEqual(list(expected[col].astype(str)), list(result[col].astype(str)), col)
+            else:
+                np.testing.assert_allclose(pd.to_numeric(expected[col]).astype(float), result[col].astype(float),
+                                           rtol=1e-12, err_msg=col)
+
+    def test_standard_csv(self):
+        child, tables = Child('emma', 'F', '2023-10-01'), build_growth_database()
+        self.assertSameFrame(standardize_reader('example.csv', child, tables),
+                             reader_polars('example.csv', child, tables))
+
+    def test_huckleberry_csv(self):
+        child, tables = Child('emma', 'F', '2023-12-01'), build_growth_database()
+        with tempfile.TemporaryDirectory() as folder:
+            export = Path(folder) / 'huckleberry.csv'
+            export.write_text(self.HUCKLEBERRY)
+            self.assertSameFrame(huckleberry_reader(export, child, tables).reset_index(drop=True),
+                                 reader_polars(export, child, tables))
+
+    def test_malformed_values(self):
+        child = Child('emma', 'F', '2023-12-01')
+        header = self.HUCKLEBERRY.splitlines()[0]
+        with tempfile.TemporaryDirectory() as folder:
+            export = Path(folder) / 'huckleberry.csv'
+            ## a weight without a unit is missing in both backends
+            export.write_text(header + '\nGrowth,2024-03-08 16:23,,,abc,57.5cm,,\n')
+            self.assertSameFrame(parse_export(export, child).reset_index(drop=True), frame_polars(export, child))
+            self.assertTrue(np.isnan(frame_polars(export, child)['weight_kg'].iloc[0]))
+            ## a length without a unit, or a number that does not parse, is an error in both
+            for row in ['Growth,2024-03-08 16:23,,,5.22kg,57.5,,', 'Growth,2024-03-08 16:23,,,5.2.1kg,57.5cm,,']:
+                export.write_text(header + '\nGrowth,2024-02-08 16:23,,,5.1kg,56cm,,\n' + row + '\n')
+                with self.assertRaises(ValueError):
+                    parse_export(export, child)
+                with self.assertRaises(ValueError):
+                    frame_polars(export, child)
+
+    def test_only_mapped_columns_are_read(self):
+        with tempfile.TemporaryDirectory() as folder:
+            export = Path(folder) / 'huckleberry.csv'
+            export.write_text(self.HUCKLEBERRY)
+            lf, _, _ = _lazy_frame(export, Child('emma', 'F', '2023-12-01'))
+            read, total = map(int, re.search(r'PROJECT (\d+)/(\d+) COLUMNS', lf.explain()).groups())
+        self.assertEqual((read, total), (5, 8))  ## Type for the filter and the 4 mapped columns
 
 
 if __name__=='__main__':